@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Benchmark da serialização de listagens (10k linhas)
+Compara o caminho padrão (modelos Pydantic + response_model) com o caminho
+rápido (linhas do banco com projeção serializadas direto pelo orjson)
+"""
+
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+from typing import List
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from server_mongodb_backup import Cliente, Fornecedor
+
+TOTAL_LINHAS = 10000
+REPETICOES = 5
+
+def gerar_clientes(total):
+    agora = datetime.utcnow()
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "nome": f"Cliente {i}",
+            "email": f"cliente{i}@exemplo.com.br",
+            "telefone": "(11) 99999-0000",
+            "endereco": f"Rua Exemplo, {i}",
+            "cidade": "São Paulo",
+            "uf": "SP",
+            "cep": "01000-000",
+            "cpf_cnpj": f"{i:014d}",
+            "observacoes": "",
+            "ativo": True,
+            "created_at": agora,
+            "updated_at": agora
+        }
+        for i in range(total)
+    ]
+
+def gerar_fornecedores(total):
+    agora = datetime.utcnow()
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "nome": f"Fornecedor {i}",
+            "cnpj": f"{i:014d}",
+            "email": f"fornecedor{i}@exemplo.com.br",
+            "telefone": "(11) 3333-0000",
+            "endereco": f"Av. Exemplo, {i}",
+            "cidade": "Campinas",
+            "uf": "SP",
+            "cep": "13000-000",
+            "contato": "Comercial",
+            "condicoes_pagamento": "30/60/90",
+            "observacoes": "",
+            "ativo": True,
+            "created_at": agora,
+            "updated_at": agora
+        }
+        for i in range(total)
+    ]
+
+async def caminho_padrao(modelo, linhas, campo):
+    """Como get_clientes/get_fornecedores sem JSON_RAPIDO"""
+    objetos = [modelo(**linha) for linha in linhas]
+    conteudo = await serialize_response(field=campo, response_content=objetos)
+    return JSONResponse(conteudo).body
+
+async def caminho_rapido(modelo, linhas, campo):
+    """Como get_clientes/get_fornecedores com JSON_RAPIDO=1"""
+    return ORJSONResponse(linhas).body
+
+async def medir(funcao, modelo, linhas, campo):
+    melhores = []
+    for _ in range(REPETICOES):
+        inicio = time.perf_counter()
+        corpo = await funcao(modelo, linhas, campo)
+        melhores.append(time.perf_counter() - inicio)
+    return min(melhores) * 1000, len(corpo)
+
+async def main():
+    print(f"Serialização de listagens com {TOTAL_LINHAS} linhas (melhor de {REPETICOES})")
+    for nome, modelo, gerar in (("clientes", Cliente, gerar_clientes), ("fornecedores", Fornecedor, gerar_fornecedores)):
+        linhas = gerar(TOTAL_LINHAS)
+        campo = create_response_field(name=f"lista_{nome}", type_=List[modelo])
+        
+        antes, tamanho_antes = await medir(caminho_padrao, modelo, linhas, campo)
+        depois, tamanho_depois = await medir(caminho_rapido, modelo, linhas, campo)
+        
+        print(f"  {nome:<13} padrão: {antes:8.1f} ms ({tamanho_antes} bytes)"
+              f" | orjson: {depois:7.1f} ms ({tamanho_depois} bytes) | {antes / depois:5.1f}x")
+
+if __name__ == "__main__":
+    import asyncio
+    asyncio.run(main())
@@ -1,31 +1,86 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import JSONResponse, ORJSONResponse, FileResponse, Response
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, UpdateMany, DeleteOne, ReturnDocument
+from pymongo.errors import BulkWriteError
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, AfterValidator, PlainSerializer
+from typing import List, Optional, Dict, Any, Union, Annotated
 import uuid
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
+from dateutil.relativedelta import relativedelta
 import jwt
 from passlib.context import CryptContext
 import xml.etree.ElementTree as ET
-from decimal import Decimal
+from decimal import Decimal, ROUND_HALF_UP
+from bson.decimal128 import Decimal128
+from bson.codec_options import CodecOptions, TypeCodec, TypeRegistry
 import json
 import asyncio
-from collections import defaultdict
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import math
+import bisect
+import heapq
+import itertools
+import unicodedata
+import csv
+import io
+import re
+import base64
+import hashlib
+import zlib
+from collections import defaultdict, Counter, OrderedDict
 import requests
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson
+except ImportError:  # dependência opcional
+    orjson = None
+
+try:
+    from PIL import Image
+except ImportError:  # dependência opcional (miniaturas)
+    Image = None
+
+try:
+    import brotli
+except ImportError:  # dependência opcional (compressão br)
+    brotli = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+class DecimalCodec(TypeCodec):
+    """Valores monetários (Decimal) gravados como Decimal128: somas exatas no banco e no Python"""
+    python_type = Decimal
+    bson_type = Decimal128
+    
+    def transform_python(self, value):
+        return Decimal128(value)
+    
+    def transform_bson(self, value):
+        return value.to_decimal()
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+db = client.get_database(os.environ['DB_NAME'], codec_options=CodecOptions(type_registry=TypeRegistry([DecimalCodec()])))
+
+# Tarefas em segundo plano (referência mantida até concluírem)
+_tarefas_background = set()
+
+# Transações exigem replica set/sharded cluster; detectado na inicialização
+transacoes_suportadas = False
 
 # Security
 SECRET_KEY = "your-secret-key-change-in-production"
@@ -33,26 +88,154 @@ ALGORITHM = "HS256"
 security = HTTPBearer()
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# Serialização rápida (orjson, sem revalidar response_model nas listagens); opt-in via JSON_RAPIDO=1
+JSON_RAPIDO = orjson is not None and os.environ.get("JSON_RAPIDO", "0") == "1"
+
+def _json_padrao(valor):
+    if isinstance(valor, Decimal):
+        return float(valor)
+    raise TypeError
+
+class RespostaJSONRapida(ORJSONResponse):
+    """ORJSONResponse que também serializa Decimal (dinheiro) como número"""
+    
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=_json_padrao, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
 # Create the main app without a prefix
-app = FastAPI(title="ERP System", version="1.0.0")
+app = FastAPI(
+    title="ERP System",
+    version="1.0.0",
+    default_response_class=RespostaJSONRapida if JSON_RAPIDO else JSONResponse
+)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
-# Função para buscar empresas cadastradas
-async def get_empresas_config():
-    """Retorna configuração de empresas do banco de dados"""
-    empresas = await db.empresas.find({"ativo": True}).to_list(100)
+# Intervalo mínimo entre consultas a versoes_colecoes feitas pelos caches em memória
+VERSAO_CACHE_TTL_SEGUNDOS = float(os.environ.get("VERSAO_CACHE_TTL_SEGUNDOS", "5"))
+
+class VersaoColecao:
+    """Versão de uma coleção em versoes_colecoes, consultada no máximo a cada VERSAO_CACHE_TTL_SEGUNDOS"""
+    
+    def __init__(self, colecao: str):
+        self.colecao = colecao
+        self.versao: Optional[int] = None
+        self.consultada_em = 0.0
+    
+    async def atual(self) -> int:
+        agora = time.monotonic()
+        if self.versao is None or agora - self.consultada_em >= VERSAO_CACHE_TTL_SEGUNDOS:
+            documento = await db.versoes_colecoes.find_one({"_id": self.colecao})
+            self.versao = documento["versao"] if documento else 0
+            self.consultada_em = agora
+        return self.versao
+    
+    def expirar(self):
+        """Consulta de novo no próximo acesso (ex.: alteração feita por esta instância)"""
+        self.versao = None
+
+# Cache das empresas cadastradas (muda poucas vezes ao ano, usado em toda operação de estoque)
+_empresas_config: Optional[Dict[str, dict]] = None
+_empresas_versao = 0
+versao_empresas = VersaoColecao("empresas")
+
+async def carregar_empresas_config():
+    """Recarrega a configuração de empresas a partir do banco de dados"""
+    global _empresas_config, _empresas_versao
+    # Versão lida antes das empresas: uma alteração no meio da leitura força nova carga
+    versao_empresas.expirar()
+    _empresas_versao = await versao_empresas.atual()
+    empresas = await db.empresas.find({"ativo": True}).to_list(None)
     config = {}
     for empresa in empresas:
         config[empresa["cnpj"]] = {
             "nome": empresa["nome_fantasia"] or empresa["razao_social"], 
             "uf": empresa["uf"]
         }
+    _empresas_config = config
     return config
 
+async def get_empresas_config():
+    """Retorna configuração de empresas (em cache); alterações de outras instâncias chegam em até VERSAO_CACHE_TTL_SEGUNDOS"""
+    if _empresas_config is None or await versao_empresas.atual() != _empresas_versao:
+        return await carregar_empresas_config()
+    return _empresas_config
+
+def invalidar_empresas_config():
+    """Descarta o cache de empresas; recarregado no próximo acesso"""
+    global _empresas_config
+    _empresas_config = None
+
+async def validar_cnpj_empresa(cnpj: str):
+    """Garante que o CNPJ pertence a uma empresa ativa"""
+    if cnpj not in await get_empresas_config():
+        raise HTTPException(status_code=400, detail=f"CNPJ {cnpj} não pertence a uma empresa ativa")
+
+def projecao_modelo(modelo) -> dict:
+    """Projeção MongoDB apenas com os campos do modelo (sem _id)"""
+    return {"_id": 0, **{campo: 1 for campo in modelo.model_fields}}
+
+def projecao_campos(fields: Optional[str], modelo) -> Optional[dict]:
+    """Projeção MongoDB a partir do parâmetro fields=campo1,campo2 (None = documento completo)"""
+    if not fields:
+        return None
+    
+    campos = [campo.strip() for campo in fields.split(",") if campo.strip()]
+    invalidos = [campo for campo in campos if campo not in modelo.model_fields]
+    if invalidos:
+        raise HTTPException(status_code=400, detail=f"Campos inválidos: {', '.join(invalidos)}")
+    
+    return {"_id": 0, "id": 1, **{campo: 1 for campo in campos}}
+
+def resposta_linhas(linhas: list, etag: Optional[str] = None):
+    """Resposta com as linhas do banco como estão (parciais, sem passar pelo response_model)"""
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"} if etag else None
+    if JSON_RAPIDO:
+        return RespostaJSONRapida(linhas, headers=headers)
+    return JSONResponse(jsonable_encoder(linhas), headers=headers)
+
+# Versão por coleção: incrementada a cada escrita, vira o ETag das listagens
+class ETagColecao:
+    """Dependência que responde 304 quando o cliente já tem a versão atual da coleção.
+    
+    Declarar depois de get_current_user: o FastAPI resolve as dependências na ordem dos
+    parâmetros, e o 304 não pode sair antes da autenticação.
+    """
+    
+    def __init__(self, colecao: str):
+        self.colecao = colecao
+    
+    async def __call__(self, request: Request, response: Response) -> str:
+        documento = await db.versoes_colecoes.find_one({"_id": self.colecao})
+        versao = documento["versao"] if documento else 0
+        # Parâmetros (ex.: fields=) mudam o corpo da resposta, então entram no ETag
+        variante = hashlib.md5(str(request.query_params).encode()).hexdigest()[:8]
+        etag = f'W/"{self.colecao}-{versao}-{variante}"'
+        
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if request.headers.get("if-none-match") == etag:
+            raise HTTPException(status_code=304, headers=headers)
+        
+        response.headers.update(headers)
+        return etag
+
+async def registrar_alteracao(*colecoes: str):
+    """Invalida os ETags das coleções alteradas"""
+    for colecao in colecoes:
+        await db.versoes_colecoes.update_one({"_id": colecao}, {"$inc": {"versao": 1}}, upsert=True)
+
 # ============= MODELS =============
 
+CENTAVO = Decimal("0.01")
+
+# Dinheiro: Decimal com 2 casas (Decimal128 no banco), número no JSON
+Dinheiro = Annotated[
+    Decimal,
+    AfterValidator(lambda valor: valor.quantize(CENTAVO, rounding=ROUND_HALF_UP)),
+    PlainSerializer(float, return_type=float, when_used="json")
+]
+
 class LoginRequest(BaseModel):
     username: str
     password: str
@@ -62,6 +245,34 @@ class LoginResponse(BaseModel):
     token_type: str = "bearer"
     user: dict
 
+# Empresa Models
+class Empresa(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    cnpj: str
+    razao_social: str
+    nome_fantasia: str = ""
+    endereco: str = ""
+    cidade: str = ""
+    uf: str
+    cep: str = ""
+    telefone: str = ""
+    email: str = ""
+    ativo: bool = True
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class EmpresaCreate(BaseModel):
+    cnpj: str
+    razao_social: str
+    nome_fantasia: str = ""
+    endereco: str = ""
+    cidade: str = ""
+    uf: str
+    cep: str = ""
+    telefone: str = ""
+    email: str = ""
+    ativo: bool = True
+
 # Cliente Models
 class Cliente(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -122,6 +333,20 @@ class FornecedorCreate(BaseModel):
     observacoes: str = ""
     ativo: bool = True
 
+# Mapeamento código do fornecedor (cProd da NF-e) -> produto
+class MapeamentoFornecedor(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    fornecedor_cnpj: str
+    codigo_fornecedor: str
+    produto_id: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class MapeamentoFornecedorCreate(BaseModel):
+    fornecedor_cnpj: str
+    codigo_fornecedor: str
+    produto_id: str
+
 # Produto Models
 class EstoqueCNPJ(BaseModel):
     cnpj: str
@@ -146,6 +371,7 @@ class Produto(BaseModel):
     estoques_cnpj: List[EstoqueCNPJ] = []
     fornecedor_id: str = ""
     imagem_url: str = ""
+    imagem_hash: str = ""  # Referência ao arquivo no armazenamento de imagens
     ativo: bool = True
     fora_estado: bool = False  # Para regra ICMS
     created_at: datetime = Field(default_factory=datetime.utcnow)
@@ -162,6 +388,7 @@ class ProdutoCreate(BaseModel):
     valor_compra: float = 0.0
     preco_venda: float = 0.0
     fornecedor_id: str = ""
+    imagem_url: str = ""  # URL ou data URI (base64), que vai para o armazenamento de imagens
     fora_estado: bool = False
 
 # Movimentação Estoque
@@ -179,6 +406,17 @@ class MovimentacaoEstoque(BaseModel):
     usuario: str = ""
     data: datetime = Field(default_factory=datetime.utcnow)
 
+class ItemTransferencia(BaseModel):
+    sku: str
+    quantidade: int
+
+class TransferenciaEstoque(BaseModel):
+    cnpj_origem: str
+    cnpj_destino: str
+    itens: List[ItemTransferencia]
+    documento: str = ""
+    motivo: str = ""
+
 # Financeiro Models  
 class ContaBanco(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -187,7 +425,7 @@ class ContaBanco(BaseModel):
     banco: str = ""
     agencia: str = ""
     conta: str = ""
-    saldo_atual: float = 0.0
+    saldo_atual: Dinheiro = Decimal("0")
     ativo: bool = True
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -197,14 +435,14 @@ class ContaBancoCreate(BaseModel):
     banco: str = ""
     agencia: str = ""
     conta: str = ""
-    saldo_atual: float = 0.0
+    saldo_atual: Dinheiro = Decimal("0")
 
 class ContaFinanceira(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     tipo: str  # PAGAR, RECEBER
     descricao: str
-    valor: float
-    valor_pago: float = 0.0
+    valor: Dinheiro
+    valor_pago: Dinheiro = Decimal("0")
     data_vencimento: date
     data_pagamento: Optional[date] = None
     status: str = "PENDENTE"  # PENDENTE, PAGO, VENCIDO
@@ -222,7 +460,7 @@ class ContaFinanceira(BaseModel):
 class ContaFinanceiraCreate(BaseModel):
     tipo: str
     descricao: str
-    valor: float
+    valor: Dinheiro
     data_vencimento: date
     categoria: str = ""
     observacoes: str = ""
@@ -230,24 +468,107 @@ class ContaFinanceiraCreate(BaseModel):
     cliente_id: str = ""
     documento: str = ""
     cnpj: str = ""
+    conta_banco_id: str = ""  # Conta bancária prevista para a baixa (projeção do fluxo de caixa)
     parcelas: int = 1
 
+class BaixaConta(BaseModel):
+    conta_banco_id: str
+    valor_pago: Dinheiro
+    data_pagamento: date
+
+class ItemBaixaLote(BaixaConta):
+    conta_id: str
+
+class BaixaLote(BaseModel):
+    baixas: List[ItemBaixaLote]
+
+class LancamentoBanco(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    conta_banco_id: str
+    conta_financeira_id: str = ""
+    tipo: str  # CREDITO, DEBITO
+    valor: Dinheiro  # Com sinal: positivo entra, negativo sai
+    descricao: str = ""
+    documento: str = ""
+    cnpj: str = ""
+    data: date
+    saldo_apos: Optional[Dinheiro] = None  # Saldo da conta bancária logo após o lançamento
+    usuario: str = "sistema"
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+# Regras de ICMS interestadual (DIFAL) aplicadas ao custo de compra
+class RegraICMS(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    uf_origem: str  # "*" = qualquer UF
+    uf_destino: str  # "*" = qualquer UF
+    ncm_prefixo: str = ""  # "" = qualquer NCM
+    categoria: str = ""  # "" = qualquer categoria
+    aliquota: float  # Percentual acrescido ao custo (ex.: 6.0)
+    descricao: str = ""
+    ativo: bool = True
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class RegraICMSCreate(BaseModel):
+    uf_origem: str
+    uf_destino: str
+    ncm_prefixo: str = ""
+    categoria: str = ""
+    aliquota: float
+    descricao: str = ""
+    ativo: bool = True
+
 # XML Processing
 class XMLProcessamento(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     arquivo_nome: str
     fornecedor_cnpj: str = ""
     fornecedor_nome: str = ""
+    uf_emitente: str = ""
     numero_nf: str = ""
     valor_total: float = 0.0
     valor_produtos: float = 0.0
     valor_icms: float = 0.0
     itens: List[Dict] = []
-    status: str = "PENDENTE"  # PENDENTE, PROCESSADO, ERRO
+    status: str = "PENDENTE"  # PENDENTE, ENFILEIRADO, PROCESSANDO, PROCESSADO, ERRO
     cnpj_destino: str = ""
     data_processamento: datetime = Field(default_factory=datetime.utcnow)
 
 # ============= HELPER FUNCTIONS =============
 
+def documento_bson(documento: dict) -> dict:
+    """Converte campos date (não suportados pelo BSON) em datetime à meia-noite"""
+    return {
+        chave: datetime.combine(valor, datetime.min.time()) if type(valor) is date else valor
+        for chave, valor in documento.items()
+    }
+
+MAXIMO_PARCELAS = 600
+
+def gerar_parcelas(conta_dict: dict) -> List[ContaFinanceira]:
+    """Gera o parcelamento em uma passada; os centavos que sobram da divisão vão para a última parcela"""
+    total_parcelas = conta_dict["parcelas"]
+    total_centavos = round(conta_dict["valor"] * 100)
+    centavos_parcela, resto = divmod(total_centavos, total_parcelas)
+    data_base = conta_dict["data_vencimento"]
+    
+    base = {chave: valor for chave, valor in conta_dict.items() if chave != "parcelas"}
+    base["total_parcelas"] = total_parcelas
+    
+    parcelas = []
+    for i in range(total_parcelas):
+        centavos = centavos_parcela + (resto if i == total_parcelas - 1 else 0)
+        parcelas.append(ContaFinanceira(
+            **{
+                **base,
+                "valor": Decimal(centavos) / 100,
+                "parcela": i + 1,
+                "descricao": f"{base['descricao']} - Parcela {i + 1}/{total_parcelas}",
+                "data_vencimento": data_base + relativedelta(months=i)
+            }
+        ))
+    return parcelas
+
 async def calcular_custo_medio(produto_id: str, novo_custo: float, quantidade: int):
     """Calcula custo médio baseado no histórico de compras"""
     produto = await db.produtos.find_one({"id": produto_id})
@@ -310,8 +631,357 @@ async def atualizar_estoque_produto(produto_id: str, cnpj: str, quantidade: int,
             }
         }
     )
+    await registrar_alteracao("produtos")
+    
+    # Atualizar alertas apenas do CNPJ movimentado
+    produto["estoques_cnpj"] = estoques_cnpj
+    await sincronizar_alertas_estoque([produto], {cnpj})
     return True
 
+async def sincronizar_alertas_estoque(produtos: List[dict], cnpjs: Optional[set] = None):
+    """Mantém o índice de alertas (produto x CNPJ abaixo do estoque mínimo) atualizado"""
+    operacoes = []
+    agora = datetime.utcnow()
+    
+    for produto in produtos:
+        for estoque in produto.get("estoques_cnpj", []):
+            if cnpjs is not None and estoque["cnpj"] not in cnpjs:
+                continue
+            
+            chave = {"produto_id": produto["id"], "cnpj": estoque["cnpj"]}
+            estoque_minimo = estoque.get("estoque_minimo", 0)
+            
+            if estoque_minimo > 0 and estoque["quantidade"] < estoque_minimo:
+                operacoes.append(UpdateOne(
+                    chave,
+                    {
+                        "$set": {
+                            "sku": produto.get("sku", ""),
+                            "nome": produto.get("nome", ""),
+                            "quantidade": estoque["quantidade"],
+                            "estoque_minimo": estoque_minimo,
+                            "estoque_maximo": estoque.get("estoque_maximo", 0),
+                            "updated_at": agora
+                        },
+                        "$setOnInsert": {"desde": agora}
+                    },
+                    upsert=True
+                ))
+            else:
+                operacoes.append(DeleteOne(chave))
+    
+    if operacoes:
+        await db.alertas_estoque.bulk_write(operacoes, ordered=False)
+
+async def reconstruir_alertas_estoque():
+    """Reconstrói o índice de alertas a partir do catálogo completo"""
+    await db.alertas_estoque.delete_many({})
+    
+    cursor = db.produtos.find({}, {"_id": 0, "id": 1, "sku": 1, "nome": 1, "estoques_cnpj": 1})
+    lote = []
+    async for produto in cursor:
+        lote.append(produto)
+        if len(lote) >= 1000:
+            await sincronizar_alertas_estoque(lote)
+            lote = []
+    if lote:
+        await sincronizar_alertas_estoque(lote)
+    
+    return await db.alertas_estoque.count_documents({})
+
+def ler_linhas_importacao(content: bytes, filename: str) -> List[dict]:
+    """Lê as linhas de um arquivo CSV (vírgula ou ponto e vírgula) ou NDJSON, com colunas em minúsculas"""
+    texto = content.decode("utf-8-sig")
+    
+    if filename.lower().endswith((".ndjson", ".jsonl")):
+        registros = [json.loads(linha) for linha in texto.splitlines() if linha.strip()]
+        if not all(isinstance(registro, dict) for registro in registros):
+            raise ValueError("Cada linha NDJSON deve ser um objeto")
+    else:
+        amostra = texto[:4096]
+        delimitador = ";" if amostra.count(";") > amostra.count(",") else ","
+        registros = csv.DictReader(io.StringIO(texto), delimiter=delimitador)
+    
+    # Cabeçalhos como "SKU;Quantidade" ou " sku " valem o mesmo que "sku;quantidade"
+    return [{str(chave).strip().lower(): valor for chave, valor in registro.items() if chave} for registro in registros]
+
+# Colunas aceitas na importação de catálogo
+CATALOGO_COLUNAS_TEXTO = ["sku", "ean", "nome", "descricao", "categoria", "marca", "unidade", "fornecedor_id"]
+CATALOGO_COLUNAS_VALOR = ["valor_compra", "preco_venda"]
+CATALOGO_TAMANHO_LOTE = 1000
+
+# Valores dos campos ausentes no arquivo, usados só quando o produto é criado
+CATALOGO_PADROES = {
+    **{coluna: "" for coluna in CATALOGO_COLUNAS_TEXTO},
+    "unidade": "UN",
+    **{coluna: 0.0 for coluna in CATALOGO_COLUNAS_VALOR},
+    "fora_estado": False,
+    "margem_percentual": 0.0
+}
+
+def ler_catalogo(content: bytes, filename: str) -> pd.DataFrame:
+    """Lê um catálogo de produtos em CSV, NDJSON ou XLSX"""
+    nome_arquivo = filename.lower()
+    if nome_arquivo.endswith(".xlsx"):
+        return pd.read_excel(io.BytesIO(content), dtype=str)
+    if nome_arquivo.endswith((".ndjson", ".jsonl")):
+        return pd.read_json(io.BytesIO(content), lines=True, dtype=False)
+    
+    amostra = content[:4096].decode("utf-8-sig", errors="ignore")
+    delimitador = ";" if amostra.count(";") > amostra.count(",") else ","
+    return pd.read_csv(io.BytesIO(content), sep=delimitador, dtype=str, keep_default_na=False, encoding="utf-8-sig")
+
+def preparar_catalogo(df: pd.DataFrame):
+    """Valida e normaliza o catálogo de forma vetorizada, retornando (registros, erros).
+    
+    Os registros trazem apenas as colunas presentes no arquivo: as demais não são
+    sobrescritas em produtos existentes.
+    """
+    df.columns = [str(coluna).strip().lower() for coluna in df.columns]
+    presentes = set(df.columns)
+    
+    for coluna in CATALOGO_COLUNAS_TEXTO:
+        if coluna not in df:
+            df[coluna] = ""
+        df[coluna] = df[coluna].fillna("").astype(str).str.strip()
+    df.loc[df["unidade"] == "", "unidade"] = "UN"
+    
+    valores_invalidos = pd.Series(False, index=df.index)
+    for coluna in CATALOGO_COLUNAS_VALOR:
+        if coluna not in df:
+            df[coluna] = "0"
+        texto = df[coluna].fillna("").astype(str).str.strip().str.replace(",", ".", regex=False)
+        valores = pd.to_numeric(texto.where(texto != "", "0"), errors="coerce")
+        valores_invalidos |= valores.isna() | (valores < 0)
+        df[coluna] = valores.fillna(0.0).astype(float)
+    
+    if "fora_estado" in df:
+        df["fora_estado"] = df["fora_estado"].fillna("").astype(str).str.strip().str.lower().isin(["1", "true", "sim", "s", "x"])
+    else:
+        df["fora_estado"] = False
+    
+    # Motivo do erro por linha (numeração a partir da primeira linha de dados)
+    motivos = np.select(
+        [df["sku"] == "", df["nome"] == "", valores_invalidos],
+        ["SKU não informado", "Nome não informado", "Valor de compra/venda inválido"],
+        default=""
+    )
+    invalidas = motivos != ""
+    erros = [
+        {"linha": int(posicao) + 1, "sku": sku, "erro": str(motivo)}
+        for posicao, sku, motivo in zip(np.flatnonzero(invalidas), df["sku"][invalidas], motivos[invalidas])
+    ]
+    
+    validos = df[~invalidas].drop_duplicates("sku", keep="last")
+    valor_compra = validos["valor_compra"].to_numpy(dtype=float)
+    preco_venda = validos["preco_venda"].to_numpy(dtype=float)
+    
+    # Margem calculada para o catálogo inteiro de uma vez
+    with np.errstate(divide="ignore", invalid="ignore"):
+        margem = np.where(valor_compra > 0, np.round((preco_venda - valor_compra) / valor_compra * 100, 2), 0.0)
+    
+    validos = validos.assign(margem_percentual=margem)
+    colunas = [coluna for coluna in CATALOGO_COLUNAS_TEXTO + CATALOGO_COLUNAS_VALOR + ["fora_estado"] if coluna in presentes]
+    # Margem só quando o arquivo traz os dois valores
+    if all(coluna in presentes for coluna in CATALOGO_COLUNAS_VALOR):
+        colunas.append("margem_percentual")
+    return validos[colunas].to_dict("records"), erros
+
+async def processar_importacao_catalogo(importacao_id: str, content: bytes, filename: str):
+    """Importa o catálogo em lotes (upsert por SKU) registrando o progresso"""
+    try:
+        total_linhas, registros, erros = await executar_em_processo(preparar_catalogo_arquivo, content, filename)
+        
+        await db.importacoes_produtos.update_one(
+            {"id": importacao_id},
+            {"$set": {
+                "total_linhas": total_linhas,
+                "total_validas": len(registros),
+                "total_erros": len(erros),
+                "erros": erros[:1000],
+                "updated_at": datetime.utcnow()
+            }}
+        )
+        
+        empresas = await get_empresas_config()
+        estoques_iniciais = [
+            {"cnpj": cnpj, "quantidade": 0, "estoque_minimo": 0, "estoque_maximo": 0}
+            for cnpj in empresas.keys()
+        ]
+        
+        for inicio in range(0, len(registros), CATALOGO_TAMANHO_LOTE):
+            lote = registros[inicio:inicio + CATALOGO_TAMANHO_LOTE]
+            agora = datetime.utcnow()
+            operacoes = [
+                UpdateOne(
+                    {"sku": registro["sku"]},
+                    {
+                        "$set": {**registro, "updated_at": agora},
+                        "$setOnInsert": {
+                            **{campo: valor for campo, valor in CATALOGO_PADROES.items() if campo not in registro},
+                            "id": str(uuid.uuid4()),
+                            "custo_medio": registro.get("valor_compra", 0.0),
+                            "estoque_total": 0,
+                            "estoques_cnpj": estoques_iniciais,
+                            "imagem_url": "",
+                            "ativo": True,
+                            "created_at": agora
+                        }
+                    },
+                    upsert=True
+                )
+                for registro in lote
+            ]
+            resultado = await db.produtos.bulk_write(operacoes, ordered=False)
+            await registrar_alteracao("produtos")
+            
+            produto_ids = []
+            async for produto in db.produtos.find(
+                {"sku": {"$in": [registro["sku"] for registro in lote]}},
+                {"_id": 0, "id": 1, "sku": 1, "ean": 1, "nome": 1}
+            ):
+                indice_produtos.adicionar(produto)
+                cache_identidade.invalidar_produto(produto["id"])
+                produto_ids.append(produto["id"])
+            await registrar_alteracao_cadastro_produtos(produto_ids)
+            
+            await db.importacoes_produtos.update_one(
+                {"id": importacao_id},
+                {
+                    "$inc": {
+                        "processadas": len(lote),
+                        "inseridos": resultado.upserted_count,
+                        "atualizados": resultado.matched_count
+                    },
+                    "$set": {"updated_at": datetime.utcnow()}
+                }
+            )
+        
+        await db.importacoes_produtos.update_one(
+            {"id": importacao_id},
+            {"$set": {"status": "CONCLUIDO", "updated_at": datetime.utcnow()}}
+        )
+    except Exception as e:
+        logger.exception("Erro na importação de catálogo %s", importacao_id)
+        await db.importacoes_produtos.update_one(
+            {"id": importacao_id},
+            {"$set": {"status": "ERRO", "mensagem": str(e), "updated_at": datetime.utcnow()}}
+        )
+
+async def executar_transacao(operacao):
+    """Executa operacao(session) em uma transação quando o MongoDB suporta"""
+    if not transacoes_suportadas:
+        return await operacao(None)
+    
+    async with await client.start_session() as session:
+        return await session.with_transaction(operacao)
+
+async def reconstruir_lancamentos_banco():
+    """Gera os lançamentos bancários dos títulos pagos antes da existência do extrato"""
+    lancamentos = []
+    async for conta in db.contas_financeiras.find({"status": "PAGO", "conta_banco_id": {"$nin": ["", None]}}, {"_id": 0}):
+        pagar = conta["tipo"] == "PAGAR"
+        valor_pago = conta.get("valor_pago") or conta["valor"]
+        lancamento = LancamentoBanco(
+            conta_banco_id=conta["conta_banco_id"],
+            conta_financeira_id=conta["id"],
+            tipo="DEBITO" if pagar else "CREDITO",
+            valor=-valor_pago if pagar else valor_pago,
+            descricao=conta.get("descricao", ""),
+            documento=conta.get("documento", ""),
+            cnpj=conta.get("cnpj", ""),
+            data=(conta.get("data_pagamento") or conta["data_vencimento"]).date(),
+            created_at=conta.get("created_at") or datetime.utcnow()
+        )
+        lancamentos.append(documento_bson(lancamento.dict()))
+    
+    if lancamentos:
+        await db.lancamentos_banco.insert_many(lancamentos, ordered=False)
+        await preencher_saldo_apos_lancamentos()
+
+async def preencher_saldo_apos_lancamentos():
+    """Grava em cada lançamento o saldo após ele: saldo atual da conta menos tudo que veio depois"""
+    saldos = {
+        conta["id"]: conta.get("saldo_atual") or 0
+        async for conta in db.contas_banco.find({}, {"_id": 0, "id": 1, "saldo_atual": 1})
+    }
+    operacoes = []
+    async for lancamento in db.lancamentos_banco.aggregate([
+        {"$setWindowFields": {
+            "partitionBy": "$conta_banco_id",
+            "sortBy": {"data": 1, "created_at": 1, "id": 1},
+            "output": {"posteriores": {"$sum": "$valor", "window": {"documents": [1, "unbounded"]}}}
+        }},
+        {"$project": {"_id": 1, "conta_banco_id": 1, "posteriores": 1}}
+    ]):
+        saldo_apos = saldos.get(lancamento["conta_banco_id"], 0) - (lancamento.get("posteriores") or 0)
+        operacoes.append(UpdateOne({"_id": lancamento["_id"]}, {"$set": {"saldo_apos": round(Decimal(saldo_apos), 2)}}))
+        if len(operacoes) >= 1000:
+            await db.lancamentos_banco.bulk_write(operacoes, ordered=False)
+            operacoes = []
+    if operacoes:
+        await db.lancamentos_banco.bulk_write(operacoes, ordered=False)
+
+async def migrar_saldo_apos_lancamentos():
+    """Preenche uma única vez o saldo_apos dos lançamentos gravados antes do campo existir"""
+    if await db.migracoes.find_one({"_id": "lancamentos_saldo_apos"}):
+        return
+    await preencher_saldo_apos_lancamentos()
+    await db.migracoes.insert_one({"_id": "lancamentos_saldo_apos", "data": datetime.utcnow()})
+
+# Campos monetários gravados como Decimal128 (antes eram double)
+CAMPOS_DINHEIRO = {
+    "contas_financeiras": ["valor", "valor_pago"],
+    "contas_banco": ["saldo_atual"],
+    "lancamentos_banco": ["valor"],
+    "extrato_bancario": ["valor"]
+}
+
+async def migrar_dinheiro_decimal():
+    """Converte uma única vez os valores monetários gravados como double para Decimal128 (2 casas)"""
+    if await db.migracoes.find_one({"_id": "dinheiro_decimal128"}):
+        return
+    
+    for colecao, campos in CAMPOS_DINHEIRO.items():
+        for campo in campos:
+            resultado = await db[colecao].update_many(
+                {campo: {"$type": ["double", "int", "long"]}},
+                [{"$set": {campo: {"$round": [{"$toDecimal": f"${campo}"}, 2]}}}]
+            )
+            if resultado.modified_count:
+                logger.info(f"{resultado.modified_count} valores de {colecao}.{campo} convertidos para Decimal128")
+    
+    await db.migracoes.insert_one({"_id": "dinheiro_decimal128", "data": datetime.utcnow()})
+
+async def criar_indices():
+    """Cria os índices usados pelas consultas de estoque"""
+    await db.empresas.create_index([("cnpj", 1)], unique=True)
+    await db.produtos.create_index([("id", 1)], unique=True)
+    await db.produtos.create_index([("sku", 1)])
+    await db.alteracoes_produtos.create_index([("versao", 1)], unique=True)
+    await db.alteracoes_produtos.create_index([("created_at", 1)], expireAfterSeconds=86400)
+    await db.produtos.create_index([("nome", "text"), ("descricao", "text")], default_language="portuguese")
+    await db.importacoes_produtos.create_index([("id", 1)], unique=True)
+    await db.produtos_fornecedor.create_index([("fornecedor_cnpj", 1), ("codigo_fornecedor", 1)], unique=True)
+    await db.produtos_fornecedor.create_index([("produto_id", 1)])
+    await db.xml_processamentos.create_index([("id", 1)], unique=True)
+    await db.tarefas.create_index([("id", 1)], unique=True)
+    await db.tarefas.create_index([("status", 1), ("created_at", 1)])
+    await db.alertas_estoque.create_index([("produto_id", 1), ("cnpj", 1)], unique=True)
+    await db.alertas_estoque.create_index([("cnpj", 1)])
+    await db.movimentacoes_estoque.create_index([("tipo", 1), ("data", -1)])
+    await db.movimentacoes_estoque.create_index([("produto_id", 1), ("cnpj", 1), ("data", -1)])
+    await db.contas_banco.create_index([("id", 1)], unique=True)
+    await db.contas_financeiras.create_index([("id", 1)], unique=True)
+    await db.lancamentos_banco.create_index([("conta_banco_id", 1), ("data", 1)])
+    await db.lancamentos_banco.create_index([("conta_financeira_id", 1)])
+    await db.contas_financeiras.create_index([("status", 1), ("data_vencimento", 1)])
+    await db.contas_financeiras.create_index([("status", 1), ("data_pagamento", 1)])
+    await db.lancamentos_banco.create_index([("data", -1), ("created_at", -1), ("id", -1)])
+    await db.extrato_bancario.create_index([("conta_banco_id", 1), ("fitid", 1)], unique=True)
+    await db.extrato_bancario.create_index([("conta_banco_id", 1), ("status", 1), ("data", -1)])
+    await db.regras_icms.create_index([("id", 1)], unique=True)
+
 async def criar_movimentacao_estoque(produto_id: str, cnpj: str, tipo: str, quantidade_entrada: int, quantidade_saida: int, documento: str, descricao: str, valor_unitario: float, usuario: str = "sistema"):
     """Cria registro de movimentação de estoque"""
     movimentacao = MovimentacaoEstoque(
@@ -330,93 +1000,1301 @@ async def criar_movimentacao_estoque(produto_id: str, cnpj: str, tipo: str, quan
     await db.movimentacoes_estoque.insert_one(movimentacao.dict())
     return movimentacao
 
-# ============= AUTH FUNCTIONS =============
-
-def create_access_token(data: dict):
-    to_encode = data.copy()
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
-
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        return username
-    except jwt.PyJWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+# ============= PROCESSAMENTO CPU (POOL DE PROCESSOS) =============
 
-# ============= AUTH ROUTES =============
+# Quantidade de processos do pool; 0 usa todos os núcleos
+PROCESSOS_WORKERS = int(os.environ.get("PROCESSOS_WORKERS", "0"))
+_executor_processos: Optional[ProcessPoolExecutor] = None
 
-@api_router.post("/auth/login", response_model=LoginResponse)
-async def login(request: LoginRequest):
-    if request.username == "admin" and request.password == "admin123":
-        access_token = create_access_token(data={"sub": request.username})
-        return LoginResponse(
-            access_token=access_token,
-            user={"username": "admin", "role": "administrator"}
+def get_executor_processos() -> ProcessPoolExecutor:
+    global _executor_processos
+    if _executor_processos is None:
+        # forkserver: fork() depois que as threads do Motor/pymongo já existem pode travar os filhos em locks herdados
+        _executor_processos = ProcessPoolExecutor(
+            max_workers=PROCESSOS_WORKERS or None,
+            mp_context=multiprocessing.get_context("forkserver")
         )
-    else:
-        raise HTTPException(status_code=401, detail="Credenciais inválidas")
-
-@api_router.get("/auth/me")
-async def get_me(current_user: str = Depends(get_current_user)):
-    return {"username": current_user, "role": "administrator"}
+    return _executor_processos
 
-# ============= CLIENTE ROUTES =============
-
-@api_router.post("/clientes", response_model=Cliente)
-async def create_cliente(cliente: ClienteCreate, current_user: str = Depends(get_current_user)):
-    cliente_dict = cliente.dict()
-    cliente_obj = Cliente(**cliente_dict)
-    await db.clientes.insert_one(cliente_obj.dict())
-    return cliente_obj
+async def executar_em_processo(funcao, *args):
+    """Executa no pool de processos o parsing CPU-bound de arquivos enviados (entrada bytes, saída dicts).
+    
+    Só compensa quando o trabalho é maior que serializar argumentos e resultado entre processos.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor_processos(), funcao, *args)
 
-@api_router.get("/clientes", response_model=List[Cliente])
-async def get_clientes(current_user: str = Depends(get_current_user)):
-    clientes = await db.clientes.find().to_list(1000)
-    return [Cliente(**cliente) for cliente in clientes]
+def encerrar_executor_processos():
+    global _executor_processos
+    if _executor_processos is not None:
+        _executor_processos.shutdown(wait=False, cancel_futures=True)
+        _executor_processos = None
 
-@api_router.get("/clientes/{cliente_id}", response_model=Cliente)
-async def get_cliente(cliente_id: str, current_user: str = Depends(get_current_user)):
-    cliente = await db.clientes.find_one({"id": cliente_id})
-    if cliente:
-        return Cliente(**cliente)
-    raise HTTPException(status_code=404, detail="Cliente não encontrado")
+def _texto(elemento, caminho: str, padrao: str = "") -> str:
+    if elemento is None:
+        return padrao
+    encontrado = elemento.find(caminho)
+    return encontrado.text if encontrado is not None and encontrado.text is not None else padrao
 
-@api_router.put("/clientes/{cliente_id}", response_model=Cliente)
-async def update_cliente(cliente_id: str, cliente: ClienteCreate, current_user: str = Depends(get_current_user)):
-    update_data = cliente.dict()
-    update_data["updated_at"] = datetime.utcnow()
+def ler_nfe_xml(content: bytes) -> dict:
+    """Extrai emitente, totais e itens do XML da NF-e"""
+    # Parse do XML
+    root = ET.fromstring(content)
     
-    await db.clientes.update_one({"id": cliente_id}, {"$set": update_data})
-    updated_cliente = await db.clientes.find_one({"id": cliente_id})
-    if updated_cliente:
-        return Cliente(**updated_cliente)
-    raise HTTPException(status_code=404, detail="Cliente não encontrado")
+    # NF-e real usa o namespace http://www.portalfiscal.inf.br/nfe em todas as tags: remover para buscar pelo nome
+    for elemento in root.iter():
+        if isinstance(elemento.tag, str) and "}" in elemento.tag:
+            elemento.tag = elemento.tag.split("}", 1)[1]
+    
+    # Dados do emitente (fornecedor)
+    emit = root.find('.//emit')
+    fornecedor_cnpj = _texto(emit, './/CNPJ')
+    fornecedor_nome = _texto(emit, './/xNome')
+    uf_emitente = _texto(emit, './/enderEmit/UF')
+    
+    # Dados da NF
+    numero_nf = _texto(root.find('.//ide'), './/nNF')
+    
+    # Totais
+    total = root.find('.//total/ICMSTot')
+    valor_total = float(_texto(total, 'vNF', "0"))
+    valor_produtos = float(_texto(total, 'vProd', "0"))
+    valor_icms = float(_texto(total, 'vICMS', "0"))
+    
+    # Itens da NF
+    itens = []
+    for det in root.findall('.//det'):
+        prod = det.find('prod')
+        if prod is not None:
+            item = {
+                "codigo": _texto(prod, 'cProd'),
+                "descricao": _texto(prod, 'xProd'),
+                "ean": _texto(prod, 'cEAN'),
+                "ncm": _texto(prod, 'NCM'),
+                "quantidade": float(_texto(prod, 'qCom', "0")),
+                "valor_unitario": float(_texto(prod, 'vUnCom', "0")),
+                "valor_total": float(_texto(prod, 'vProd', "0"))
+            }
+            itens.append(item)
+    
+    return {
+        "fornecedor_cnpj": fornecedor_cnpj,
+        "fornecedor_nome": fornecedor_nome,
+        "uf_emitente": uf_emitente,
+        "numero_nf": numero_nf,
+        "valor_total": valor_total,
+        "valor_produtos": valor_produtos,
+        "valor_icms": valor_icms,
+        "itens": itens
+    }
 
-@api_router.delete("/clientes/{cliente_id}")
-async def delete_cliente(cliente_id: str, current_user: str = Depends(get_current_user)):
-    result = await db.clientes.delete_one({"id": cliente_id})
-    if result.deleted_count:
-        return {"message": "Cliente deletado com sucesso"}
-    raise HTTPException(status_code=404, detail="Cliente não encontrado")
+PROJECAO_EXPORTACAO = {
+    "_id": 0, "sku": 1, "nome": 1, "descricao": 1, "marca": 1, "categoria": 1, "ean": 1,
+    "estoque_total": 1, "custo_medio": 1, "preco_venda": 1, "margem_percentual": 1, "ativo": 1, "updated_at": 1
+}
 
-# ============= FORNECEDOR ROUTES =============
+def gerar_exportacao_estoque(produtos: List[dict], formato: str):
+    """Monta as linhas de exportação para marketplaces; em CSV retorna o texto pronto"""
+    dados_exportacao = []
+    for produto in produtos:
+        dados_exportacao.append({
+            "sku": produto["sku"],
+            "nome": produto["nome"],
+            "descricao": produto.get("descricao", ""),
+            "marca": produto.get("marca", ""),
+            "categoria": produto.get("categoria", ""),
+            "ean": produto.get("ean", ""),
+            "estoque_disponivel": produto["estoque_total"],
+            "custo_medio": round(produto["custo_medio"], 2),
+            "preco_venda": round(produto["preco_venda"], 2),
+            "margem_percentual": round(produto.get("margem_percentual", 0), 2),
+            "ativo": produto["ativo"],
+            "atualizado_em": produto["updated_at"].isoformat()
+        })
+    
+    if formato != "csv":
+        return dados_exportacao
+    
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=dados_exportacao[0].keys() if dados_exportacao else [])
+    writer.writeheader()
+    writer.writerows(dados_exportacao)
+    return output.getvalue()
 
-@api_router.post("/fornecedores", response_model=Fornecedor)
-async def create_fornecedor(fornecedor: FornecedorCreate, current_user: str = Depends(get_current_user)):
-    fornecedor_dict = fornecedor.dict()
-    fornecedor_obj = Fornecedor(**fornecedor_dict)
+def calcular_lucros_marketplace(movimentacoes: List[dict], custos: Dict[str, float]):
+    """Soma vendas e lucro estimado por marketplace a partir das movimentações de venda"""
+    lucro_total = 0
+    vendas_por_marketplace = {}
+    
+    for mov in movimentacoes:
+        # Extrair marketplace da descrição
+        desc = mov.get("descricao", "")
+        if "UPSELLER" in desc:
+            marketplace_nome = "UPSELLER"
+        elif "MERCADO LIVRE" in desc:
+            marketplace_nome = "MERCADO_LIVRE"
+        else:
+            marketplace_nome = "OUTROS"
+        
+        if marketplace_nome not in vendas_por_marketplace:
+            vendas_por_marketplace[marketplace_nome] = {
+                "vendas": 0,
+                "quantidade": 0,
+                "valor_vendido": 0,
+                "lucro_estimado": 0
+            }
+        
+        if mov["produto_id"] in custos:
+            custo_medio = custos[mov["produto_id"]]
+            lucro_item = (mov["valor_unitario"] - custo_medio) * mov["quantidade_saida"]
+            
+            vendas_por_marketplace[marketplace_nome]["vendas"] += 1
+            vendas_por_marketplace[marketplace_nome]["quantidade"] += mov["quantidade_saida"]
+            vendas_por_marketplace[marketplace_nome]["valor_vendido"] += mov["valor_total"]
+            vendas_por_marketplace[marketplace_nome]["lucro_estimado"] += lucro_item
+            
+            lucro_total += lucro_item
+    
+    return lucro_total, vendas_por_marketplace
+
+def preparar_catalogo_arquivo(content: bytes, filename: str):
+    """Lê e valida o catálogo, retornando (total de linhas, registros, erros)"""
+    df = ler_catalogo(content, filename)
+    registros, erros = preparar_catalogo(df)
+    return len(df), registros, erros
+
+def _data_extrato(texto: str) -> date:
+    texto = texto.strip()
+    if re.match(r"^\d{8}", texto):  # OFX: AAAAMMDD[HHMMSS[.XXX][-3:BRT]]
+        return datetime.strptime(texto[:8], "%Y%m%d").date()
+    for formato in ("%d/%m/%Y", "%Y-%m-%d", "%d/%m/%y"):
+        try:
+            return datetime.strptime(texto, formato).date()
+        except ValueError:
+            continue
+    raise ValueError(f"data inválida: {texto}")
+
+def _valor_extrato(texto: str) -> Decimal:
+    texto = str(texto).strip().replace("R$", "").replace(" ", "")
+    if "," in texto:  # formato brasileiro: 1.234,56
+        texto = texto.replace(".", "").replace(",", ".")
+    try:
+        return Decimal(texto).quantize(CENTAVO, rounding=ROUND_HALF_UP)
+    except ArithmeticError:
+        raise ValueError(f"valor inválido: {texto}")
+
+def ler_extrato(content: bytes, filename: str) -> dict:
+    """Lê extrato OFX ou CSV (colunas data, valor, descricao, documento, fitid), retornando linhas e erros"""
+    linhas, erros = [], []
+    
+    if filename.lower().endswith(".ofx"):
+        texto = content.decode("latin-1")
+        for numero, bloco in enumerate(re.findall(r"<STMTTRN>(.*?)</STMTTRN>", texto, re.S | re.I), start=1):
+            # OFX 1.x (SGML) não fecha as tags: o valor vai até a próxima tag ou quebra de linha
+            campos = {tag.upper(): valor.strip() for tag, valor in re.findall(r"<(\w+)>([^<\r\n]*)", bloco)}
+            try:
+                linhas.append({
+                    "fitid": campos.get("FITID", ""),
+                    "data": _data_extrato(campos["DTPOSTED"]),
+                    "valor": _valor_extrato(campos["TRNAMT"]),
+                    "descricao": campos.get("MEMO") or campos.get("NAME", ""),
+                    "documento": campos.get("CHECKNUM") or campos.get("REFNUM", "")
+                })
+            except (KeyError, ValueError) as e:
+                erros.append({"linha": numero, "erro": f"Lançamento inválido: {e}"})
+    else:
+        for numero, registro in enumerate(ler_linhas_importacao(content, filename), start=2):
+            try:
+                linhas.append({
+                    "fitid": str(registro.get("fitid") or "").strip(),
+                    "data": _data_extrato(str(registro["data"])),
+                    "valor": _valor_extrato(registro["valor"]),
+                    "descricao": str(registro.get("descricao") or "").strip(),
+                    "documento": str(registro.get("documento") or "").strip()
+                })
+            except (KeyError, ValueError) as e:
+                erros.append({"linha": numero, "erro": f"Linha inválida: {e}"})
+    
+    # Sem FITID, a identidade da linha é o próprio conteúdo (com contador para lançamentos idênticos no mesmo dia)
+    ocorrencias = Counter()
+    for linha in linhas:
+        if not linha["fitid"]:
+            chave = f"{linha['data'].isoformat()}|{linha['valor']:.2f}|{linha['descricao']}|{linha['documento']}"
+            ocorrencias[chave] += 1
+            linha["fitid"] = "H" + hashlib.sha1(f"{chave}|{ocorrencias[chave]}".encode()).hexdigest()
+    
+    return {"linhas": linhas, "erros": erros}
+
+def conciliar_extrato(linhas: List[dict], titulos: List[dict], janela_dias: int) -> List[dict]:
+    """Casa as linhas do extrato com títulos em aberto.
+    
+    Índice hash por (tipo, valor em centavos) com vencimentos ordenados, consultado por bisect
+    na janela de datas; o documento desempata. Retorna, por linha, o título casado ou os candidatos.
+    """
+    indice = defaultdict(list)
+    for titulo in sorted(titulos, key=lambda t: t["data_vencimento"]):
+        centavos = round((titulo["valor"] - (titulo.get("valor_pago") or 0)) * 100)
+        indice[(titulo["tipo"], centavos)].append(titulo)
+    datas = {chave: [t["data_vencimento"] for t in lista] for chave, lista in indice.items()}
+    janela = timedelta(days=janela_dias)
+    
+    resultados = []
+    usados = set()
+    for linha in linhas:
+        chave = ("RECEBER" if linha["valor"] > 0 else "PAGAR", round(abs(linha["valor"]) * 100))
+        candidatos = []
+        if chave in indice:
+            inicio = bisect.bisect_left(datas[chave], linha["data"] - janela)
+            fim = bisect.bisect_right(datas[chave], linha["data"] + janela)
+            candidatos = [t for t in indice[chave][inicio:fim] if t["id"] not in usados]
+        
+        if len(candidatos) > 1 and linha["documento"]:
+            mesmo_documento = [t for t in candidatos if t.get("documento") == linha["documento"]]
+            if mesmo_documento:
+                candidatos = mesmo_documento
+        
+        if len(candidatos) == 1:
+            usados.add(candidatos[0]["id"])
+            resultados.append({"status": "CONCILIADO", "conta_id": candidatos[0]["id"]})
+        elif candidatos:
+            resultados.append({"status": "AMBIGUO", "candidatos": [t["id"] for t in candidatos]})
+        else:
+            resultados.append({"status": "NAO_CONCILIADO"})
+    
+    return resultados
+
+# ============= BUSCA DE PRODUTOS =============
+
+def normalizar_busca(texto: str) -> str:
+    """Minúsculas e sem acentos, para indexar e buscar"""
+    if not texto or texto.isascii():
+        return (texto or "").lower().strip()
+    texto = unicodedata.normalize("NFKD", texto)
+    return "".join(c for c in texto if not unicodedata.combining(c)).lower().strip()
+
+def gerar_trigramas(texto: str) -> set:
+    """Trigramas do texto normalizado, com bordas marcadas por espaços"""
+    texto = f"  {texto} "
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+class IndiceProdutos:
+    """Índice em memória de produtos: SKU/EAN exatos, prefixo de SKU e nome por trigramas"""
+    
+    # Acima disso o termo é comum demais: os candidatos são restringidos aos nomes com mais trigramas raros
+    limite_candidatos = int(os.environ.get("BUSCA_LIMITE_CANDIDATOS", "2000"))
+    
+    def __init__(self):
+        self.por_sku: Dict[str, str] = {}
+        self.por_ean: Dict[str, str] = {}
+        self.skus_ordenados: List[tuple] = []
+        self.trigramas: Dict[str, set] = defaultdict(set)
+        self.chaves: Dict[str, tuple] = {}  # id -> (sku, ean, trigramas) para remoção
+    
+    def adicionar(self, produto: dict, ordenar: bool = True):
+        """Inclui ou atualiza o produto; carga em lote passa ordenar=False e chama ordenar() no fim"""
+        self.remover(produto["id"])
+        
+        produto_id = produto["id"]
+        sku = normalizar_busca(produto.get("sku", ""))
+        ean = (produto.get("ean") or "").strip()
+        trigramas = gerar_trigramas(normalizar_busca(produto.get("nome", "")))
+        
+        if sku:
+            self.por_sku[sku] = produto_id
+            if ordenar:
+                bisect.insort(self.skus_ordenados, (sku, produto_id))
+            else:
+                self.skus_ordenados.append((sku, produto_id))
+        if ean:
+            self.por_ean[ean] = produto_id
+        for trigrama in trigramas:
+            self.trigramas[trigrama].add(produto_id)
+        self.chaves[produto_id] = (sku, ean, trigramas)
+    
+    def remover(self, produto_id: str):
+        chaves = self.chaves.pop(produto_id, None)
+        if not chaves:
+            return
+        
+        sku, ean, trigramas = chaves
+        if sku and self.por_sku.get(sku) == produto_id:
+            del self.por_sku[sku]
+        if sku:
+            posicao = bisect.bisect_left(self.skus_ordenados, (sku, produto_id))
+            if posicao < len(self.skus_ordenados) and self.skus_ordenados[posicao] == (sku, produto_id):
+                del self.skus_ordenados[posicao]
+        if ean and self.por_ean.get(ean) == produto_id:
+            del self.por_ean[ean]
+        for trigrama in trigramas:
+            ids = self.trigramas.get(trigrama)
+            if ids:
+                ids.discard(produto_id)
+                if not ids:
+                    del self.trigramas[trigrama]
+    
+    def ordenar(self):
+        self.skus_ordenados.sort()
+    
+    def limpar(self):
+        self.__init__()
+    
+    def buscar_exato(self, termo: str) -> Optional[str]:
+        """Id do produto com SKU ou EAN exatamente igual ao termo"""
+        return self.por_sku.get(normalizar_busca(termo)) or self.por_ean.get(termo.strip())
+    
+    def buscar(self, termo: str, limite: int = 20, cobertura_minima: float = 0.5) -> List[str]:
+        """Retorna ids ordenados: SKU/EAN exato, prefixo de SKU e nome aproximado"""
+        termo_normalizado = normalizar_busca(termo)
+        if not termo_normalizado:
+            return []
+        
+        resultado = []
+        vistos = set()
+        
+        def incluir(produto_id):
+            if produto_id not in vistos and len(resultado) < limite:
+                vistos.add(produto_id)
+                resultado.append(produto_id)
+        
+        for produto_id in (self.por_sku.get(termo_normalizado), self.por_ean.get(termo.strip())):
+            if produto_id:
+                incluir(produto_id)
+        
+        posicao = bisect.bisect_left(self.skus_ordenados, (termo_normalizado,))
+        while posicao < len(self.skus_ordenados) and len(resultado) < limite:
+            sku, produto_id = self.skus_ordenados[posicao]
+            if not sku.startswith(termo_normalizado):
+                break
+            incluir(produto_id)
+            posicao += 1
+        
+        if len(resultado) >= limite:
+            return resultado
+        
+        # Nome aproximado (tolerante a erros de digitação): o nome precisa conter uma
+        # fração mínima dos trigramas do termo, então basta gerar candidatos a partir
+        # dos trigramas mais raros e conferir os demais por interseção
+        trigramas_termo = gerar_trigramas(termo_normalizado)
+        minimo_comum = math.ceil(cobertura_minima * len(trigramas_termo))
+        mais_raros = sorted(trigramas_termo, key=lambda t: len(self.trigramas.get(t, ())))
+        
+        # Termo comum: corte antecipado, consumindo as listas da mais rara para a mais comum
+        listas = [self.trigramas.get(trigrama, ()) for trigrama in mais_raros[:len(trigramas_termo) - minimo_comum + 1]]
+        candidatos = set(itertools.islice(itertools.chain(*listas), self.limite_candidatos))
+        
+        pontuados = []
+        for produto_id in candidatos:
+            trigramas_nome = self.chaves[produto_id][2]
+            comuns = len(trigramas_termo & trigramas_nome)
+            if comuns >= minimo_comum:
+                # Coeficiente de Dice entre os trigramas do termo e do nome
+                pontuados.append((2 * comuns / (len(trigramas_termo) + len(trigramas_nome)), produto_id))
+        
+        for _, produto_id in heapq.nlargest(limite - len(resultado), pontuados):
+            incluir(produto_id)
+        
+        return resultado
+
+indice_produtos = IndiceProdutos()
+
+class CacheIdentidadeProdutos:
+    """Cache LRU limitado de identificação de produtos: (tipo, código) -> id do produto"""
+    
+    def __init__(self, capacidade: int):
+        self.capacidade = capacidade
+        self.itens: OrderedDict = OrderedDict()
+        self.chaves_produto: Dict[str, set] = defaultdict(set)
+    
+    def __len__(self):
+        return len(self.itens)
+    
+    def obter(self, chave: tuple) -> Optional[str]:
+        produto_id = self.itens.get(chave)
+        if produto_id is not None:
+            self.itens.move_to_end(chave)
+        return produto_id
+    
+    def definir(self, chave: tuple, produto_id: str):
+        anterior = self.itens.pop(chave, None)
+        if anterior is not None:
+            self.chaves_produto[anterior].discard(chave)
+        
+        self.itens[chave] = produto_id
+        self.chaves_produto[produto_id].add(chave)
+        
+        while len(self.itens) > self.capacidade:
+            chave_antiga, id_antigo = self.itens.popitem(last=False)
+            chaves = self.chaves_produto.get(id_antigo)
+            if chaves is not None:
+                chaves.discard(chave_antiga)
+                if not chaves:
+                    del self.chaves_produto[id_antigo]
+    
+    def invalidar_produto(self, produto_id: str):
+        for chave in self.chaves_produto.pop(produto_id, ()):
+            self.itens.pop(chave, None)
+    
+    def limpar(self):
+        self.itens.clear()
+        self.chaves_produto.clear()
+
+cache_identidade = CacheIdentidadeProdutos(int(os.environ.get("CACHE_PRODUTOS_CAPACIDADE", "50000")))
+
+def ean_valido(ean: str) -> bool:
+    return bool(ean) and ean.strip().upper() != "SEM GTIN"
+
+async def resolver_ids_produtos(skus: List[str], eans: List[str] = ()):
+    """Resolve SKUs/EANs para ids de produto: cache primeiro, uma única consulta para as faltas"""
+    await sincronizar_cadastro_produtos()
+    ids_sku: Dict[str, str] = {}
+    ids_ean: Dict[str, str] = {}
+    faltando_sku = set()
+    faltando_ean = set()
+    
+    for sku in set(skus):
+        if not sku:
+            continue
+        produto_id = cache_identidade.obter(("sku", sku))
+        if produto_id:
+            ids_sku[sku] = produto_id
+        else:
+            faltando_sku.add(sku)
+    
+    for ean in set(eans):
+        if not ean_valido(ean):
+            continue
+        produto_id = cache_identidade.obter(("ean", ean))
+        if produto_id:
+            ids_ean[ean] = produto_id
+        else:
+            faltando_ean.add(ean)
+    
+    if faltando_sku or faltando_ean:
+        async for produto in db.produtos.find(
+            {"$or": [{"sku": {"$in": list(faltando_sku)}}, {"ean": {"$in": list(faltando_ean)}}]},
+            {"_id": 0, "id": 1, "sku": 1, "ean": 1}
+        ):
+            if produto.get("sku") in faltando_sku:
+                ids_sku[produto["sku"]] = produto["id"]
+                cache_identidade.definir(("sku", produto["sku"]), produto["id"])
+            if produto.get("ean") in faltando_ean:
+                ids_ean[produto["ean"]] = produto["id"]
+                cache_identidade.definir(("ean", produto["ean"]), produto["id"])
+    
+    return ids_sku, ids_ean
+
+async def resolver_codigos_fornecedor(fornecedor_cnpj: str, codigos: List[str]) -> Dict[str, str]:
+    """Resolve códigos do fornecedor (cProd) para ids de produto pela tabela de mapeamento"""
+    await sincronizar_cadastro_produtos()
+    ids_codigo: Dict[str, str] = {}
+    faltando = set()
+    
+    for codigo in set(codigos):
+        if not codigo:
+            continue
+        produto_id = cache_identidade.obter(("fornecedor", fornecedor_cnpj, codigo))
+        if produto_id:
+            ids_codigo[codigo] = produto_id
+        else:
+            faltando.add(codigo)
+    
+    if fornecedor_cnpj and faltando:
+        async for mapeamento in db.produtos_fornecedor.find(
+            {"fornecedor_cnpj": fornecedor_cnpj, "codigo_fornecedor": {"$in": list(faltando)}},
+            {"_id": 0, "codigo_fornecedor": 1, "produto_id": 1}
+        ):
+            ids_codigo[mapeamento["codigo_fornecedor"]] = mapeamento["produto_id"]
+            cache_identidade.definir(("fornecedor", fornecedor_cnpj, mapeamento["codigo_fornecedor"]), mapeamento["produto_id"])
+    
+    return ids_codigo
+
+async def aprender_codigos_fornecedor(fornecedor_cnpj: str, codigos_produtos: Dict[str, str]):
+    """Grava mapeamentos novos (cProd -> produto) confirmados em uma importação"""
+    if not fornecedor_cnpj or not codigos_produtos:
+        return
+    
+    agora = datetime.utcnow()
+    operacoes = [
+        UpdateOne(
+            {"fornecedor_cnpj": fornecedor_cnpj, "codigo_fornecedor": codigo},
+            {"$setOnInsert": {"id": str(uuid.uuid4()), "produto_id": produto_id, "created_at": agora, "updated_at": agora}},
+            upsert=True
+        )
+        for codigo, produto_id in codigos_produtos.items()
+    ]
+    await db.produtos_fornecedor.bulk_write(operacoes, ordered=False)
+
+# Versão do cadastro (SKU, EAN, nome, códigos de fornecedor), separada de "produtos", que muda a cada movimentação
+versao_cadastro_produtos = VersaoColecao("produtos_cadastro")
+_cadastro_produtos_versao = 0
+
+async def registrar_alteracao_cadastro_produtos(produto_ids):
+    """Publica os produtos com cadastro alterado para o índice e o cache das outras instâncias"""
+    global _cadastro_produtos_versao
+    documento = await db.versoes_colecoes.find_one_and_update(
+        {"_id": "produtos_cadastro"},
+        {"$inc": {"versao": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    await db.alteracoes_produtos.insert_one({
+        "versao": documento["versao"],
+        "produto_ids": list(produto_ids),
+        "created_at": datetime.utcnow()
+    })
+    # Esta instância já aplicou a alteração; só avança se nenhuma outra ficou no meio
+    if documento["versao"] == _cadastro_produtos_versao + 1:
+        _cadastro_produtos_versao = documento["versao"]
+
+async def sincronizar_cadastro_produtos():
+    """Aplica no índice de busca e no cache de identificação as alterações feitas por outras instâncias"""
+    global _cadastro_produtos_versao
+    versao = await versao_cadastro_produtos.atual()
+    if versao <= _cadastro_produtos_versao:
+        return
+    
+    anterior = _cadastro_produtos_versao
+    alteracoes = await db.alteracoes_produtos.find(
+        {"versao": {"$gt": anterior, "$lte": versao}}, {"_id": 0, "versao": 1, "produto_ids": 1}
+    ).sort("versao", 1).to_list(None)
+    if [alteracao["versao"] for alteracao in alteracoes] != list(range(anterior + 1, versao + 1)):
+        # Histórico incompleto (expirado ou gravação ainda em andamento): recarregar o catálogo
+        await carregar_indice_produtos()
+        return
+    
+    produto_ids = {produto_id for alteracao in alteracoes for produto_id in alteracao["produto_ids"]}
+    existentes = set()
+    async for produto in db.produtos.find({"id": {"$in": list(produto_ids)}}, {"_id": 0, "id": 1, "sku": 1, "ean": 1, "nome": 1}):
+        indice_produtos.adicionar(produto)
+        existentes.add(produto["id"])
+    for produto_id in produto_ids:
+        cache_identidade.invalidar_produto(produto_id)
+        if produto_id not in existentes:
+            indice_produtos.remover(produto_id)
+    _cadastro_produtos_versao = max(_cadastro_produtos_versao, versao)
+
+async def carregar_indice_produtos():
+    """Carrega o índice de busca com todo o catálogo e aquece o cache de identificação"""
+    global _cadastro_produtos_versao
+    indice_produtos.limpar()
+    cache_identidade.limpar()
+    # Versão lida antes do catálogo: alterações durante a carga são reaplicadas depois
+    versao_cadastro_produtos.expirar()
+    _cadastro_produtos_versao = await versao_cadastro_produtos.atual()
+    
+    async for produto in db.produtos.find({}, {"_id": 0, "id": 1, "sku": 1, "ean": 1, "nome": 1}):
+        indice_produtos.adicionar(produto, ordenar=False)
+        if len(cache_identidade) < cache_identidade.capacidade:
+            if produto.get("sku"):
+                cache_identidade.definir(("sku", produto["sku"]), produto["id"])
+            if ean_valido(produto.get("ean", "")):
+                cache_identidade.definir(("ean", produto["ean"]), produto["id"])
+    indice_produtos.ordenar()
+
+# ============= IMAGENS DE PRODUTOS =============
+
+# Arquivos endereçados pelo SHA-256 do conteúdo: imagens iguais são gravadas uma única vez
+IMAGENS_DIR = Path(os.environ.get("IMAGENS_DIR", str(ROOT_DIR / "imagens")))
+IMAGEM_TAMANHO_MAXIMO = int(os.environ.get("IMAGEM_TAMANHO_MAXIMO", str(5 * 1024 * 1024)))
+MINIATURA_TAMANHO = (256, 256)
+
+_hash_imagem_valido = re.compile(r"^[0-9a-f]{64}$")
+
+TIPOS_IMAGEM = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+def tipo_imagem(cabecalho: bytes) -> Optional[str]:
+    """Identifica o tipo da imagem pelos bytes iniciais"""
+    for assinatura, media_type in TIPOS_IMAGEM:
+        if cabecalho.startswith(assinatura):
+            return media_type
+    if cabecalho[:4] == b"RIFF" and cabecalho[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+def caminho_imagem(imagem_hash: str, miniatura: bool = False) -> Path:
+    """Caminho do arquivo (dois níveis de diretório para não concentrar milhares de arquivos)"""
+    nome = f"{imagem_hash}.thumb" if miniatura else imagem_hash
+    return IMAGENS_DIR / imagem_hash[:2] / nome
+
+def _gravar_arquivo(caminho: Path, conteudo: bytes):
+    """Grava em arquivo temporário e renomeia, para nunca servir arquivo pela metade"""
+    caminho.parent.mkdir(parents=True, exist_ok=True)
+    temporario = caminho.with_name(f"{caminho.name}.{uuid.uuid4().hex}.tmp")
+    temporario.write_bytes(conteudo)
+    os.replace(temporario, caminho)
+
+def _gerar_miniatura(imagem_hash: str) -> Path:
+    """Gera a miniatura uma única vez; sem Pillow, a imagem original é usada"""
+    original = caminho_imagem(imagem_hash)
+    miniatura = caminho_imagem(imagem_hash, miniatura=True)
+    if miniatura.exists() or Image is None:
+        return miniatura if miniatura.exists() else original
+    
+    with Image.open(original) as imagem:
+        imagem.thumbnail(MINIATURA_TAMANHO)
+        buffer = io.BytesIO()
+        if imagem.mode in ("RGBA", "LA", "P"):
+            imagem.save(buffer, format="PNG", optimize=True)
+        else:
+            imagem.convert("RGB").save(buffer, format="JPEG", quality=85, optimize=True)
+    
+    _gravar_arquivo(miniatura, buffer.getvalue())
+    return miniatura
+
+def _salvar_imagem(conteudo: bytes) -> str:
+    imagem_hash = hashlib.sha256(conteudo).hexdigest()
+    caminho = caminho_imagem(imagem_hash)
+    if not caminho.exists():
+        _gravar_arquivo(caminho, conteudo)
+        try:
+            _gerar_miniatura(imagem_hash)
+        except Exception as e:
+            logger.warning(f"Falha ao gerar miniatura de {imagem_hash}: {e}")
+    return imagem_hash
+
+async def salvar_imagem(conteudo: bytes) -> str:
+    """Valida e armazena a imagem, retornando o hash que a referencia"""
+    if len(conteudo) > IMAGEM_TAMANHO_MAXIMO:
+        raise HTTPException(status_code=413, detail="Imagem excede o tamanho máximo permitido")
+    if not tipo_imagem(conteudo[:16]):
+        raise HTTPException(status_code=400, detail="Formato de imagem não suportado (PNG, JPEG, GIF ou WEBP)")
+    
+    return await asyncio.to_thread(_salvar_imagem, conteudo)
+
+def referencia_imagem(imagem_hash: str) -> dict:
+    """Campos gravados no produto para uma imagem armazenada"""
+    return {"imagem_hash": imagem_hash, "imagem_url": f"/api/imagens/{imagem_hash}"}
+
+async def extrair_imagem_base64(produto_dict: dict):
+    """Substitui imagem_url em data URI (base64) pela referência ao arquivo armazenado"""
+    imagem_url = produto_dict.get("imagem_url") or ""
+    if not imagem_url.startswith("data:image"):
+        return
+    
+    try:
+        conteudo = base64.b64decode(imagem_url.split(",", 1)[1], validate=True)
+    except (IndexError, ValueError):
+        raise HTTPException(status_code=400, detail="Imagem em base64 inválida")
+    
+    produto_dict.update(referencia_imagem(await salvar_imagem(conteudo)))
+
+_url_imagem_armazenada = re.compile(r"^/api/imagens/([0-9a-f]{64})$")
+
+async def definir_imagem_produto(produto_dict: dict):
+    """Normaliza imagem_url e mantém imagem_hash coerente: base64 vai para o armazenamento,
+    URL do armazenamento aponta para o hash, qualquer outra URL (ou vazia) zera o hash"""
+    produto_dict["imagem_url"] = str(produto_dict.get("imagem_url") or "")
+    if produto_dict["imagem_url"].startswith("data:image"):
+        await extrair_imagem_base64(produto_dict)
+        return
+    armazenada = _url_imagem_armazenada.match(produto_dict["imagem_url"])
+    produto_dict["imagem_hash"] = armazenada.group(1) if armazenada else ""
+
+async def migrar_imagens_base64():
+    """Move para o armazenamento as imagens base64 ainda gravadas nos produtos"""
+    migrados = 0
+    async for produto in db.produtos.find({"imagem_url": {"$regex": "^data:image"}}, {"_id": 0, "id": 1, "imagem_url": 1}):
+        try:
+            await extrair_imagem_base64(produto)
+        except HTTPException as e:
+            logger.warning(f"Imagem do produto {produto['id']} não migrada: {e.detail}")
+            continue
+        await db.produtos.update_one(
+            {"id": produto["id"]},
+            {"$set": {"imagem_hash": produto["imagem_hash"], "imagem_url": produto["imagem_url"]}}
+        )
+        migrados += 1
+    
+    if migrados:
+        await registrar_alteracao("produtos")
+        logger.info(f"{migrados} imagens de produtos migradas para {IMAGENS_DIR}")
+
+# ============= FILA DE TAREFAS =============
+
+TAREFAS_WORKERS = int(os.environ.get("TAREFAS_WORKERS", "2"))
+# Processamentos de XML/venda não são idempotentes: repetir só se configurado
+TAREFAS_MAX_TENTATIVAS = int(os.environ.get("TAREFAS_MAX_TENTATIVAS", "1"))
+
+class FilaTarefas:
+    """Fila de tarefas em processo (asyncio) com registro persistente em db.tarefas"""
+    
+    def __init__(self):
+        self.handlers: Dict[str, Any] = {}
+        self.fila: Optional[asyncio.Queue] = None
+        self.workers: List[asyncio.Task] = []
+    
+    def tarefa(self, tipo: str):
+        """Registra a função que executa as tarefas do tipo informado"""
+        def registrar(func):
+            self.handlers[tipo] = func
+            return func
+        return registrar
+    
+    async def enfileirar(self, tipo: str, payload: dict, usuario: str = "sistema") -> dict:
+        agora = datetime.utcnow()
+        tarefa = {
+            "id": str(uuid.uuid4()),
+            "tipo": tipo,
+            "payload": payload,
+            "status": "PENDENTE",  # PENDENTE, PROCESSANDO, CONCLUIDO, ERRO
+            "tentativas": 0,
+            "max_tentativas": TAREFAS_MAX_TENTATIVAS,
+            "resultado": None,
+            "erro": "",
+            "usuario": usuario,
+            "created_at": agora,
+            "updated_at": agora
+        }
+        await db.tarefas.insert_one(tarefa)
+        tarefa.pop("_id", None)
+        self.fila.put_nowait(tarefa["id"])
+        return tarefa
+    
+    async def iniciar(self, quantidade_workers: int):
+        self.fila = asyncio.Queue()
+        
+        # Tarefas interrompidas no meio podem ter sido aplicadas parcialmente: não repetir
+        await db.tarefas.update_many(
+            {"status": "PROCESSANDO"},
+            {"$set": {"status": "ERRO", "erro": "Interrompida pela reinicialização do servidor", "updated_at": datetime.utcnow()}}
+        )
+        async for tarefa in db.tarefas.find({"status": "PENDENTE"}, {"_id": 0, "id": 1}).sort("created_at", 1):
+            self.fila.put_nowait(tarefa["id"])
+        
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(quantidade_workers)]
+    
+    async def parar(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+    
+    async def _worker(self):
+        while True:
+            tarefa_id = await self.fila.get()
+            try:
+                await self._executar(tarefa_id)
+            except Exception:
+                logger.exception("Erro inesperado na tarefa %s", tarefa_id)
+            finally:
+                self.fila.task_done()
+    
+    async def _atualizar(self, tarefa_id: str, dados: dict):
+        dados["updated_at"] = datetime.utcnow()
+        await db.tarefas.update_one({"id": tarefa_id}, {"$set": dados})
+    
+    async def _executar(self, tarefa_id: str):
+        # Reservar a tarefa (outra instância do servidor pode ter pego antes)
+        tarefa = await db.tarefas.find_one_and_update(
+            {"id": tarefa_id, "status": "PENDENTE"},
+            {"$set": {"status": "PROCESSANDO", "updated_at": datetime.utcnow()}, "$inc": {"tentativas": 1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not tarefa:
+            return
+        
+        try:
+            resultado = await self.handlers[tarefa["tipo"]](tarefa["payload"], tarefa["usuario"])
+        except HTTPException as e:
+            # Erro de validação: repetir não muda o resultado
+            await self._atualizar(tarefa_id, {"status": "ERRO", "erro": str(e.detail)})
+        except Exception as e:
+            if tarefa["tentativas"] < tarefa["max_tentativas"]:
+                await self._atualizar(tarefa_id, {"status": "PENDENTE", "erro": str(e)})
+                espera = 2 ** tarefa["tentativas"]
+                asyncio.get_running_loop().call_later(espera, self.fila.put_nowait, tarefa_id)
+            else:
+                logger.exception("Tarefa %s (%s) falhou", tarefa_id, tarefa["tipo"])
+                await self._atualizar(tarefa_id, {"status": "ERRO", "erro": str(e)})
+        else:
+            await self._atualizar(tarefa_id, {"status": "CONCLUIDO", "resultado": resultado, "erro": ""})
+
+fila_tarefas = FilaTarefas()
+
+# ============= ROTINAS PERIÓDICAS =============
+
+VENCIMENTO_INTERVALO_SEGUNDOS = int(os.environ.get("VENCIMENTO_INTERVALO_SEGUNDOS", "3600"))
+
+class Agendador:
+    """Executa rotinas em intervalos fixos dentro do processo do servidor"""
+    
+    def __init__(self):
+        self.rotinas: List[tuple] = []
+        self.tasks: List[asyncio.Task] = []
+    
+    def rotina(self, intervalo_segundos: int):
+        """Registra uma função assíncrona executada na inicialização e depois a cada intervalo"""
+        def registrar(func):
+            self.rotinas.append((func, intervalo_segundos))
+            return func
+        return registrar
+    
+    def iniciar(self):
+        self.tasks = [asyncio.create_task(self._executar(func, intervalo)) for func, intervalo in self.rotinas]
+    
+    async def parar(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+    
+    async def _executar(self, func, intervalo_segundos: int):
+        while True:
+            try:
+                await func()
+            except Exception:
+                logger.exception("Erro na rotina periódica %s", func.__name__)
+            await asyncio.sleep(intervalo_segundos)
+
+agendador = Agendador()
+
+# Totais de contas vencidas para o dashboard, com a versão (versoes_colecoes) de quando foram calculados
+_resumo_vencidos: Optional[dict] = None
+_resumo_vencidos_versao = 0
+
+async def get_resumo_vencidos() -> dict:
+    """Quantidade e valor das contas vencidas por tipo (consulta ao índice status/vencimento só quando algum título mudou)"""
+    global _resumo_vencidos, _resumo_vencidos_versao
+    documento = await db.versoes_colecoes.find_one({"_id": "contas_financeiras"})
+    versao = documento["versao"] if documento else 0
+    if _resumo_vencidos is None or versao != _resumo_vencidos_versao:
+        resumo = {tipo: {"quantidade": 0, "valor": 0.0} for tipo in ("PAGAR", "RECEBER")}
+        async for grupo in db.contas_financeiras.aggregate([
+            {"$match": {"status": "VENCIDO"}},
+            {"$group": {"_id": "$tipo", "quantidade": {"$sum": 1}, "valor": {"$sum": "$valor"}}}
+        ]):
+            resumo[grupo["_id"]] = {"quantidade": grupo["quantidade"], "valor": round(grupo["valor"], 2)}
+        _resumo_vencidos = resumo
+        _resumo_vencidos_versao = versao
+    return _resumo_vencidos
+
+@agendador.rotina(VENCIMENTO_INTERVALO_SEGUNDOS)
+async def marcar_contas_vencidas():
+    """Passa para VENCIDO as contas pendentes com vencimento anterior a hoje"""
+    hoje = datetime.combine(date.today(), datetime.min.time())
+    filtro = {"status": "PENDENTE", "data_vencimento": {"$lt": hoje}}
+    cnpjs = await db.contas_financeiras.distinct("cnpj", filtro)
+    resultado = await db.contas_financeiras.update_many(filtro, {"$set": {"status": "VENCIDO"}})
+    if resultado.modified_count:
+        await registrar_alteracao_financeiro(cnpjs)
+    # Deixar o resumo pronto para o dashboard
+    await get_resumo_vencidos()
+    if resultado.modified_count:
+        logger.info(f"{resultado.modified_count} contas marcadas como vencidas")
+
+# ============= REGRAS ICMS (DIFAL) =============
+
+# Regra antiga, usada quando nenhuma regra da tabela se aplica: produto marcado fora_estado paga 6%
+ALIQUOTA_FORA_ESTADO_PADRAO = 6.0
+
+class TabelaICMS:
+    """Regras de ICMS compiladas por par de UFs, das mais específicas para as mais genéricas"""
+    
+    def __init__(self, regras: List[dict] = None, versao: int = 0):
+        self.versao = versao
+        self.por_par: Dict[tuple, List[dict]] = defaultdict(list)
+        for regra in regras or []:
+            self.por_par[(regra["uf_origem"].upper(), regra["uf_destino"].upper())].append(regra)
+    
+    def regras_para(self, uf_origem: str, uf_destino: str) -> List[dict]:
+        uf_origem, uf_destino = uf_origem.upper(), uf_destino.upper()
+        regras = []
+        for par in ((uf_origem, uf_destino), (uf_origem, "*"), ("*", uf_destino), ("*", "*")):
+            regras.extend(self.por_par.get(par, []))
+        return sorted(
+            regras,
+            key=lambda r: (len(r["ncm_prefixo"]), bool(r["categoria"]), r["uf_origem"] != "*", r["uf_destino"] != "*"),
+            reverse=True
+        )
+    
+    def aliquotas(self, uf_origem: str, uf_destino: str, ncms: List[str], categorias: List[str], fora_estado: List[bool]) -> np.ndarray:
+        """Alíquota (%) de cada item da nota, calculada de uma vez para todos os itens"""
+        # Operação interna (mesma UF) não tem diferencial de alíquota
+        if uf_origem and uf_origem.upper() == uf_destino.upper():
+            return np.zeros(len(ncms))
+        
+        ncms = np.array([ncm or "" for ncm in ncms], dtype=str)
+        categorias = np.array([categoria or "" for categoria in categorias], dtype=str)
+        resultado = np.full(len(ncms), np.nan)
+        
+        if uf_origem and uf_destino:
+            for regra in self.regras_para(uf_origem, uf_destino):
+                pendentes = np.isnan(resultado)
+                if not pendentes.any():
+                    break
+                aplica = pendentes & np.char.startswith(ncms, regra["ncm_prefixo"])
+                if regra["categoria"]:
+                    aplica &= categorias == regra["categoria"]
+                resultado[aplica] = regra["aliquota"]
+        
+        # Sem regra: comportamento anterior (fora_estado)
+        sem_regra = np.isnan(resultado)
+        resultado[sem_regra] = np.where(np.array(fora_estado, dtype=bool)[sem_regra], ALIQUOTA_FORA_ESTADO_PADRAO, 0.0)
+        return resultado
+
+tabela_icms = TabelaICMS()
+
+async def carregar_regras_icms():
+    """Compila as regras ativas na tabela em memória"""
+    global tabela_icms
+    documento = await db.versoes_colecoes.find_one({"_id": "regras_icms"})
+    regras = await db.regras_icms.find({"ativo": True}, {"_id": 0}).to_list(None)
+    tabela_icms = TabelaICMS(regras, documento["versao"] if documento else 0)
+    return tabela_icms
+
+async def get_tabela_icms() -> TabelaICMS:
+    """Tabela compilada, recompilada se outra instância alterou as regras"""
+    documento = await db.versoes_colecoes.find_one({"_id": "regras_icms"})
+    if (documento["versao"] if documento else 0) != tabela_icms.versao:
+        await carregar_regras_icms()
+    return tabela_icms
+
+# ============= COMPRESSÃO DE RESPOSTAS =============
+
+COMPRESSAO_TAMANHO_MINIMO = int(os.environ.get("COMPRESSAO_TAMANHO_MINIMO", "1024"))
+COMPRESSAO_NIVEL_GZIP = int(os.environ.get("COMPRESSAO_NIVEL_GZIP", "6"))
+COMPRESSAO_NIVEL_BROTLI = int(os.environ.get("COMPRESSAO_NIVEL_BROTLI", "5"))
+
+TIPOS_COMPRESSIVEIS = ("application/json", "text/", "application/xml", "application/javascript")
+
+# Totais desde a inicialização do processo, por codificação
+metricas_compressao = defaultdict(Counter)
+
+class CompressaoMiddleware:
+    """Comprime (br ou gzip) respostas JSON/CSV/XML das rotas da API.
+    
+    Respostas pequenas passam intactas; respostas em streaming são comprimidas
+    pedaço a pedaço (com flush), sem acumular o corpo inteiro em memória.
+    """
+    
+    def __init__(self, app, prefixo: str = "/api", tamanho_minimo: int = COMPRESSAO_TAMANHO_MINIMO):
+        self.app = app
+        self.prefixo = prefixo
+        self.tamanho_minimo = tamanho_minimo
+    
+    def _negociar(self, scope) -> Optional[str]:
+        """Codificação com maior q aceita pelo cliente (br antes de gzip no empate); q=0 recusa"""
+        aceitas = {}
+        for nome, valor in scope["headers"]:
+            if nome == b"accept-encoding":
+                for parte in valor.decode("latin-1").lower().split(","):
+                    codificacao, _, parametros = parte.partition(";")
+                    q = 1.0
+                    for parametro in parametros.split(";"):
+                        chave, _, numero = parametro.strip().partition("=")
+                        if chave == "q":
+                            try:
+                                q = float(numero)
+                            except ValueError:
+                                q = 0.0
+                    aceitas[codificacao.strip()] = q
+        
+        suportadas = ("br", "gzip") if brotli is not None else ("gzip",)
+        pesos = {codificacao: aceitas.get(codificacao, aceitas.get("*", 0.0)) for codificacao in suportadas}
+        melhor = max(suportadas, key=lambda codificacao: pesos[codificacao])
+        return melhor if pesos[melhor] > 0 else None
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefixo):
+            await self.app(scope, receive, send)
+            return
+        
+        # Mesmo sem codificação aceita a resposta passa pelo wrapper, que acrescenta o Vary
+        codificacao = self._negociar(scope)
+        await _RespostaComprimida(codificacao, self.tamanho_minimo, send).executar(self.app, scope, receive)
+
+def _com_vary(headers) -> list:
+    """Headers com Vary: Accept-Encoding, sem duplicar se a rota já declarou"""
+    headers = list(headers)
+    if not any(nome.lower() == b"vary" and b"accept-encoding" in valor.lower() for nome, valor in headers):
+        headers.append((b"vary", b"Accept-Encoding"))
+    return headers
+
+class _RespostaComprimida:
+    """Estado de compressão de uma única resposta (codificacao None: só acrescenta o Vary)"""
+    
+    def __init__(self, codificacao: Optional[str], tamanho_minimo: int, send):
+        self.codificacao = codificacao
+        self.tamanho_minimo = tamanho_minimo
+        self.send = send
+        self.inicio = None
+        self.compressor = None
+        self.ignorar = False
+        self.bytes_originais = 0
+        self.bytes_comprimidos = 0
+    
+    async def executar(self, app, scope, receive):
+        await app(scope, receive, self.enviar)
+    
+    def _comprimir(self, dados: bytes, final: bool) -> bytes:
+        if self.codificacao == "br":
+            saida = self.compressor.process(dados)
+            return saida + (self.compressor.finish() if final else self.compressor.flush())
+        saida = self.compressor.compress(dados)
+        return saida + self.compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+    
+    def _compressivel(self, corpo: bytes, mais_corpo: bool) -> bool:
+        headers = {nome.lower(): valor for nome, valor in self.inicio["headers"]}
+        if b"content-encoding" in headers or self.inicio["status"] < 200 or self.inicio["status"] in (204, 304):
+            return False
+        tipo = headers.get(b"content-type", b"").decode("latin-1")
+        if not tipo.startswith(TIPOS_COMPRESSIVEIS):
+            return False
+        # Corpo único abaixo do limite não compensa; streaming é sempre comprimido
+        return mais_corpo or len(corpo) >= self.tamanho_minimo
+    
+    async def enviar(self, message):
+        if message["type"] == "http.response.start":
+            self.inicio = message
+            return
+        if message["type"] != "http.response.body" or self.ignorar:
+            await self.send(message)
+            return
+        
+        corpo = message.get("body", b"")
+        mais_corpo = message.get("more_body", False)
+        
+        if self.compressor is None:
+            if self.codificacao is None or not self._compressivel(corpo, mais_corpo):
+                self.ignorar = True
+                if self.codificacao is not None:
+                    metricas_compressao["ignorada"]["respostas"] += 1
+                # O corpo dependeria do Accept-Encoding: caches não podem servir esta versão a outro cliente
+                await self.send({**self.inicio, "headers": _com_vary(self.inicio["headers"])})
+                await self.send(message)
+                return
+            
+            if self.codificacao == "br":
+                self.compressor = brotli.Compressor(quality=COMPRESSAO_NIVEL_BROTLI)
+            else:
+                self.compressor = zlib.compressobj(COMPRESSAO_NIVEL_GZIP, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+            
+            headers = [(nome, valor) for nome, valor in self.inicio["headers"] if nome.lower() != b"content-length"]
+            headers.append((b"content-encoding", self.codificacao.encode()))
+            await self.send({**self.inicio, "headers": _com_vary(headers)})
+        
+        comprimido = self._comprimir(corpo, final=not mais_corpo)
+        self.bytes_originais += len(corpo)
+        self.bytes_comprimidos += len(comprimido)
+        await self.send({"type": "http.response.body", "body": comprimido, "more_body": mais_corpo})
+        
+        if not mais_corpo:
+            metricas = metricas_compressao[self.codificacao]
+            metricas["respostas"] += 1
+            metricas["bytes_originais"] += self.bytes_originais
+            metricas["bytes_comprimidos"] += self.bytes_comprimidos
+
+# ============= AUTH FUNCTIONS =============
+
+def create_access_token(data: dict):
+    to_encode = data.copy()
+    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    return encoded_jwt
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    try:
+        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        username: str = payload.get("sub")
+        if username is None:
+            raise HTTPException(status_code=401, detail="Invalid token")
+        return username
+    except jwt.PyJWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+# ============= AUTH ROUTES =============
+
+@api_router.post("/auth/login", response_model=LoginResponse)
+async def login(request: LoginRequest):
+    if request.username == "admin" and request.password == "admin123":
+        access_token = create_access_token(data={"sub": request.username})
+        return LoginResponse(
+            access_token=access_token,
+            user={"username": "admin", "role": "administrator"}
+        )
+    else:
+        raise HTTPException(status_code=401, detail="Credenciais inválidas")
+
+@api_router.get("/auth/me")
+async def get_me(current_user: str = Depends(get_current_user)):
+    return {"username": current_user, "role": "administrator"}
+
+# ============= EMPRESA ROUTES =============
+
+@api_router.post("/empresas", response_model=Empresa)
+async def create_empresa(empresa: EmpresaCreate, current_user: str = Depends(get_current_user)):
+    if await db.empresas.find_one({"cnpj": empresa.cnpj}):
+        raise HTTPException(status_code=400, detail="CNPJ já cadastrado")
+    
+    empresa_obj = Empresa(**empresa.dict())
+    await db.empresas.insert_one(empresa_obj.dict())
+    await registrar_alteracao("empresas")
+    invalidar_empresas_config()
+    return empresa_obj
+
+@api_router.get("/empresas", response_model=List[Empresa])
+async def get_empresas(fields: Optional[str] = None, current_user: str = Depends(get_current_user), etag: str = Depends(ETagColecao("empresas"))):
+    projecao = projecao_campos(fields, Empresa)
+    if projecao:
+        return resposta_linhas(await db.empresas.find({}, projecao).to_list(1000), etag)
+    
+    if JSON_RAPIDO:
+        empresas = await db.empresas.find({}, projecao_modelo(Empresa)).to_list(1000)
+        return resposta_linhas(empresas, etag)
+    
+    empresas = await db.empresas.find().to_list(1000)
+    return [Empresa(**empresa) for empresa in empresas]
+
+@api_router.get("/empresas/{empresa_id}", response_model=Empresa)
+async def get_empresa(empresa_id: str, current_user: str = Depends(get_current_user)):
+    empresa = await db.empresas.find_one({"id": empresa_id})
+    if empresa:
+        return Empresa(**empresa)
+    raise HTTPException(status_code=404, detail="Empresa não encontrada")
+
+@api_router.put("/empresas/{empresa_id}", response_model=Empresa)
+async def update_empresa(empresa_id: str, empresa: EmpresaCreate, current_user: str = Depends(get_current_user)):
+    if await db.empresas.find_one({"cnpj": empresa.cnpj, "id": {"$ne": empresa_id}}):
+        raise HTTPException(status_code=400, detail="CNPJ já cadastrado")
+    
+    update_data = empresa.dict()
+    update_data["updated_at"] = datetime.utcnow()
+    
+    await db.empresas.update_one({"id": empresa_id}, {"$set": update_data})
+    await registrar_alteracao("empresas")
+    invalidar_empresas_config()
+    updated_empresa = await db.empresas.find_one({"id": empresa_id})
+    if updated_empresa:
+        return Empresa(**updated_empresa)
+    raise HTTPException(status_code=404, detail="Empresa não encontrada")
+
+@api_router.delete("/empresas/{empresa_id}")
+async def delete_empresa(empresa_id: str, current_user: str = Depends(get_current_user)):
+    result = await db.empresas.delete_one({"id": empresa_id})
+    if result.deleted_count:
+        invalidar_empresas_config()
+        await registrar_alteracao("empresas")
+        return {"message": "Empresa deletada com sucesso"}
+    raise HTTPException(status_code=404, detail="Empresa não encontrada")
+
+# ============= CLIENTE ROUTES =============
+
+@api_router.post("/clientes", response_model=Cliente)
+async def create_cliente(cliente: ClienteCreate, current_user: str = Depends(get_current_user)):
+    cliente_dict = cliente.dict()
+    cliente_obj = Cliente(**cliente_dict)
+    await db.clientes.insert_one(cliente_obj.dict())
+    return cliente_obj
+
+@api_router.get("/clientes", response_model=List[Cliente])
+async def get_clientes(fields: Optional[str] = None, current_user: str = Depends(get_current_user)):
+    projecao = projecao_campos(fields, Cliente)
+    if projecao:
+        return resposta_linhas(await db.clientes.find({}, projecao).to_list(1000))
+    
+    if JSON_RAPIDO:
+        clientes = await db.clientes.find({}, projecao_modelo(Cliente)).to_list(1000)
+        return RespostaJSONRapida(clientes)
+    
+    clientes = await db.clientes.find().to_list(1000)
+    return [Cliente(**cliente) for cliente in clientes]
+
+@api_router.get("/clientes/{cliente_id}", response_model=Cliente)
+async def get_cliente(cliente_id: str, current_user: str = Depends(get_current_user)):
+    cliente = await db.clientes.find_one({"id": cliente_id})
+    if cliente:
+        return Cliente(**cliente)
+    raise HTTPException(status_code=404, detail="Cliente não encontrado")
+
+@api_router.put("/clientes/{cliente_id}", response_model=Cliente)
+async def update_cliente(cliente_id: str, cliente: ClienteCreate, current_user: str = Depends(get_current_user)):
+    update_data = cliente.dict()
+    update_data["updated_at"] = datetime.utcnow()
+    
+    await db.clientes.update_one({"id": cliente_id}, {"$set": update_data})
+    updated_cliente = await db.clientes.find_one({"id": cliente_id})
+    if updated_cliente:
+        return Cliente(**updated_cliente)
+    raise HTTPException(status_code=404, detail="Cliente não encontrado")
+
+@api_router.delete("/clientes/{cliente_id}")
+async def delete_cliente(cliente_id: str, current_user: str = Depends(get_current_user)):
+    result = await db.clientes.delete_one({"id": cliente_id})
+    if result.deleted_count:
+        return {"message": "Cliente deletado com sucesso"}
+    raise HTTPException(status_code=404, detail="Cliente não encontrado")
+
+# ============= FORNECEDOR ROUTES =============
+
+@api_router.post("/fornecedores", response_model=Fornecedor)
+async def create_fornecedor(fornecedor: FornecedorCreate, current_user: str = Depends(get_current_user)):
+    fornecedor_dict = fornecedor.dict()
+    fornecedor_obj = Fornecedor(**fornecedor_dict)
     await db.fornecedores.insert_one(fornecedor_obj.dict())
+    await registrar_alteracao("fornecedores")
     return fornecedor_obj
 
 @api_router.get("/fornecedores", response_model=List[Fornecedor])
-async def get_fornecedores(current_user: str = Depends(get_current_user)):
+async def get_fornecedores(fields: Optional[str] = None, current_user: str = Depends(get_current_user), etag: str = Depends(ETagColecao("fornecedores"))):
+    projecao = projecao_campos(fields, Fornecedor)
+    if projecao:
+        return resposta_linhas(await db.fornecedores.find({}, projecao).to_list(1000), etag)
+    
+    if JSON_RAPIDO:
+        fornecedores = await db.fornecedores.find({}, projecao_modelo(Fornecedor)).to_list(1000)
+        return resposta_linhas(fornecedores, etag)
+    
     fornecedores = await db.fornecedores.find().to_list(1000)
     return [Fornecedor(**fornecedor) for fornecedor in fornecedores]
 
+@api_router.post("/fornecedores/mapeamentos", response_model=MapeamentoFornecedor)
+async def create_mapeamento_fornecedor(mapeamento: MapeamentoFornecedorCreate, current_user: str = Depends(get_current_user)):
+    """Vincula o código do produto no fornecedor (cProd) a um produto cadastrado"""
+    if not await db.produtos.find_one({"id": mapeamento.produto_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Produto não encontrado")
+    
+    mapeamento_obj = MapeamentoFornecedor(**mapeamento.dict())
+    dados = mapeamento_obj.dict()
+    dados_insercao = {"id": dados.pop("id"), "created_at": dados.pop("created_at")}
+    anterior = await db.produtos_fornecedor.find_one_and_update(
+        {"fornecedor_cnpj": mapeamento.fornecedor_cnpj, "codigo_fornecedor": mapeamento.codigo_fornecedor},
+        {"$set": dados, "$setOnInsert": dados_insercao},
+        projection={"_id": 0, "produto_id": 1},
+        upsert=True
+    )
+    cache_identidade.definir(("fornecedor", mapeamento.fornecedor_cnpj, mapeamento.codigo_fornecedor), mapeamento.produto_id)
+    # O código pode ter saído de outro produto: as outras instâncias descartam o vínculo dos dois
+    await registrar_alteracao_cadastro_produtos({mapeamento.produto_id, *([anterior["produto_id"]] if anterior else [])})
+    
+    salvo = await db.produtos_fornecedor.find_one(
+        {"fornecedor_cnpj": mapeamento.fornecedor_cnpj, "codigo_fornecedor": mapeamento.codigo_fornecedor}
+    )
+    return MapeamentoFornecedor(**salvo)
+
+@api_router.get("/fornecedores/mapeamentos", response_model=List[MapeamentoFornecedor])
+async def get_mapeamentos_fornecedor(fornecedor_cnpj: str = None, produto_id: str = None, current_user: str = Depends(get_current_user)):
+    filter_query = {}
+    if fornecedor_cnpj:
+        filter_query["fornecedor_cnpj"] = fornecedor_cnpj
+    if produto_id:
+        filter_query["produto_id"] = produto_id
+    
+    mapeamentos = await db.produtos_fornecedor.find(filter_query).to_list(1000)
+    return [MapeamentoFornecedor(**mapeamento) for mapeamento in mapeamentos]
+
+@api_router.delete("/fornecedores/mapeamentos/{mapeamento_id}")
+async def delete_mapeamento_fornecedor(mapeamento_id: str, current_user: str = Depends(get_current_user)):
+    mapeamento = await db.produtos_fornecedor.find_one_and_delete({"id": mapeamento_id})
+    if mapeamento:
+        cache_identidade.invalidar_produto(mapeamento["produto_id"])
+        await registrar_alteracao_cadastro_produtos([mapeamento["produto_id"]])
+        return {"message": "Mapeamento deletado com sucesso"}
+    raise HTTPException(status_code=404, detail="Mapeamento não encontrado")
+
 @api_router.get("/fornecedores/{fornecedor_id}", response_model=Fornecedor)
 async def get_fornecedor(fornecedor_id: str, current_user: str = Depends(get_current_user)):
     fornecedor = await db.fornecedores.find_one({"id": fornecedor_id})
@@ -430,6 +2308,7 @@ async def update_fornecedor(fornecedor_id: str, fornecedor: FornecedorCreate, cu
     update_data["updated_at"] = datetime.utcnow()
     
     await db.fornecedores.update_one({"id": fornecedor_id}, {"$set": update_data})
+    await registrar_alteracao("fornecedores")
     updated_fornecedor = await db.fornecedores.find_one({"id": fornecedor_id})
     if updated_fornecedor:
         return Fornecedor(**updated_fornecedor)
@@ -439,6 +2318,7 @@ async def update_fornecedor(fornecedor_id: str, fornecedor: FornecedorCreate, cu
 async def delete_fornecedor(fornecedor_id: str, current_user: str = Depends(get_current_user)):
     result = await db.fornecedores.delete_one({"id": fornecedor_id})
     if result.deleted_count:
+        await registrar_alteracao("fornecedores")
         return {"message": "Fornecedor deletado com sucesso"}
     raise HTTPException(status_code=404, detail="Fornecedor não encontrado")
 
@@ -449,8 +2329,9 @@ async def create_produto(produto: ProdutoCreate, current_user: str = Depends(get
     produto_dict = produto.dict()
     
     # Inicializar estoques por CNPJ
+    empresas = await get_empresas_config()
     estoques_cnpj = []
-    for cnpj in CNPJS_CONFIG.keys():
+    for cnpj in empresas.keys():
         estoques_cnpj.append({
             "cnpj": cnpj,
             "quantidade": 0,
@@ -466,15 +2347,84 @@ async def create_produto(produto: ProdutoCreate, current_user: str = Depends(get
     if produto_dict["valor_compra"] > 0:
         produto_dict["margem_percentual"] = round(((produto_dict["preco_venda"] - produto_dict["valor_compra"]) / produto_dict["valor_compra"]) * 100, 2)
     
+    await definir_imagem_produto(produto_dict)
+    
     produto_obj = Produto(**produto_dict)
     await db.produtos.insert_one(produto_obj.dict())
+    await registrar_alteracao("produtos")
+    indice_produtos.adicionar(produto_obj.dict())
+    await registrar_alteracao_cadastro_produtos([produto_obj.id])
     return produto_obj
 
 @api_router.get("/produtos")
-async def get_produtos(current_user: str = Depends(get_current_user)):
-    produtos = await db.produtos.find().to_list(1000)
+async def get_produtos(fields: Optional[str] = None, current_user: str = Depends(get_current_user), etag: str = Depends(ETagColecao("produtos"))):
+    """Lista produtos; fields=sku,nome,preco_venda retorna apenas as colunas pedidas"""
+    projecao = projecao_campos(fields, Produto) or {"_id": 0}
+    produtos = await db.produtos.find({}, projecao).to_list(1000)
     return produtos
 
+@api_router.get("/produtos/busca")
+async def buscar_produtos(q: str, limite: int = 20, current_user: str = Depends(get_current_user)):
+    """Busca produtos por SKU/EAN exato, prefixo de SKU, nome aproximado ou descrição"""
+    limite = max(1, min(limite, 100))
+    await sincronizar_cadastro_produtos()
+    ids = indice_produtos.buscar(q, limite)
+    
+    projecao = {"_id": 0, "descricao": 0, "estoques_cnpj": 0}
+    produtos = await db.produtos.find({"id": {"$in": ids}}, projecao).to_list(None)
+    por_id = {p["id"]: p for p in produtos}
+    resultado = [por_id[produto_id] for produto_id in ids if produto_id in por_id]
+    
+    # Completar com o índice textual do MongoDB (palavras da descrição), exceto em código exato
+    if len(resultado) < limite and not indice_produtos.buscar_exato(q):
+        complemento = await db.produtos.find(
+            {"$text": {"$search": q}, "id": {"$nin": ids}},
+            {**projecao, "score": {"$meta": "textScore"}}
+        ).sort([("score", {"$meta": "textScore"})]).limit(limite - len(resultado)).to_list(None)
+        for produto in complemento:
+            produto.pop("score", None)
+            resultado.append(produto)
+    
+    return {"produtos": resultado, "total": len(resultado)}
+
+@api_router.post("/produtos/importar")
+async def importar_catalogo(file: UploadFile = File(...), current_user: str = Depends(get_current_user)):
+    """Importa/atualiza produtos em massa a partir de CSV, NDJSON ou XLSX"""
+    if not file.filename.lower().endswith((".csv", ".ndjson", ".jsonl", ".xlsx")):
+        raise HTTPException(status_code=400, detail="Arquivo deve ser CSV, NDJSON ou XLSX")
+    
+    content = await file.read()
+    importacao = {
+        "id": str(uuid.uuid4()),
+        "arquivo_nome": file.filename,
+        "status": "PROCESSANDO",
+        "total_linhas": 0,
+        "total_validas": 0,
+        "processadas": 0,
+        "inseridos": 0,
+        "atualizados": 0,
+        "total_erros": 0,
+        "erros": [],
+        "usuario": current_user,
+        "created_at": datetime.utcnow(),
+        "updated_at": datetime.utcnow()
+    }
+    await db.importacoes_produtos.insert_one(importacao)
+    
+    tarefa = asyncio.create_task(processar_importacao_catalogo(importacao["id"], content, file.filename))
+    _tarefas_background.add(tarefa)
+    tarefa.add_done_callback(_tarefas_background.discard)
+    
+    return {"message": "Importação iniciada", "importacao_id": importacao["id"], "status": importacao["status"]}
+
+@api_router.get("/produtos/importar/{importacao_id}")
+async def get_importacao_catalogo(importacao_id: str, current_user: str = Depends(get_current_user)):
+    """Consulta o progresso de uma importação de catálogo"""
+    importacao = await db.importacoes_produtos.find_one({"id": importacao_id}, {"_id": 0})
+    if importacao:
+        return importacao
+    raise HTTPException(status_code=404, detail="Importação não encontrada")
+
 @api_router.get("/produtos/{produto_id}", response_model=Produto)
 async def get_produto(produto_id: str, current_user: str = Depends(get_current_user)):
     produto = await db.produtos.find_one({"id": produto_id})
@@ -486,21 +2436,75 @@ async def get_produto(produto_id: str, current_user: str = Depends(get_current_u
 async def update_produto(produto_id: str, produto_data: dict, current_user: str = Depends(get_current_user)):
     produto_data["updated_at"] = datetime.utcnow()
     
+    # Imagem enviada em base64 vai para o armazenamento; no produto fica só a referência
+    if "imagem_url" in produto_data:
+        await definir_imagem_produto(produto_data)
+    
     # Recalcular margem se necessário
     if "valor_compra" in produto_data and "preco_venda" in produto_data:
         if produto_data["valor_compra"] > 0:
             produto_data["margem_percentual"] = round(((produto_data["preco_venda"] - produto_data["valor_compra"]) / produto_data["valor_compra"]) * 100, 2)
     
     await db.produtos.update_one({"id": produto_id}, {"$set": produto_data})
+    await registrar_alteracao("produtos")
     updated_produto = await db.produtos.find_one({"id": produto_id})
     if updated_produto:
+        # Mínimos/máximos podem ter mudado: refazer alertas do produto
+        await db.alertas_estoque.delete_many({"produto_id": produto_id})
+        await sincronizar_alertas_estoque([updated_produto])
+        indice_produtos.adicionar(updated_produto)
+        cache_identidade.invalidar_produto(produto_id)
+        await registrar_alteracao_cadastro_produtos([produto_id])
         return Produto(**updated_produto)
     raise HTTPException(status_code=404, detail="Produto não encontrado")
 
+@api_router.post("/produtos/{produto_id}/imagem", response_model=Produto)
+async def upload_imagem_produto(produto_id: str, file: UploadFile = File(...), current_user: str = Depends(get_current_user)):
+    """Armazena a imagem do produto e grava apenas a referência no cadastro"""
+    conteudo = await file.read()
+    imagem_hash = await salvar_imagem(conteudo)
+    
+    produto = await db.produtos.find_one_and_update(
+        {"id": produto_id},
+        {"$set": {**referencia_imagem(imagem_hash), "updated_at": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not produto:
+        raise HTTPException(status_code=404, detail="Produto não encontrado")
+    await registrar_alteracao("produtos")
+    return Produto(**produto)
+
+@api_router.get("/imagens/{imagem_hash}")
+async def get_imagem(imagem_hash: str, request: Request, thumb: bool = False):
+    """Serve a imagem (ou miniatura); o conteúdo nunca muda para o mesmo hash"""
+    if not _hash_imagem_valido.match(imagem_hash):
+        raise HTTPException(status_code=404, detail="Imagem não encontrada")
+    
+    etag = f'"{imagem_hash}{"-thumb" if thumb else ""}"'
+    headers = {"Cache-Control": "public, max-age=31536000, immutable", "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    caminho = caminho_imagem(imagem_hash)
+    if not caminho.exists():
+        raise HTTPException(status_code=404, detail="Imagem não encontrada")
+    if thumb:
+        caminho = await asyncio.to_thread(_gerar_miniatura, imagem_hash)
+    
+    with open(caminho, "rb") as arquivo:
+        media_type = tipo_imagem(arquivo.read(16)) or "application/octet-stream"
+    return FileResponse(caminho, media_type=media_type, headers=headers)
+
 @api_router.delete("/produtos/{produto_id}")
 async def delete_produto(produto_id: str, current_user: str = Depends(get_current_user)):
     result = await db.produtos.delete_one({"id": produto_id})
     if result.deleted_count:
+        await registrar_alteracao("produtos")
+        await db.alertas_estoque.delete_many({"produto_id": produto_id})
+        indice_produtos.remover(produto_id)
+        cache_identidade.invalidar_produto(produto_id)
+        await db.produtos_fornecedor.delete_many({"produto_id": produto_id})
+        await registrar_alteracao_cadastro_produtos([produto_id])
         return {"message": "Produto deletado com sucesso"}
     raise HTTPException(status_code=404, detail="Produto não encontrado")
 
@@ -531,6 +2535,8 @@ async def get_movimentacoes_produto(produto_id: str, cnpj: str = None, current_u
 @api_router.post("/estoque/ajuste")
 async def ajustar_estoque(produto_id: str, cnpj: str, quantidade: int, motivo: str, current_user: str = Depends(get_current_user)):
     """Ajusta estoque manualmente"""
+    await validar_cnpj_empresa(cnpj)
+    
     produto = await db.produtos.find_one({"id": produto_id})
     if not produto:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
@@ -545,6 +2551,331 @@ async def ajustar_estoque(produto_id: str, cnpj: str, quantidade: int, motivo: s
     
     return {"message": "Estoque ajustado com sucesso"}
 
+@api_router.post("/estoque/transferencia")
+async def transferir_estoque(transferencia: TransferenciaEstoque, current_user: str = Depends(get_current_user)):
+    """Transfere estoque de vários produtos entre dois CNPJs em um único lote"""
+    origem = transferencia.cnpj_origem
+    destino = transferencia.cnpj_destino
+    if origem == destino:
+        raise HTTPException(status_code=400, detail="CNPJ de origem e destino devem ser diferentes")
+    await validar_cnpj_empresa(origem)
+    await validar_cnpj_empresa(destino)
+    
+    # Consolidar linhas repetidas do mesmo SKU
+    quantidades = defaultdict(int)
+    for item in transferencia.itens:
+        if item.quantidade <= 0:
+            raise HTTPException(status_code=400, detail=f"Quantidade inválida para o SKU {item.sku}")
+        quantidades[item.sku] += item.quantidade
+    
+    if not quantidades:
+        raise HTTPException(status_code=400, detail="Nenhum item informado")
+    
+    produtos = await db.produtos.find(
+        {"sku": {"$in": list(quantidades)}},
+        {"_id": 0, "id": 1, "sku": 1, "nome": 1, "custo_medio": 1, "estoques_cnpj": 1}
+    ).to_list(None)
+    produtos_por_sku = {p["sku"]: p for p in produtos}
+    
+    # Validar todo o lote antes de qualquer escrita
+    nao_encontrados = [sku for sku in quantidades if sku not in produtos_por_sku]
+    estoque_insuficiente = []
+    for sku, quantidade in quantidades.items():
+        produto = produtos_por_sku.get(sku)
+        if produto:
+            disponivel = next((e["quantidade"] for e in produto.get("estoques_cnpj", []) if e["cnpj"] == origem), 0)
+            if disponivel < quantidade:
+                estoque_insuficiente.append({"sku": sku, "disponivel": disponivel, "solicitado": quantidade})
+    
+    if nao_encontrados or estoque_insuficiente:
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "message": "Transferência não realizada",
+                "nao_encontrados": nao_encontrados,
+                "estoque_insuficiente": estoque_insuficiente
+            }
+        )
+    
+    agora = datetime.utcnow()
+    documento = transferencia.documento or f"TRF-{uuid.uuid4().hex[:8].upper()}"
+    descricao = f"Transferência {origem} -> {destino}"
+    if transferencia.motivo:
+        descricao += f": {transferencia.motivo}"
+    
+    # Marca gravada nos produtos movidos: identifica quais SKUs saíram da origem se não houver transação.
+    # Lista curta (últimas marcas) em vez de um campo único, para transferências concorrentes não se sobrescreverem
+    transferencia_id = str(uuid.uuid4())
+    criacoes = []
+    transferencias = {}
+    for sku, quantidade in quantidades.items():
+        produto = produtos_por_sku[sku]
+        
+        # Criar posição de estoque no destino se ainda não existir
+        if not any(e["cnpj"] == destino for e in produto.get("estoques_cnpj", [])):
+            criacoes.append(UpdateOne(
+                {"id": produto["id"], "estoques_cnpj.cnpj": {"$ne": destino}},
+                {"$push": {"estoques_cnpj": {"cnpj": destino, "quantidade": 0, "estoque_minimo": 0, "estoque_maximo": 0}}}
+            ))
+        
+        # Saída e entrada no mesmo documento: as duas pontas são aplicadas juntas
+        operacao = UpdateOne(
+            {"id": produto["id"], "estoques_cnpj": {"$elemMatch": {"cnpj": origem, "quantidade": {"$gte": quantidade}}}},
+            {
+                "$inc": {
+                    "estoques_cnpj.$[origem].quantidade": -quantidade,
+                    "estoques_cnpj.$[destino].quantidade": quantidade
+                },
+                "$set": {"updated_at": agora},
+                "$push": {"transferencias_recentes": {"$each": [transferencia_id], "$slice": -20}}
+            },
+            array_filters=[{"origem.cnpj": origem}, {"destino.cnpj": destino}]
+        )
+        
+        # Movimentações pareadas valorizadas pelo mesmo custo médio
+        custo_medio = produto.get("custo_medio", 0.0)
+        movimentacoes = []
+        for cnpj, entrada, saida in ((origem, 0, quantidade), (destino, quantidade, 0)):
+            movimentacoes.append(MovimentacaoEstoque(
+                produto_id=produto["id"],
+                cnpj=cnpj,
+                tipo="TRANSFERENCIA",
+                documento=documento,
+                descricao=descricao,
+                quantidade_entrada=entrada,
+                quantidade_saida=saida,
+                valor_unitario=custo_medio,
+                valor_total=quantidade * custo_medio,
+                usuario=current_user,
+                data=agora
+            ).dict())
+        transferencias[sku] = (operacao, movimentacoes)
+    
+    nao_transferidos = []
+    
+    async def aplicar(session):
+        nao_transferidos.clear()
+        # A criação da posição de destino é idempotente ($ne), então não entra na conferência
+        if criacoes:
+            await db.produtos.bulk_write(criacoes, ordered=True, session=session)
+        
+        resultado = await db.produtos.bulk_write(
+            [operacao for operacao, _ in transferencias.values()], ordered=False, session=session
+        )
+        if resultado.matched_count != len(transferencias):
+            if session is not None:
+                # Com transação, nada foi gravado: a transferência inteira pode ser repetida
+                raise HTTPException(status_code=409, detail="Estoque alterado durante a transferência, tente novamente")
+            
+            # Sem transação as saídas já estão gravadas: movimentações só dos SKUs que esta transferência moveu
+            movidos = {
+                produto["sku"]
+                async for produto in db.produtos.find(
+                    {"sku": {"$in": list(transferencias)}, "transferencias_recentes": transferencia_id},
+                    {"_id": 0, "sku": 1}
+                )
+            }
+            nao_transferidos.extend(sku for sku in transferencias if sku not in movidos)
+        
+        falhas = set(nao_transferidos)
+        movimentacoes = [mov for sku, (_, movs) in transferencias.items() if sku not in falhas for mov in movs]
+        if movimentacoes:
+            await db.movimentacoes_estoque.insert_many(movimentacoes, session=session)
+    
+    await executar_transacao(aplicar)
+    if len(nao_transferidos) == len(transferencias):
+        raise HTTPException(status_code=409, detail="Estoque alterado durante a transferência, tente novamente")
+    await registrar_alteracao("produtos")
+    
+    atualizados = await db.produtos.find(
+        {"id": {"$in": [p["id"] for p in produtos]}},
+        {"_id": 0, "id": 1, "sku": 1, "nome": 1, "estoques_cnpj": 1}
+    ).to_list(None)
+    await sincronizar_alertas_estoque(atualizados, {origem, destino})
+    
+    transferidos = [sku for sku in quantidades if sku not in nao_transferidos]
+    return {
+        "message": "Transferência realizada com sucesso" if not nao_transferidos else "Transferência realizada parcialmente",
+        "documento": documento,
+        "itens": len(transferidos),
+        "quantidade_total": sum(quantidades[sku] for sku in transferidos),
+        "nao_transferidos": nao_transferidos
+    }
+
+@api_router.post("/estoque/inventario")
+async def importar_inventario(file: UploadFile = File(...), cnpj: str = Form(...), motivo: str = Form("Inventário"), aplicar: bool = Form(True), current_user: str = Depends(get_current_user)):
+    """Importa contagem física (CSV/NDJSON com sku e quantidade) e ajusta o estoque do CNPJ"""
+    await validar_cnpj_empresa(cnpj)
+    
+    content = await file.read()
+    try:
+        linhas = ler_linhas_importacao(content, file.filename)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Arquivo de inventário inválido")
+    
+    # Somar contagens do mesmo SKU (ex.: contado em mais de um local)
+    contagem = defaultdict(int)
+    linhas_invalidas = []
+    # Numeração igual à do extrato: a linha 1 do arquivo é o cabeçalho
+    for numero, linha in enumerate(linhas, start=2):
+        sku = str(linha.get("sku") or "").strip()
+        try:
+            valor = float(str(linha.get("quantidade", "")).replace(",", "."))
+            # Contagem física é inteira: "2,7" é erro de digitação, não 2 unidades
+            quantidade = int(valor) if valor.is_integer() else -1
+        except (ValueError, OverflowError):
+            quantidade = -1
+        
+        if not sku or quantidade < 0:
+            linhas_invalidas.append({"linha": numero, "dados": linha})
+            continue
+        contagem[sku] += quantidade
+    
+    produtos = await db.produtos.find(
+        {"sku": {"$in": list(contagem)}},
+        {"_id": 0, "id": 1, "sku": 1, "nome": 1, "custo_medio": 1, "estoques_cnpj": 1}
+    ).to_list(None)
+    produtos_por_sku = {p["sku"]: p for p in produtos}
+    nao_encontrados = [sku for sku in contagem if sku not in produtos_por_sku]
+    
+    # Comparar contagem com o estoque atual do CNPJ em uma única passada
+    divergencias = []
+    for sku, quantidade_contada in contagem.items():
+        produto = produtos_por_sku.get(sku)
+        if not produto:
+            continue
+        
+        quantidade_sistema = next((e["quantidade"] for e in produto.get("estoques_cnpj", []) if e["cnpj"] == cnpj), 0)
+        diferenca = quantidade_contada - quantidade_sistema
+        if diferenca != 0:
+            custo_medio = produto.get("custo_medio", 0.0)
+            divergencias.append({
+                "produto_id": produto["id"],
+                "sku": sku,
+                "nome": produto["nome"],
+                "quantidade_sistema": quantidade_sistema,
+                "quantidade_contada": quantidade_contada,
+                "diferenca": diferenca,
+                "custo_medio": custo_medio,
+                "valor_diferenca": round(diferenca * custo_medio, 2)
+            })
+    
+    if aplicar and divergencias:
+        agora = datetime.utcnow()
+        documento = f"INV-{uuid.uuid4().hex[:8].upper()}"
+        operacoes = []
+        movimentacoes = []
+        
+        for divergencia in divergencias:
+            produto = produtos_por_sku[divergencia["sku"]]
+            
+            if not any(e["cnpj"] == cnpj for e in produto.get("estoques_cnpj", [])):
+                operacoes.append(UpdateOne(
+                    {"id": produto["id"], "estoques_cnpj.cnpj": {"$ne": cnpj}},
+                    {"$push": {"estoques_cnpj": {"cnpj": cnpj, "quantidade": 0, "estoque_minimo": 0, "estoque_maximo": 0}}}
+                ))
+            
+            # Fixar a quantidade contada e recalcular o total no próprio servidor
+            operacoes.append(UpdateOne({"id": produto["id"]}, [
+                {"$set": {"estoques_cnpj": {"$map": {
+                    "input": "$estoques_cnpj",
+                    "in": {"$cond": [
+                        {"$eq": ["$$this.cnpj", cnpj]},
+                        {"$mergeObjects": ["$$this", {"quantidade": divergencia["quantidade_contada"]}]},
+                        "$$this"
+                    ]}
+                }}}},
+                {"$set": {"estoque_total": {"$sum": "$estoques_cnpj.quantidade"}, "updated_at": agora}}
+            ]))
+            
+            diferenca = divergencia["diferenca"]
+            movimentacoes.append(MovimentacaoEstoque(
+                produto_id=produto["id"],
+                cnpj=cnpj,
+                tipo="AJUSTE",
+                documento=documento,
+                descricao=f"Inventário: {motivo}",
+                quantidade_entrada=max(diferenca, 0),
+                quantidade_saida=max(-diferenca, 0),
+                valor_unitario=divergencia["custo_medio"],
+                valor_total=abs(diferenca) * divergencia["custo_medio"],
+                usuario=current_user,
+                data=agora
+            ).dict())
+        
+        async def aplicar_ajustes(session):
+            await db.produtos.bulk_write(operacoes, ordered=True, session=session)
+            await db.movimentacoes_estoque.insert_many(movimentacoes, session=session)
+        
+        await executar_transacao(aplicar_ajustes)
+        await registrar_alteracao("produtos")
+        
+        atualizados = await db.produtos.find(
+            {"id": {"$in": [d["produto_id"] for d in divergencias]}},
+            {"_id": 0, "id": 1, "sku": 1, "nome": 1, "estoques_cnpj": 1}
+        ).to_list(None)
+        await sincronizar_alertas_estoque(atualizados, {cnpj})
+    
+    return {
+        "cnpj": cnpj,
+        "aplicado": aplicar and bool(divergencias),
+        "itens_contados": len(contagem),
+        "itens_divergentes": len(divergencias),
+        "valor_divergencia_total": round(sum(d["valor_diferenca"] for d in divergencias), 2),
+        "divergencias": divergencias,
+        "nao_encontrados": nao_encontrados,
+        "linhas_invalidas": linhas_invalidas
+    }
+
+@api_router.get("/estoque/alertas")
+async def get_alertas_estoque(cnpj: str = None, dias_vendas: int = 30, dias_cobertura: int = 30, current_user: str = Depends(get_current_user)):
+    """Lista produtos abaixo do estoque mínimo com sugestão de reposição"""
+    if dias_vendas <= 0 or dias_cobertura <= 0:
+        raise HTTPException(status_code=400, detail="Períodos devem ser maiores que zero")
+    
+    filter_query = {}
+    if cnpj:
+        filter_query["cnpj"] = cnpj
+    
+    alertas = await db.alertas_estoque.find(filter_query, {"_id": 0}).sort("nome", 1).to_list(None)
+    if not alertas:
+        return {"alertas": [], "total": 0}
+    
+    # Velocidade de vendas recente por produto x CNPJ (uma única agregação)
+    data_inicio = datetime.utcnow() - timedelta(days=dias_vendas)
+    vendas = await db.movimentacoes_estoque.aggregate([
+        {"$match": {
+            "tipo": "VENDA",
+            "data": {"$gte": data_inicio},
+            "produto_id": {"$in": list({a["produto_id"] for a in alertas})}
+        }},
+        {"$group": {
+            "_id": {"produto_id": "$produto_id", "cnpj": "$cnpj"},
+            "quantidade": {"$sum": "$quantidade_saida"}
+        }}
+    ]).to_list(None)
+    vendido = {(v["_id"]["produto_id"], v["_id"]["cnpj"]): v["quantidade"] for v in vendas}
+    
+    for alerta in alertas:
+        quantidade_vendida = vendido.get((alerta["produto_id"], alerta["cnpj"]), 0)
+        demanda_diaria = quantidade_vendida / dias_vendas
+        
+        # Repor até o máximo ou, sem máximo definido, mínimo + demanda do período de cobertura
+        alvo = max(alerta["estoque_maximo"], alerta["estoque_minimo"] + math.ceil(demanda_diaria * dias_cobertura))
+        
+        alerta["vendido_periodo"] = quantidade_vendida
+        alerta["demanda_diaria"] = round(demanda_diaria, 2)
+        alerta["dias_restantes"] = round(max(alerta["quantidade"], 0) / demanda_diaria, 1) if demanda_diaria > 0 else None
+        alerta["sugestao_reposicao"] = max(alvo - alerta["quantidade"], 0)
+    
+    return {"alertas": alertas, "total": len(alertas)}
+
+@api_router.post("/estoque/alertas/reconstruir")
+async def reconstruir_alertas(current_user: str = Depends(get_current_user)):
+    """Reconstrói o índice de alertas de estoque mínimo"""
+    total = await reconstruir_alertas_estoque()
+    return {"message": "Alertas reconstruídos com sucesso", "total": total}
+
 # ============= FINANCEIRO ROUTES =============
 
 @api_router.post("/contas-banco", response_model=ContaBanco)
@@ -552,100 +2883,352 @@ async def create_conta_banco(conta: ContaBancoCreate, current_user: str = Depend
     conta_dict = conta.dict()
     conta_obj = ContaBanco(**conta_dict)
     await db.contas_banco.insert_one(conta_obj.dict())
+    await registrar_alteracao("contas_banco")
     return conta_obj
 
 @api_router.get("/contas-banco", response_model=List[ContaBanco])
-async def get_contas_banco(current_user: str = Depends(get_current_user)):
+async def get_contas_banco(fields: Optional[str] = None, current_user: str = Depends(get_current_user), etag: str = Depends(ETagColecao("contas_banco"))):
+    projecao = projecao_campos(fields, ContaBanco)
+    if projecao:
+        return resposta_linhas(await db.contas_banco.find({}, projecao).to_list(100), etag)
+    
+    if JSON_RAPIDO:
+        contas = await db.contas_banco.find({}, projecao_modelo(ContaBanco)).to_list(100)
+        return resposta_linhas(contas, etag)
+    
     contas = await db.contas_banco.find().to_list(100)
     return [ContaBanco(**conta) for conta in contas]
 
-@api_router.post("/financeiro", response_model=ContaFinanceira)
+@api_router.post("/financeiro", response_model=Union[ContaFinanceira, List[ContaFinanceira]])
 async def create_conta_financeira(conta: ContaFinanceiraCreate, current_user: str = Depends(get_current_user)):
     conta_dict = conta.dict()
     
-    # Se tem parcelas, criar múltiplas contas
-    if conta_dict.get("parcelas", 1) > 1:
-        contas_criadas = []
-        valor_parcela = conta_dict["valor"] / conta_dict["parcelas"]
-        
-        for i in range(conta_dict["parcelas"]):
-            conta_parcela = conta_dict.copy()
-            conta_parcela["valor"] = round(valor_parcela, 2)
-            conta_parcela["parcela"] = i + 1
-            conta_parcela["total_parcelas"] = conta_dict["parcelas"]
-            conta_parcela["descricao"] = f"{conta_dict['descricao']} - Parcela {i+1}/{conta_dict['parcelas']}"
+    if not 1 <= conta_dict["parcelas"] <= MAXIMO_PARCELAS:
+        raise HTTPException(status_code=400, detail=f"Número de parcelas deve estar entre 1 e {MAXIMO_PARCELAS}")
+    if conta_dict["conta_banco_id"] and not await db.contas_banco.find_one({"id": conta_dict["conta_banco_id"]}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Conta bancária não encontrada")
+    
+    # Se tem parcelas, criar todas de uma vez e retornar o parcelamento completo
+    if conta_dict["parcelas"] > 1:
+        parcelas = gerar_parcelas(conta_dict)
+        await db.contas_financeiras.insert_many([documento_bson(parcela.dict()) for parcela in parcelas])
+        await registrar_alteracao_financeiro([conta_dict["cnpj"]])
+        return parcelas
+    else:
+        del conta_dict["parcelas"]
+        conta_obj = ContaFinanceira(**conta_dict)
+        await db.contas_financeiras.insert_one(documento_bson(conta_obj.dict()))
+        await registrar_alteracao_financeiro([conta_obj.cnpj])
+        return conta_obj
+
+@api_router.get("/financeiro")
+async def get_contas_financeiras(tipo: str = None, status: str = None, fields: Optional[str] = None, current_user: str = Depends(get_current_user)):
+    filter_query = {}
+    if tipo:
+        filter_query["tipo"] = tipo
+    if status:
+        filter_query["status"] = status
+    
+    projecao = projecao_campos(fields, ContaFinanceira) or {"_id": 0}
+    contas = await db.contas_financeiras.find(filter_query, projecao).sort("data_vencimento", 1).to_list(1000)
+    return contas
+
+def chave_lancamento(lancamento: LancamentoBanco) -> tuple:
+    """Posição do lançamento no extrato: (data, created_at, id), com created_at na precisão do BSON (ms)"""
+    created_at = lancamento.created_at.replace(microsecond=lancamento.created_at.microsecond // 1000 * 1000)
+    return datetime.combine(lancamento.data, datetime.min.time()), created_at, lancamento.id
+
+def filtro_posteriores(chave: tuple) -> dict:
+    """Lançamentos que vêm depois da chave (data, created_at, id) no extrato"""
+    data, created_at, lancamento_id = chave
+    return {"$or": [
+        {"data": {"$gt": data}},
+        {"data": data, "created_at": {"$gt": created_at}},
+        {"data": data, "created_at": created_at, "id": {"$gt": lancamento_id}}
+    ]}
+
+async def lancar_extrato_banco(conta_banco_id: str, lancamentos: List[LancamentoBanco], session=None):
+    """Aplica os lançamentos no saldo da conta bancária e grava-os no extrato.
+    
+    saldo_apos segue a ordem do extrato (data, created_at, id): lançamentos com data
+    passada também somam no saldo_apos dos que já existiam depois deles.
+    """
+    for lancamento in lancamentos:
+        lancamento.created_at = chave_lancamento(lancamento)[1]
+    chaves = [chave_lancamento(lancamento) for lancamento in lancamentos]
+    
+    delta = round(sum(lancamento.valor for lancamento in lancamentos), 2)
+    conta_banco = await db.contas_banco.find_one_and_update(
+        {"id": conta_banco_id},
+        {"$inc": {"saldo_atual": delta}},
+        projection={"_id": 0, "saldo_atual": 1},
+        return_document=ReturnDocument.AFTER,
+        session=session
+    )
+    saldo = conta_banco["saldo_atual"] if conta_banco else delta
+    
+    # Lançamentos existentes posteriores ao mais antigo do lote (em geral poucos: só quando há data passada)
+    existentes = await db.lancamentos_banco.find(
+        {"conta_banco_id": conta_banco_id, **filtro_posteriores(min(chaves))},
+        {"_id": 0, "data": 1, "created_at": 1, "id": 1, "valor": 1},
+        session=session
+    ).to_list(None)
+    if existentes:
+        await db.lancamentos_banco.bulk_write(
+            [
+                UpdateMany({"conta_banco_id": conta_banco_id, **filtro_posteriores(chave)}, {"$inc": {"saldo_apos": lancamento.valor}})
+                for chave, lancamento in zip(chaves, lancamentos)
+            ],
+            ordered=False,
+            session=session
+        )
+    
+    # Saldo após cada novo lançamento: saldo atual menos tudo que vem depois dele no extrato
+    ordenados = sorted(
+        [((e["data"], e["created_at"], e["id"]), e["valor"], None) for e in existentes]
+        + [(chave, lancamento.valor, lancamento) for chave, lancamento in zip(chaves, lancamentos)],
+        key=lambda item: item[0],
+        reverse=True
+    )
+    posteriores = 0
+    for _, valor, lancamento in ordenados:
+        if lancamento is not None:
+            lancamento.saldo_apos = saldo - posteriores
+        posteriores += valor
+    
+    await db.lancamentos_banco.insert_many([documento_bson(lancamento.dict()) for lancamento in lancamentos], session=session)
+
+def lancamento_baixa(conta: dict, baixa: BaixaConta, usuario: str) -> LancamentoBanco:
+    """Lançamento no extrato da conta bancária correspondente à baixa de um título"""
+    pagar = conta["tipo"] == "PAGAR"
+    return LancamentoBanco(
+        conta_banco_id=baixa.conta_banco_id,
+        conta_financeira_id=conta["id"],
+        tipo="DEBITO" if pagar else "CREDITO",
+        valor=-baixa.valor_pago if pagar else baixa.valor_pago,
+        descricao=conta.get("descricao", ""),
+        documento=conta.get("documento", ""),
+        cnpj=conta.get("cnpj", ""),
+        data=baixa.data_pagamento,
+        usuario=usuario
+    )
+
+@api_router.post("/financeiro/{conta_id}/pagar")
+async def pagar_conta(conta_id: str, baixa: BaixaConta, current_user: str = Depends(get_current_user)):
+    """Baixa uma conta como paga"""
+    if baixa.valor_pago <= 0:
+        raise HTTPException(status_code=400, detail="Valor pago deve ser maior que zero")
+    if not await db.contas_banco.find_one({"id": baixa.conta_banco_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Conta bancária não encontrada")
+    
+    update_data = {
+        "valor_pago": baixa.valor_pago,
+        "data_pagamento": baixa.data_pagamento,
+        "status": "PAGO",
+        "conta_banco_id": baixa.conta_banco_id
+    }
+    
+    async def aplicar(session):
+        # A troca de status só acontece uma vez: baixas concorrentes do mesmo título não movem o saldo duas vezes
+        conta = await db.contas_financeiras.find_one_and_update(
+            {"id": conta_id, "status": {"$ne": "PAGO"}},
+            {"$set": documento_bson(update_data)},
+            session=session
+        )
+        if not conta:
+            if await db.contas_financeiras.find_one({"id": conta_id}, {"_id": 1}, session=session):
+                raise HTTPException(status_code=409, detail="Conta já está paga")
+            raise HTTPException(status_code=404, detail="Conta não encontrada")
+        
+        await lancar_extrato_banco(baixa.conta_banco_id, [lancamento_baixa(conta, baixa, current_user)], session)
+        return conta
+    
+    conta = await executar_transacao(aplicar)
+    await registrar_alteracao("contas_banco")
+    await registrar_alteracao_financeiro([conta.get("cnpj", "")])
+    
+    return {"message": "Conta baixada com sucesso"}
+
+MAXIMO_BAIXAS_LOTE = 5000
+
+async def executar_baixas(baixas: List[ItemBaixaLote], usuario: str) -> List[dict]:
+    """Baixa os títulos em uma única escrita em lote, com um $inc agregado por conta bancária.
+    
+    Retorna um resultado por linha, na ordem recebida (status BAIXADA ou ERRO).
+    """
+    resultados = [{"conta_id": baixa.conta_id} for baixa in baixas]
+    vistos = set()
+    candidatas = []
+    for indice, baixa in enumerate(baixas):
+        if baixa.conta_id in vistos:
+            resultados[indice].update(status="ERRO", detalhe="Conta repetida no lote")
+        elif baixa.valor_pago <= 0:
+            resultados[indice].update(status="ERRO", detalhe="Valor pago deve ser maior que zero")
+        else:
+            candidatas.append((indice, baixa))
+        vistos.add(baixa.conta_id)
+    
+    bancos = {
+        banco["id"]
+        async for banco in db.contas_banco.find(
+            {"id": {"$in": list({baixa.conta_banco_id for _, baixa in candidatas})}}, {"_id": 0, "id": 1}
+        )
+    }
+    
+    aplicadas = []
+    cnpjs_afetados = set()
+    # Marca gravada nos títulos desta baixa: identifica quais trocaram de status se não houver transação
+    baixa_lote_id = str(uuid.uuid4())
+    
+    async def aplicar(session):
+        aplicadas.clear()
+        cnpjs_afetados.clear()
+        contas = {
+            conta["id"]: conta
+            async for conta in db.contas_financeiras.find(
+                {"id": {"$in": [baixa.conta_id for _, baixa in candidatas]}}, {"_id": 0}, session=session
+            )
+        }
+        
+        operacoes = []
+        pendentes = []
+        for indice, baixa in candidatas:
+            conta = contas.get(baixa.conta_id)
+            if not conta:
+                resultados[indice].update(status="ERRO", detalhe="Conta não encontrada")
+                continue
+            if conta["status"] == "PAGO":
+                resultados[indice].update(status="ERRO", detalhe="Conta já está paga")
+                continue
+            if baixa.conta_banco_id not in bancos:
+                resultados[indice].update(status="ERRO", detalhe="Conta bancária não encontrada")
+                continue
             
-            # Ajustar data de vencimento
-            from dateutil.relativedelta import relativedelta
-            data_base = datetime.strptime(str(conta_dict["data_vencimento"]), "%Y-%m-%d").date()
-            conta_parcela["data_vencimento"] = data_base + relativedelta(months=i)
+            operacoes.append(UpdateOne(
+                {"id": baixa.conta_id, "status": {"$ne": "PAGO"}},
+                {"$set": documento_bson({
+                    "valor_pago": baixa.valor_pago,
+                    "data_pagamento": baixa.data_pagamento,
+                    "status": "PAGO",
+                    "conta_banco_id": baixa.conta_banco_id,
+                    "baixa_lote_id": baixa_lote_id
+                })}
+            ))
+            pendentes.append((indice, baixa, conta))
+        
+        if not operacoes:
+            return
+        
+        resultado = await db.contas_financeiras.bulk_write(operacoes, ordered=False, session=session)
+        if resultado.matched_count != len(operacoes):
+            if session is not None:
+                # Com transação, nada foi gravado: o lote inteiro pode ser repetido
+                raise HTTPException(status_code=409, detail="Contas alteradas durante a baixa, tente novamente")
             
-            del conta_parcela["parcelas"]
-            conta_obj = ContaFinanceira(**conta_parcela)
-            await db.contas_financeiras.insert_one(conta_obj.dict())
-            contas_criadas.append(conta_obj)
+            # Sem transação as trocas de status já estão gravadas: saldo e extrato só dos títulos que este lote baixou
+            baixados = {
+                conta["id"]
+                async for conta in db.contas_financeiras.find(
+                    {"id": {"$in": [baixa.conta_id for _, baixa, _ in pendentes]}, "baixa_lote_id": baixa_lote_id},
+                    {"_id": 0, "id": 1}
+                )
+            }
+            for indice, baixa, _ in pendentes:
+                if baixa.conta_id not in baixados:
+                    resultados[indice].update(status="ERRO", detalhe="Conta baixada por outra operação")
+            pendentes = [pendente for pendente in pendentes if pendente[1].conta_id in baixados]
+            if not pendentes:
+                return
         
-        return contas_criadas[0]  # Retorna a primeira parcela
-    else:
-        del conta_dict["parcelas"]
-        conta_obj = ContaFinanceira(**conta_dict)
-        await db.contas_financeiras.insert_one(conta_obj.dict())
-        return conta_obj
+        lancamentos = defaultdict(list)
+        for indice, baixa, conta in pendentes:
+            lancamentos[baixa.conta_banco_id].append(lancamento_baixa(conta, baixa, usuario))
+            aplicadas.append(indice)
+            cnpjs_afetados.add(conta.get("cnpj", ""))
+        
+        # Um único $inc por conta bancária, com a soma do lote
+        for banco, lancamentos_banco in lancamentos.items():
+            await lancar_extrato_banco(banco, lancamentos_banco, session)
+    
+    await executar_transacao(aplicar)
+    
+    for indice in aplicadas:
+        resultados[indice].update(status="BAIXADA", valor_pago=baixas[indice].valor_pago)
+    if aplicadas:
+        await registrar_alteracao("contas_banco")
+        await registrar_alteracao_financeiro(cnpjs_afetados)
+    
+    return resultados
 
-@api_router.get("/financeiro")
-async def get_contas_financeiras(tipo: str = None, status: str = None, current_user: str = Depends(get_current_user)):
-    filter_query = {}
-    if tipo:
-        filter_query["tipo"] = tipo
-    if status:
-        filter_query["status"] = status
+@api_router.post("/financeiro/baixa-lote")
+async def baixar_contas_lote(lote: BaixaLote, current_user: str = Depends(get_current_user)):
+    """Baixa vários títulos de uma vez (ex.: repasse de marketplace), com resultado por linha"""
+    if len(lote.baixas) > MAXIMO_BAIXAS_LOTE:
+        raise HTTPException(status_code=400, detail=f"Máximo de {MAXIMO_BAIXAS_LOTE} baixas por lote")
     
-    contas = await db.contas_financeiras.find(filter_query).sort("data_vencimento", 1).to_list(1000)
-    return contas
+    resultados = await executar_baixas(lote.baixas, current_user)
+    baixadas = sum(1 for resultado in resultados if resultado["status"] == "BAIXADA")
+    
+    return {
+        "total": len(resultados),
+        "baixadas": baixadas,
+        "erros": len(resultados) - baixadas,
+        "resultados": resultados
+    }
 
-@api_router.post("/financeiro/{conta_id}/pagar")
-async def pagar_conta(conta_id: str, conta_banco_id: str, valor_pago: float, data_pagamento: str, current_user: str = Depends(get_current_user)):
-    """Baixa uma conta como paga"""
-    conta = await db.contas_financeiras.find_one({"id": conta_id})
-    if not conta:
-        raise HTTPException(status_code=404, detail="Conta não encontrada")
+# Totais em aberto por CNPJ, com a versão (versoes_colecoes) de quando foram calculados
+_relatorios_cnpj: Dict[str, dict] = {}
+_relatorios_carregados = False
+
+PREFIXO_VERSAO_FINANCEIRO = "contas_financeiras:"
+
+async def registrar_alteracao_financeiro(cnpjs):
+    """Invalida o relatório em cache dos CNPJs cujos títulos foram alterados e o resumo de vencidos"""
+    await registrar_alteracao("contas_financeiras", *{f"{PREFIXO_VERSAO_FINANCEIRO}{cnpj}" for cnpj in cnpjs})
+
+async def get_relatorios_por_cnpj() -> Dict[str, dict]:
+    """Totais por CNPJ; recalcula em uma única agregação apenas os CNPJs alterados desde o último cálculo"""
+    global _relatorios_carregados
     
-    # Atualizar conta
-    update_data = {
-        "valor_pago": valor_pago,
-        "data_pagamento": datetime.strptime(data_pagamento, "%Y-%m-%d").date(),
-        "status": "PAGO",
-        "conta_banco_id": conta_banco_id
+    versoes = {
+        documento["_id"][len(PREFIXO_VERSAO_FINANCEIRO):]: documento["versao"]
+        async for documento in db.versoes_colecoes.find({"_id": {"$regex": f"^{PREFIXO_VERSAO_FINANCEIRO}"}})
     }
+    if _relatorios_carregados:
+        desatualizados = [cnpj for cnpj, versao in versoes.items() if _relatorios_cnpj.get(cnpj, {}).get("versao") != versao]
+        if not desatualizados:
+            return _relatorios_cnpj
+        filtro_cnpj = {"cnpj": {"$in": desatualizados}}
+    else:
+        desatualizados = list(versoes)
+        filtro_cnpj = {}
     
-    await db.contas_financeiras.update_one({"id": conta_id}, {"$set": update_data})
+    def somar(tipo, status):
+        return {"$sum": {"$cond": [{"$and": [{"$eq": ["$tipo", tipo]}, {"$in": ["$status", status]}]}, "$valor", 0]}}
     
-    # Atualizar saldo da conta bancária
-    conta_banco = await db.contas_banco.find_one({"id": conta_banco_id})
-    if conta_banco:
-        if conta["tipo"] == "PAGAR":
-            novo_saldo = conta_banco["saldo_atual"] - valor_pago
-        else:  # RECEBER
-            novo_saldo = conta_banco["saldo_atual"] + valor_pago
-        
-        await db.contas_banco.update_one({"id": conta_banco_id}, {"$set": {"saldo_atual": novo_saldo}})
+    totais = {cnpj: {"contas_pagar": 0, "contas_receber": 0, "pagar_vencido": 0, "receber_vencido": 0} for cnpj in desatualizados}
+    async for grupo in db.contas_financeiras.aggregate([
+        {"$match": {"status": {"$in": ["PENDENTE", "VENCIDO"]}, **filtro_cnpj}},
+        {"$group": {
+            "_id": "$cnpj",
+            "contas_pagar": somar("PAGAR", ["PENDENTE", "VENCIDO"]),
+            "contas_receber": somar("RECEBER", ["PENDENTE", "VENCIDO"]),
+            "pagar_vencido": somar("PAGAR", ["VENCIDO"]),
+            "receber_vencido": somar("RECEBER", ["VENCIDO"])
+        }}
+    ]):
+        cnpj = grupo.pop("_id") or ""
+        totais[cnpj] = {campo: round(valor, 2) for campo, valor in grupo.items()}
     
-    return {"message": "Conta baixada com sucesso"}
+    for cnpj, total in totais.items():
+        _relatorios_cnpj[cnpj] = {**total, "versao": versoes.get(cnpj, 0)}
+    _relatorios_carregados = True
+    return _relatorios_cnpj
 
 @api_router.get("/financeiro/relatorios")
 async def get_relatorios_financeiros(current_user: str = Depends(get_current_user)):
-    """Relatórios financeiros gerais"""
-    # Contas a pagar
-    total_pagar = await db.contas_financeiras.aggregate([
-        {"$match": {"tipo": "PAGAR", "status": "PENDENTE"}},
-        {"$group": {"_id": None, "total": {"$sum": "$valor"}}}
-    ]).to_list(1)
-    
-    # Contas a receber
-    total_receber = await db.contas_financeiras.aggregate([
-        {"$match": {"tipo": "RECEBER", "status": "PENDENTE"}},
-        {"$group": {"_id": None, "total": {"$sum": "$valor"}}}
-    ]).to_list(1)
+    """Relatórios financeiros: consolidado de todas as empresas e totais por CNPJ"""
+    por_cnpj = await get_relatorios_por_cnpj()
     
     # Saldo total das contas bancárias
     saldo_bancos = await db.contas_banco.aggregate([
@@ -653,17 +3236,394 @@ async def get_relatorios_financeiros(current_user: str = Depends(get_current_use
         {"$group": {"_id": None, "total": {"$sum": "$saldo_atual"}}}
     ]).to_list(1)
     
-    pagar = total_pagar[0]["total"] if total_pagar else 0
-    receber = total_receber[0]["total"] if total_receber else 0
+    pagar = round(sum(total["contas_pagar"] for total in por_cnpj.values()), 2)
+    receber = round(sum(total["contas_receber"] for total in por_cnpj.values()), 2)
     saldo = saldo_bancos[0]["total"] if saldo_bancos else 0
     
+    empresas = await get_empresas_config()
     return {
         "contas_pagar": pagar,
         "contas_receber": receber,
         "saldo_bancos": saldo,
-        "patrimonio_liquido": saldo + receber - pagar
+        "patrimonio_liquido": saldo + receber - pagar,
+        "por_cnpj": [
+            {
+                "cnpj": cnpj,
+                "nome": empresas.get(cnpj, {}).get("nome", ""),
+                "contas_pagar": total["contas_pagar"],
+                "contas_receber": total["contas_receber"],
+                "pagar_vencido": total["pagar_vencido"],
+                "receber_vencido": total["receber_vencido"],
+                "saldo_titulos": round(total["contas_receber"] - total["contas_pagar"], 2)
+            }
+            for cnpj, total in sorted(por_cnpj.items())
+            if total["contas_pagar"] or total["contas_receber"]
+        ]
+    }
+
+@api_router.get("/financeiro/fluxo-caixa")
+async def get_fluxo_caixa(dias: int = 90, cnpj: str = None, current_user: str = Depends(get_current_user)):
+    """Projeção diária de caixa por CNPJ/conta bancária a partir dos títulos em aberto e saldos atuais.
+    
+    Títulos vencidos entram no dia de hoje; títulos sem conta bancária ficam em conta_banco_id "".
+    """
+    if not 1 <= dias <= 366:
+        raise HTTPException(status_code=400, detail="Período deve estar entre 1 e 366 dias")
+    
+    hoje = datetime.combine(date.today(), datetime.min.time())
+    fim = hoje + timedelta(days=dias)
+    
+    filtro = {"status": {"$in": ["PENDENTE", "VENCIDO"]}, "data_vencimento": {"$lt": fim}}
+    if cnpj:
+        filtro["cnpj"] = cnpj
+    
+    aberto = {"$subtract": ["$valor", {"$ifNull": ["$valor_pago", 0]}]}
+    grupos = await db.contas_financeiras.aggregate([
+        {"$match": filtro},
+        {"$group": {
+            "_id": {
+                "cnpj": "$cnpj",
+                "conta_banco_id": "$conta_banco_id",
+                "dia": {"$cond": [{"$lt": ["$data_vencimento", hoje]}, hoje, "$data_vencimento"]}
+            },
+            "entradas": {"$sum": {"$cond": [{"$eq": ["$tipo", "RECEBER"]}, aberto, 0]}},
+            "saidas": {"$sum": {"$cond": [{"$eq": ["$tipo", "PAGAR"]}, aberto, 0]}}
+        }}
+    ]).to_list(None)
+    
+    contas_banco = await db.contas_banco.find({"ativo": True}, {"_id": 0, "id": 1, "nome": 1, "saldo_atual": 1}).to_list(None)
+    
+    # Séries (cnpj, conta bancária) em matrizes séries x dias
+    chaves = sorted({(g["_id"].get("cnpj", ""), g["_id"].get("conta_banco_id", "")) for g in grupos})
+    indice_serie = {chave: i for i, chave in enumerate(chaves)}
+    entradas = np.zeros((len(chaves), dias))
+    saidas = np.zeros((len(chaves), dias))
+    if grupos:
+        linhas = np.fromiter((indice_serie[(g["_id"].get("cnpj", ""), g["_id"].get("conta_banco_id", ""))] for g in grupos), dtype=np.int64, count=len(grupos))
+        colunas = np.fromiter(((g["_id"]["dia"] - hoje).days for g in grupos), dtype=np.int64, count=len(grupos))
+        # Decimal -> float só aqui, para a série vetorizada (a soma por dia já veio exata do banco)
+        np.add.at(entradas, (linhas, colunas), np.array([g["entradas"] for g in grupos], dtype=float))
+        np.add.at(saidas, (linhas, colunas), np.array([g["saidas"] for g in grupos], dtype=float))
+    liquido = entradas - saidas
+    acumulado = np.cumsum(liquido, axis=1)
+    
+    def serie(valores) -> List[float]:
+        return np.round(valores, 2).tolist()
+    
+    # Saldo projetado por conta bancária: saldo atual + fluxo dos títulos vinculados a ela
+    bancos = []
+    for conta in contas_banco:
+        vinculadas = [indice_serie[chave] for chave in chaves if chave[1] == conta["id"]]
+        saldo = float(conta.get("saldo_atual", 0)) + (acumulado[vinculadas].sum(axis=0) if vinculadas else np.zeros(dias))
+        bancos.append({
+            "conta_banco_id": conta["id"],
+            "nome": conta.get("nome", ""),
+            "saldo_inicial": round(conta.get("saldo_atual", 0), 2),
+            "saldo": serie(saldo),
+            "menor_saldo": round(float(saldo.min()), 2)
+        })
+    
+    saldo_inicial = float(sum(conta.get("saldo_atual", 0) for conta in contas_banco))
+    saldo_consolidado = saldo_inicial + acumulado.sum(axis=0)
+    dia_menor = int(saldo_consolidado.argmin())
+    
+    return {
+        "inicio": hoje.date(),
+        "dias": dias,
+        "datas": [(hoje + timedelta(days=i)).date() for i in range(dias)],
+        "series": [
+            {
+                "cnpj": chave[0],
+                "conta_banco_id": chave[1],
+                "entradas": serie(entradas[i]),
+                "saidas": serie(saidas[i]),
+                "acumulado": serie(acumulado[i])
+            }
+            for i, chave in enumerate(chaves)
+        ],
+        "contas_banco": bancos,
+        "consolidado": {
+            "saldo_inicial": round(saldo_inicial, 2),
+            "entradas": serie(entradas.sum(axis=0)),
+            "saidas": serie(saidas.sum(axis=0)),
+            "saldo": serie(saldo_consolidado),
+            "menor_saldo": round(float(saldo_consolidado[dia_menor]), 2),
+            "data_menor_saldo": (hoje + timedelta(days=dia_menor)).date()
+        }
+    }
+
+def codificar_cursor(lancamento: dict) -> str:
+    chave = [lancamento["data"].isoformat(), lancamento["created_at"].isoformat(), lancamento["id"]]
+    return base64.urlsafe_b64encode(json.dumps(chave).encode()).decode()
+
+def decodificar_cursor(cursor: str) -> tuple:
+    try:
+        data, created_at, lancamento_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(data), datetime.fromisoformat(created_at), lancamento_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+@api_router.get("/financeiro/historico")
+async def get_historico_financeiro(
+    inicio: Optional[date] = None,
+    fim: Optional[date] = None,
+    cnpj: str = None,
+    conta_banco_id: str = None,
+    cursor: str = None,
+    limite: int = 100,
+    current_user: str = Depends(get_current_user)
+):
+    """Histórico de lançamentos bancários (mais recentes primeiro) com saldo após cada lançamento,
+    mais o resumo mensal de receitas/despesas pagas no período"""
+    limite = max(1, min(limite, 500))
+    data_inicio = datetime.combine(inicio, datetime.min.time()) if inicio else None
+    data_fim = datetime.combine(fim, datetime.min.time()) if fim else None
+    
+    # Resumo mensal dos títulos pagos
+    filtro_pagos = {"status": "PAGO"}
+    if data_inicio or data_fim:
+        filtro_pagos["data_pagamento"] = {
+            **({"$gte": data_inicio} if data_inicio else {}),
+            **({"$lte": data_fim} if data_fim else {})
+        }
+    if cnpj:
+        filtro_pagos["cnpj"] = cnpj
+    
+    historico = await db.contas_financeiras.aggregate([
+        {"$match": filtro_pagos},
+        {"$group": {
+            "_id": {
+                "year": {"$year": "$data_pagamento"},
+                "month": {"$month": "$data_pagamento"},
+                "tipo": {"$cond": [{"$eq": ["$tipo", "RECEBER"]}, "receita", "despesa"]}
+            },
+            "total": {"$sum": "$valor_pago"},
+            "count": {"$sum": 1}
+        }},
+        {"$sort": {"_id.year": -1, "_id.month": -1}}
+    ]).to_list(None)
+    for item in historico:
+        item["total"] = round(item["total"], 2)
+    
+    # Lançamentos: cada um já traz o saldo após ele na ordem do extrato (mantido por lancar_extrato_banco), então a página é uma consulta simples
+    filtro = {}
+    if conta_banco_id:
+        filtro["conta_banco_id"] = conta_banco_id
+    if data_inicio or data_fim:
+        filtro["data"] = {
+            **({"$gte": data_inicio} if data_inicio else {}),
+            **({"$lte": data_fim} if data_fim else {})
+        }
+    if cnpj:
+        filtro["cnpj"] = cnpj
+    if cursor:
+        data, created_at, lancamento_id = decodificar_cursor(cursor)
+        filtro["$or"] = [
+            {"data": {"$lt": data}},
+            {"data": data, "created_at": {"$lt": created_at}},
+            {"data": data, "created_at": created_at, "id": {"$lt": lancamento_id}}
+        ]
+    
+    lancamentos = await db.lancamentos_banco.find(filtro, {"_id": 0}).sort(
+        [("data", -1), ("created_at", -1), ("id", -1)]
+    ).limit(limite + 1).to_list(None)
+    
+    proximo_cursor = None
+    if len(lancamentos) > limite:
+        lancamentos = lancamentos[:limite]
+        proximo_cursor = codificar_cursor(lancamentos[-1])
+    
+    return {
+        "historico": historico,
+        "lancamentos": lancamentos,
+        "proximo_cursor": proximo_cursor
+    }
+
+# ============= CONCILIAÇÃO BANCÁRIA =============
+
+@api_router.post("/financeiro/extrato/importar")
+async def importar_extrato(
+    conta_banco_id: str = Form(...),
+    janela_dias: int = Form(3),
+    file: UploadFile = File(...),
+    current_user: str = Depends(get_current_user)
+):
+    """Importa extrato OFX/CSV, concilia com os títulos em aberto e baixa os casamentos exatos"""
+    if not await db.contas_banco.find_one({"id": conta_banco_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Conta bancária não encontrada")
+    janela_dias = max(0, min(janela_dias, 30))
+    
+    content = await file.read()
+    try:
+        extrato = await executar_em_processo(ler_extrato, content, file.filename)
+    except (UnicodeDecodeError, csv.Error, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Erro ao ler extrato: {e}")
+    
+    # Linhas já importadas (mesmo FITID na mesma conta) são ignoradas
+    linhas = extrato["linhas"]
+    importadas = {
+        linha["fitid"]
+        async for linha in db.extrato_bancario.find(
+            {"conta_banco_id": conta_banco_id, "fitid": {"$in": [linha["fitid"] for linha in linhas]}},
+            {"_id": 0, "fitid": 1}
+        )
+    }
+    vistas = set()
+    novas = []
+    for linha in linhas:
+        if linha["fitid"] not in importadas and linha["fitid"] not in vistas:
+            novas.append(linha)
+            vistas.add(linha["fitid"])
+    
+    conciliacao = []
+    if novas:
+        janela = timedelta(days=janela_dias)
+        titulos = await db.contas_financeiras.find(
+            {
+                "status": {"$in": ["PENDENTE", "VENCIDO"]},
+                "data_vencimento": {
+                    "$gte": datetime.combine(min(l["data"] for l in novas) - janela, datetime.min.time()),
+                    "$lte": datetime.combine(max(l["data"] for l in novas) + janela, datetime.min.time())
+                }
+            },
+            {"_id": 0, "id": 1, "tipo": 1, "valor": 1, "valor_pago": 1, "data_vencimento": 1, "documento": 1}
+        ).to_list(None)
+        for titulo in titulos:
+            titulo["data_vencimento"] = titulo["data_vencimento"].date()
+        conciliacao = conciliar_extrato(novas, titulos, janela_dias)
+    
+    # Baixa em lote dos casamentos únicos
+    casadas = [(linha, resultado) for linha, resultado in zip(novas, conciliacao) if resultado["status"] == "CONCILIADO"]
+    baixas = await executar_baixas(
+        [
+            ItemBaixaLote(
+                conta_id=resultado["conta_id"],
+                conta_banco_id=conta_banco_id,
+                valor_pago=abs(linha["valor"]),
+                data_pagamento=linha["data"]
+            )
+            for linha, resultado in casadas
+        ],
+        current_user
+    ) if casadas else []
+    for (linha, resultado), baixa in zip(casadas, baixas):
+        if baixa["status"] != "BAIXADA":
+            resultado.update(status="NAO_CONCILIADO", detalhe=baixa.get("detalhe", ""))
+            resultado.pop("conta_id")
+    
+    agora = datetime.utcnow()
+    documentos = [
+        documento_bson({
+            "id": str(uuid.uuid4()),
+            "conta_banco_id": conta_banco_id,
+            **linha,
+            **resultado,
+            "arquivo_nome": file.filename,
+            "usuario": current_user,
+            "created_at": agora
+        })
+        for linha, resultado in zip(novas, conciliacao)
+    ]
+    if documentos:
+        try:
+            await db.extrato_bancario.insert_many(documentos, ordered=False)
+        except BulkWriteError as e:
+            # Importação concorrente do mesmo extrato gravou a linha primeiro (índice único conta_banco_id + fitid)
+            erros = e.details.get("writeErrors", [])
+            if any(erro["code"] != 11000 for erro in erros):
+                raise
+            repetidas = {erro["index"] for erro in erros}
+            novas = [linha for i, linha in enumerate(novas) if i not in repetidas]
+            conciliacao = [resultado for i, resultado in enumerate(conciliacao) if i not in repetidas]
+    
+    def linhas_com_status(status):
+        return [
+            {**linha, **resultado}
+            for linha, resultado in zip(novas, conciliacao)
+            if resultado["status"] == status
+        ]
+    
+    return {
+        "total_linhas": len(linhas),
+        "duplicadas": len(linhas) - len(novas),
+        "conciliadas": sum(1 for resultado in conciliacao if resultado["status"] == "CONCILIADO"),
+        "ambiguas": linhas_com_status("AMBIGUO"),
+        "nao_conciliadas": linhas_com_status("NAO_CONCILIADO"),
+        "erros": extrato["erros"]
     }
 
+@api_router.get("/financeiro/extrato")
+async def get_extrato(conta_banco_id: str, status: str = None, current_user: str = Depends(get_current_user)):
+    """Linhas de extrato importadas (ex.: status=AMBIGUO para conciliação manual)"""
+    filter_query = {"conta_banco_id": conta_banco_id}
+    if status:
+        filter_query["status"] = status
+    
+    return await db.extrato_bancario.find(filter_query, {"_id": 0}).sort("data", -1).to_list(1000)
+
+# ============= ICMS ROUTES =============
+
+def normalizar_regra_icms(regra: dict) -> dict:
+    regra["uf_origem"] = regra["uf_origem"].strip().upper()
+    regra["uf_destino"] = regra["uf_destino"].strip().upper()
+    regra["ncm_prefixo"] = re.sub(r"\D", "", regra.get("ncm_prefixo", ""))
+    regra["categoria"] = regra.get("categoria", "").strip()
+    if regra["aliquota"] < 0:
+        raise HTTPException(status_code=400, detail="Alíquota não pode ser negativa")
+    return regra
+
+async def regras_icms_alteradas():
+    await registrar_alteracao("regras_icms")
+    await carregar_regras_icms()
+
+@api_router.post("/icms/regras", response_model=RegraICMS)
+async def create_regra_icms(regra: RegraICMSCreate, current_user: str = Depends(get_current_user)):
+    regra_obj = RegraICMS(**normalizar_regra_icms(regra.dict()))
+    await db.regras_icms.insert_one(regra_obj.dict())
+    await regras_icms_alteradas()
+    return regra_obj
+
+@api_router.get("/icms/regras", response_model=List[RegraICMS])
+async def get_regras_icms(uf_origem: str = None, uf_destino: str = None, current_user: str = Depends(get_current_user)):
+    filter_query = {}
+    if uf_origem:
+        filter_query["uf_origem"] = uf_origem.upper()
+    if uf_destino:
+        filter_query["uf_destino"] = uf_destino.upper()
+    
+    regras = await db.regras_icms.find(filter_query, {"_id": 0}).sort([("uf_origem", 1), ("uf_destino", 1), ("ncm_prefixo", 1)]).to_list(None)
+    return [RegraICMS(**regra) for regra in regras]
+
+@api_router.put("/icms/regras/{regra_id}", response_model=RegraICMS)
+async def update_regra_icms(regra_id: str, regra_data: RegraICMSCreate, current_user: str = Depends(get_current_user)):
+    update_data = normalizar_regra_icms(regra_data.dict())
+    update_data["updated_at"] = datetime.utcnow()
+    
+    regra = await db.regras_icms.find_one_and_update(
+        {"id": regra_id},
+        {"$set": update_data},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not regra:
+        raise HTTPException(status_code=404, detail="Regra não encontrada")
+    await regras_icms_alteradas()
+    return RegraICMS(**regra)
+
+@api_router.delete("/icms/regras/{regra_id}")
+async def delete_regra_icms(regra_id: str, current_user: str = Depends(get_current_user)):
+    result = await db.regras_icms.delete_one({"id": regra_id})
+    if result.deleted_count:
+        await regras_icms_alteradas()
+        return {"message": "Regra deletada com sucesso"}
+    raise HTTPException(status_code=404, detail="Regra não encontrada")
+
+@api_router.post("/icms/regras/recompilar")
+async def recompilar_regras_icms(current_user: str = Depends(get_current_user)):
+    """Recompila a tabela em memória (ex.: após carga direta no banco)"""
+    await regras_icms_alteradas()
+    return {"message": "Regras recompiladas", "pares_uf": len(tabela_icms.por_par), "versao": tabela_icms.versao}
+
 # ============= XML PROCESSING ROUTES =============
 
 @api_router.post("/xml/upload")
@@ -672,57 +3632,20 @@ async def upload_xml(file: UploadFile = File(...), cnpj_destino: str = Form(...)
     if not file.filename.endswith('.xml'):
         raise HTTPException(status_code=400, detail="Arquivo deve ser XML")
     
+    await validar_cnpj_empresa(cnpj_destino)
+    
     # Ler conteúdo do arquivo
     content = await file.read()
     
     try:
-        # Parse do XML
-        root = ET.fromstring(content)
-        
-        # Extrair dados básicos da NF
-        ns = {'nfe': 'http://www.portalfiscal.inf.br/nfe'}  # Namespace padrão NFe
-        
-        # Dados do emitente (fornecedor)
-        emit = root.find('.//nfe:emit', ns) or root.find('.//emit')
-        fornecedor_cnpj = emit.find('.//CNPJ').text if emit is not None and emit.find('.//CNPJ') is not None else ""
-        fornecedor_nome = emit.find('.//xNome').text if emit is not None and emit.find('.//xNome') is not None else ""
-        
-        # Dados da NF
-        ide = root.find('.//nfe:ide', ns) or root.find('.//ide')
-        numero_nf = ide.find('.//nNF').text if ide is not None and ide.find('.//nNF') is not None else ""
-        
-        # Totais
-        total = root.find('.//nfe:total//nfe:ICMSTot', ns) or root.find('.//total//ICMSTot')
-        valor_total = float(total.find('.//vNF').text) if total is not None and total.find('.//vNF') is not None else 0.0
-        valor_produtos = float(total.find('.//vProd').text) if total is not None and total.find('.//vProd') is not None else 0.0
-        valor_icms = float(total.find('.//vICMS').text) if total is not None and total.find('.//vICMS') is not None else 0.0
-        
-        # Itens da NF
-        itens = []
-        for det in root.findall('.//nfe:det', ns) or root.findall('.//det'):
-            prod = det.find('.//nfe:prod', ns) or det.find('.//prod')
-            if prod is not None:
-                item = {
-                    "codigo": prod.find('.//cProd').text if prod.find('.//cProd') is not None else "",
-                    "descricao": prod.find('.//xProd').text if prod.find('.//xProd') is not None else "",
-                    "ean": prod.find('.//cEAN').text if prod.find('.//cEAN') is not None else "",
-                    "quantidade": float(prod.find('.//qCom').text) if prod.find('.//qCom') is not None else 0.0,
-                    "valor_unitario": float(prod.find('.//vUnCom').text) if prod.find('.//vUnCom') is not None else 0.0,
-                    "valor_total": float(prod.find('.//vProd').text) if prod.find('.//vProd') is not None else 0.0
-                }
-                itens.append(item)
+        # Parse do XML fora do event loop
+        nfe = await executar_em_processo(ler_nfe_xml, content)
         
         # Criar registro de processamento
         xml_proc = XMLProcessamento(
             arquivo_nome=file.filename,
-            fornecedor_cnpj=fornecedor_cnpj,
-            fornecedor_nome=fornecedor_nome,
-            numero_nf=numero_nf,
-            valor_total=valor_total,
-            valor_produtos=valor_produtos,
-            valor_icms=valor_icms,
-            itens=itens,
-            cnpj_destino=cnpj_destino
+            cnpj_destino=cnpj_destino,
+            **nfe
         )
         
         await db.xml_processamentos.insert_one(xml_proc.dict())
@@ -739,13 +3662,35 @@ async def upload_xml(file: UploadFile = File(...), cnpj_destino: str = Form(...)
 
 @api_router.post("/xml/{xml_id}/processar")
 async def processar_xml_compra(xml_id: str, current_user: str = Depends(get_current_user)):
-    """Processa XML confirmando entrada no estoque e financeiro"""
-    xml_proc = await db.xml_processamentos.find_one({"_id": xml_id})  # Usar _id do MongoDB
+    """Enfileira o processamento do XML (entrada no estoque e financeiro)"""
+    # Reservar o XML antes de enfileirar: cliques repetidos não geram uma segunda entrada
+    xml_proc = await db.xml_processamentos.find_one_and_update(
+        {"id": xml_id, "status": {"$nin": ["ENFILEIRADO", "PROCESSANDO", "PROCESSADO"]}},
+        {"$set": {"status": "ENFILEIRADO"}}
+    )
     if not xml_proc:
-        raise HTTPException(status_code=404, detail="XML não encontrado")
+        existente = await db.xml_processamentos.find_one({"id": xml_id}, {"_id": 0, "status": 1})
+        if not existente:
+            raise HTTPException(status_code=404, detail="XML não encontrado")
+        if existente["status"] == "PROCESSADO":
+            raise HTTPException(status_code=400, detail="XML já foi processado")
+        raise HTTPException(status_code=409, detail="XML já está em processamento")
     
-    if xml_proc["status"] == "PROCESSADO":
-        raise HTTPException(status_code=400, detail="XML já foi processado")
+    tarefa = await fila_tarefas.enfileirar("PROCESSAR_XML", {"xml_id": xml_id}, current_user)
+    return {"message": "Processamento do XML enfileirado", "tarefa_id": tarefa["id"], "status": tarefa["status"]}
+
+@fila_tarefas.tarefa("PROCESSAR_XML")
+async def executar_processamento_xml(payload: dict, usuario: str):
+    """Processa XML confirmando entrada no estoque e financeiro"""
+    xml_id = payload["xml_id"]
+    # Mesma reserva do enfileiramento; ERRO permite a nova tentativa da fila após falha transitória
+    xml_proc = await db.xml_processamentos.find_one_and_update(
+        {"id": xml_id, "status": {"$in": ["ENFILEIRADO", "ERRO"]}},
+        {"$set": {"status": "PROCESSANDO"}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not xml_proc:
+        raise HTTPException(status_code=409, detail="XML já foi processado ou está em processamento")
     
     try:
         # Buscar ou criar fornecedor
@@ -757,58 +3702,87 @@ async def processar_xml_compra(xml_id: str, current_user: str = Depends(get_curr
                 cnpj=xml_proc["fornecedor_cnpj"]
             )
             await db.fornecedores.insert_one(novo_fornecedor.dict())
+            await registrar_alteracao("fornecedores")
             fornecedor_id = novo_fornecedor.id
         else:
             fornecedor_id = fornecedor["id"]
         
+        # Identificar os produtos da nota: mapeamento do fornecedor primeiro, depois SKU/EAN
+        itens = xml_proc["itens"]
+        fornecedor_cnpj = xml_proc["fornecedor_cnpj"]
+        ids_fornecedor = await resolver_codigos_fornecedor(fornecedor_cnpj, [item["codigo"] for item in itens])
+        sem_mapeamento = [item for item in itens if item["codigo"] not in ids_fornecedor]
+        ids_sku, ids_ean = await resolver_ids_produtos(
+            [item["codigo"] for item in sem_mapeamento],
+            [item["ean"] for item in sem_mapeamento]
+        )
+        ids_itens = [
+            ids_fornecedor.get(item["codigo"]) or ids_sku.get(item["codigo"]) or ids_ean.get(item["ean"])
+            for item in itens
+        ]
+        produtos = await db.produtos.find({"id": {"$in": [i for i in ids_itens if i]}}).to_list(None)
+        produtos_por_id = {p["id"]: p for p in produtos}
+        
+        codigos_aprendidos = {}
+        itens_nao_encontrados = []
+        
+        # Alíquota DIFAL de todos os itens: UF do emitente (XML) x UF da empresa destino, por NCM/categoria
+        empresas = await get_empresas_config()
+        uf_destino = empresas.get(xml_proc["cnpj_destino"], {}).get("uf", "")
+        produtos_itens = [produtos_por_id.get(produto_id, {}) for produto_id in ids_itens]
+        tabela = await get_tabela_icms()
+        aliquotas = tabela.aliquotas(
+            xml_proc.get("uf_emitente", ""),
+            uf_destino,
+            [item.get("ncm", "") for item in itens],
+            [produto.get("categoria", "") for produto in produtos_itens],
+            [produto.get("fora_estado", False) for produto in produtos_itens]
+        )
+        valores_compra = np.array([item["valor_unitario"] for item in itens], dtype=float) * (1 + aliquotas / 100)
+        
         # Processar cada item
-        for item in xml_proc["itens"]:
-            # Buscar produto pelo código/EAN
-            produto = await db.produtos.find_one({
-                "$or": [
-                    {"sku": item["codigo"]},
-                    {"ean": item["ean"]}
-                ]
-            })
+        for item, produto_id, valor_compra in zip(itens, ids_itens, valores_compra.tolist()):
+            produto = produtos_por_id.get(produto_id)
             
-            if produto:
-                produto_id = produto["id"]
-                valor_compra = item["valor_unitario"]
-                
-                # Aplicar regra ICMS diferencial se produto de fora do estado
-                if produto.get("fora_estado", False):
-                    valor_compra *= 1.06  # Adiciona 6%
-                
-                # Calcular novo custo médio
-                novo_custo_medio = await calcular_custo_medio(produto_id, valor_compra, int(item["quantidade"]))
-                
-                # Atualizar produto
-                await db.produtos.update_one(
-                    {"id": produto_id},
-                    {
-                        "$set": {
-                            "valor_compra": valor_compra,
-                            "custo_medio": novo_custo_medio,
-                            "updated_at": datetime.utcnow()
-                        }
+            if not produto:
+                itens_nao_encontrados.append(item)
+                continue
+            
+            if item["codigo"] not in ids_fornecedor:
+                codigos_aprendidos[item["codigo"]] = produto["id"]
+            
+            produto_id = produto["id"]
+            
+            # Calcular novo custo médio
+            novo_custo_medio = await calcular_custo_medio(produto_id, valor_compra, int(item["quantidade"]))
+            
+            # Atualizar produto
+            await db.produtos.update_one(
+                {"id": produto_id},
+                {
+                    "$set": {
+                        "valor_compra": valor_compra,
+                        "custo_medio": novo_custo_medio,
+                        "updated_at": datetime.utcnow()
                     }
-                )
-                
-                # Atualizar estoque
-                await atualizar_estoque_produto(produto_id, xml_proc["cnpj_destino"], int(item["quantidade"]), "ENTRADA")
-                
-                # Criar movimentação de estoque
-                await criar_movimentacao_estoque(
-                    produto_id=produto_id,
-                    cnpj=xml_proc["cnpj_destino"],
-                    tipo="COMPRA",
-                    quantidade_entrada=int(item["quantidade"]),
-                    quantidade_saida=0,
-                    documento=f"NF {xml_proc['numero_nf']}",
-                    descricao=f"Compra - {item['descricao']}",
-                    valor_unitario=valor_compra,
-                    usuario=current_user
-                )
+                }
+            )
+            
+            # Atualizar estoque
+            await atualizar_estoque_produto(produto_id, xml_proc["cnpj_destino"], int(item["quantidade"]), "ENTRADA")
+            
+            # Criar movimentação de estoque
+            await criar_movimentacao_estoque(
+                produto_id=produto_id,
+                cnpj=xml_proc["cnpj_destino"],
+                tipo="COMPRA",
+                quantidade_entrada=int(item["quantidade"]),
+                quantidade_saida=0,
+                documento=f"NF {xml_proc['numero_nf']}",
+                descricao=f"Compra - {item['descricao']}",
+                valor_unitario=valor_compra,
+                usuario=usuario
+            )
         
         # Criar conta a pagar
         conta_pagar = ContaFinanceira(
@@ -822,179 +3796,181 @@ async def processar_xml_compra(xml_id: str, current_user: str = Depends(get_curr
             cnpj=xml_proc["cnpj_destino"]
         )
         
-        await db.contas_financeiras.insert_one(conta_pagar.dict())
+        await db.contas_financeiras.insert_one(documento_bson(conta_pagar.dict()))
+        await registrar_alteracao_financeiro([conta_pagar.cnpj])
+        
+        await aprender_codigos_fornecedor(fornecedor_cnpj, codigos_aprendidos)
         
         # Marcar XML como processado
         await db.xml_processamentos.update_one(
-            {"_id": xml_id},
-            {"$set": {"status": "PROCESSADO"}}
+            {"id": xml_id},
+            {"$set": {"status": "PROCESSADO", "itens_nao_encontrados": itens_nao_encontrados}}
         )
         
-        return {"message": "XML processado e integrado com sucesso"}
+        return {
+            "message": "XML processado e integrado com sucesso",
+            "itens_processados": len(itens) - len(itens_nao_encontrados),
+            "itens_nao_encontrados": itens_nao_encontrados
+        }
         
-    except Exception as e:
+    except Exception:
         await db.xml_processamentos.update_one(
-            {"_id": xml_id},
+            {"id": xml_id},
             {"$set": {"status": "ERRO"}}
         )
-        raise HTTPException(status_code=500, detail=f"Erro ao processar: {str(e)}")
+        raise
 
 # ============= MARKETPLACE/UPSELLER - EXPORTAÇÃO DE DADOS =============
 
 @api_router.get("/marketplace/exportar-estoque")
 async def exportar_estoque_marketplace(formato: str = "json"):
     """Exporta estoque consolidado para marketplaces (CSV, JSON, XML)"""
-    produtos = await db.produtos.find({"ativo": True}).to_list(1000)
+    produtos = await db.produtos.find({"ativo": True}, PROJECAO_EXPORTACAO).to_list(1000)
     
-    dados_exportacao = []
-    for produto in produtos:
-        dados_exportacao.append({
-            "sku": produto["sku"],
-            "nome": produto["nome"],
-            "descricao": produto.get("descricao", ""),
-            "marca": produto.get("marca", ""),
-            "categoria": produto.get("categoria", ""),
-            "ean": produto.get("ean", ""),
-            "estoque_disponivel": produto["estoque_total"],
-            "custo_medio": round(produto["custo_medio"], 2),
-            "preco_venda": round(produto["preco_venda"], 2),
-            "margem_percentual": round(produto.get("margem_percentual", 0), 2),
-            "ativo": produto["ativo"],
-            "atualizado_em": produto["updated_at"].isoformat()
-        })
+    exportacao = gerar_exportacao_estoque(produtos, formato)
     
     if formato == "csv":
-        import csv
-        import io
-        
-        output = io.StringIO()
-        writer = csv.DictWriter(output, fieldnames=dados_exportacao[0].keys() if dados_exportacao else [])
-        writer.writeheader()
-        writer.writerows(dados_exportacao)
-        
         return {
             "formato": "csv",
-            "dados": output.getvalue(),
-            "total_produtos": len(dados_exportacao)
+            "dados": exportacao,
+            "total_produtos": len(produtos)
         }
     
     return {
         "formato": "json", 
-        "produtos": dados_exportacao,
-        "total_produtos": len(dados_exportacao),
+        "produtos": exportacao,
+        "total_produtos": len(exportacao),
         "exportado_em": datetime.utcnow().isoformat()
     }
 
 @api_router.post("/marketplace/processar-venda")
 async def processar_venda_marketplace(venda_data: dict):
-    """Processa vendas vindas de marketplaces (entrada manual de dados)"""
-    try:
-        # Extrair dados da venda
-        cnpj_vendedor = venda_data.get("cnpj_vendedor")
-        marketplace = venda_data.get("marketplace", "UPSELLER")
-        produtos_vendidos = venda_data.get("produtos", [])
-        valor_bruto = venda_data.get("valor_bruto", 0)
-        valor_liquido = venda_data.get("valor_liquido", 0)
-        taxas = venda_data.get("taxas", 0)
-        pedido_id = venda_data.get("pedido_id", "")
-        data_venda = venda_data.get("data_venda", date.today().isoformat())
-        
-        if not cnpj_vendedor or not produtos_vendidos:
-            raise HTTPException(status_code=400, detail="CNPJ vendedor e produtos são obrigatórios")
-        
-        lucro_total = 0
-        produtos_processados = 0
-        
-        # Processar cada produto vendido
-        for item in produtos_vendidos:
-            sku = item.get("sku")
-            quantidade = item.get("quantidade", 0)
-            preco_unitario = item.get("preco_unitario", 0)
-            
-            if not sku or quantidade <= 0:
-                continue
+    """Enfileira vendas vindas de marketplaces (entrada manual de dados)"""
+    if not venda_data.get("cnpj_vendedor") or not venda_data.get("produtos"):
+        raise HTTPException(status_code=400, detail="CNPJ vendedor e produtos são obrigatórios")
+    
+    await validar_cnpj_empresa(venda_data["cnpj_vendedor"])
+    
+    tarefa = await fila_tarefas.enfileirar("PROCESSAR_VENDA", venda_data, "marketplace")
+    return {"message": "Venda enfileirada para processamento", "tarefa_id": tarefa["id"], "status": tarefa["status"]}
+
+@fila_tarefas.tarefa("PROCESSAR_VENDA")
+async def executar_venda_marketplace(venda_data: dict, usuario: str):
+    """Processa vendas vindas de marketplaces"""
+    # Extrair dados da venda
+    cnpj_vendedor = venda_data.get("cnpj_vendedor")
+    marketplace = venda_data.get("marketplace", "UPSELLER")
+    produtos_vendidos = venda_data.get("produtos", [])
+    valor_bruto = venda_data.get("valor_bruto", 0)
+    valor_liquido = venda_data.get("valor_liquido", 0)
+    taxas = venda_data.get("taxas", 0)
+    pedido_id = venda_data.get("pedido_id", "")
+    data_venda = venda_data.get("data_venda", date.today().isoformat())
+    
+    if not cnpj_vendedor or not produtos_vendidos:
+        raise HTTPException(status_code=400, detail="CNPJ vendedor e produtos são obrigatórios")
+    
+    await validar_cnpj_empresa(cnpj_vendedor)
+    
+    lucro_total = 0
+    produtos_processados = 0
+    
+    # Identificar todos os produtos vendidos de uma vez
+    ids_sku, _ = await resolver_ids_produtos([item.get("sku") for item in produtos_vendidos])
+    produtos = await db.produtos.find({"id": {"$in": list(ids_sku.values())}}).to_list(None)
+    produtos_por_id = {p["id"]: p for p in produtos}
+    
+    # Processar cada produto vendido
+    for item in produtos_vendidos:
+        sku = item.get("sku")
+        quantidade = item.get("quantidade", 0)
+        preco_unitario = item.get("preco_unitario", 0)
+        
+        if not sku or quantidade <= 0:
+            continue
+        
+        produto = produtos_por_id.get(ids_sku.get(sku))
+        if produto:
+            produto_id = produto["id"]
+            custo_medio = produto["custo_medio"]
             
-            # Buscar produto
-            produto = await db.produtos.find_one({"sku": sku})
-            if produto:
-                produto_id = produto["id"]
-                custo_medio = produto["custo_medio"]
-                
-                # Verificar se há estoque suficiente no CNPJ
-                estoque_cnpj = next((e for e in produto.get("estoques_cnpj", []) if e["cnpj"] == cnpj_vendedor), None)
-                if not estoque_cnpj or estoque_cnpj["quantidade"] < quantidade:
-                    raise HTTPException(
-                        status_code=400, 
-                        detail=f"Estoque insuficiente para produto {sku} no CNPJ {cnpj_vendedor}"
-                    )
-                
-                # Calcular lucro do item
-                lucro_item = (preco_unitario - custo_medio) * quantidade
-                lucro_total += lucro_item
-                
-                # Baixar estoque (do CNPJ que vendeu)
-                await atualizar_estoque_produto(produto_id, cnpj_vendedor, quantidade, "SAIDA")
-                
-                # Criar movimentação de estoque
-                await criar_movimentacao_estoque(
-                    produto_id=produto_id,
-                    cnpj=cnpj_vendedor,
-                    tipo="VENDA",
-                    quantidade_entrada=0,
-                    quantidade_saida=quantidade,
-                    documento=pedido_id,
-                    descricao=f"Venda {marketplace} - {produto['nome']}",
-                    valor_unitario=preco_unitario,
-                    usuario="marketplace"
+            # Verificar se há estoque suficiente no CNPJ
+            estoque_cnpj = next((e for e in produto.get("estoques_cnpj", []) if e["cnpj"] == cnpj_vendedor), None)
+            if not estoque_cnpj or estoque_cnpj["quantidade"] < quantidade:
+                raise HTTPException(
+                    status_code=400, 
+                    detail=f"Estoque insuficiente para produto {sku} no CNPJ {cnpj_vendedor}"
                 )
-                
-                produtos_processados += 1
-        
-        # Criar conta a receber (valor líquido)
-        if valor_liquido > 0:
-            conta_receber = ContaFinanceira(
-                tipo="RECEBER",
-                descricao=f"Venda {marketplace} - Pedido {pedido_id}",
-                valor=valor_liquido,
-                data_vencimento=datetime.strptime(data_venda, "%Y-%m-%d").date(),
-                categoria=f"VENDAS_{marketplace}",
-                documento=pedido_id,
-                cnpj=cnpj_vendedor
-            )
             
-            await db.contas_financeiras.insert_one(conta_receber.dict())
-        
-        # Registrar taxas como despesa se houver
-        if taxas > 0:
-            taxa_despesa = ContaFinanceira(
-                tipo="PAGAR",
-                descricao=f"Taxas {marketplace} - Pedido {pedido_id}",
-                valor=taxas,
-                data_vencimento=datetime.strptime(data_venda, "%Y-%m-%d").date(),
-                categoria=f"TAXAS_{marketplace}",
-                documento=pedido_id,
+            # Calcular lucro do item
+            lucro_item = (preco_unitario - custo_medio) * quantidade
+            lucro_total += lucro_item
+            
+            # Baixar estoque (do CNPJ que vendeu)
+            await atualizar_estoque_produto(produto_id, cnpj_vendedor, quantidade, "SAIDA")
+            estoque_cnpj["quantidade"] -= quantidade  # mesmo SKU pode repetir no pedido
+            
+            # Criar movimentação de estoque
+            await criar_movimentacao_estoque(
+                produto_id=produto_id,
                 cnpj=cnpj_vendedor,
-                status="PAGO"  # Taxas já são descontadas
+                tipo="VENDA",
+                quantidade_entrada=0,
+                quantidade_saida=quantidade,
+                documento=pedido_id,
+                descricao=f"Venda {marketplace} - {produto['nome']}",
+                valor_unitario=preco_unitario,
+                usuario=usuario
             )
             
-            await db.contas_financeiras.insert_one(taxa_despesa.dict())
+            produtos_processados += 1
+    
+    # Criar conta a receber (valor líquido)
+    if valor_liquido > 0:
+        conta_receber = ContaFinanceira(
+            tipo="RECEBER",
+            descricao=f"Venda {marketplace} - Pedido {pedido_id}",
+            valor=valor_liquido,
+            data_vencimento=datetime.strptime(data_venda, "%Y-%m-%d").date(),
+            categoria=f"VENDAS_{marketplace}",
+            documento=pedido_id,
+            cnpj=cnpj_vendedor
+        )
         
-        return {
-            "message": "Venda processada com sucesso",
-            "marketplace": marketplace,
-            "pedido_id": pedido_id,
-            "lucro_bruto": round(lucro_total, 2),
-            "valor_liquido": valor_liquido,
-            "produtos_processados": produtos_processados
-        }
+        await db.contas_financeiras.insert_one(documento_bson(conta_receber.dict()))
+    
+    # Registrar taxas como despesa se houver
+    if taxas > 0:
+        taxa_despesa = ContaFinanceira(
+            tipo="PAGAR",
+            descricao=f"Taxas {marketplace} - Pedido {pedido_id}",
+            valor=taxas,
+            data_vencimento=datetime.strptime(data_venda, "%Y-%m-%d").date(),
+            categoria=f"TAXAS_{marketplace}",
+            documento=pedido_id,
+            cnpj=cnpj_vendedor,
+            status="PAGO"  # Taxas já são descontadas
+        )
         
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Erro ao processar venda: {str(e)}")
+        await db.contas_financeiras.insert_one(documento_bson(taxa_despesa.dict()))
+    
+    if valor_liquido > 0 or taxas > 0:
+        await registrar_alteracao_financeiro([cnpj_vendedor])
+    
+    return {
+        "message": "Venda processada com sucesso",
+        "marketplace": marketplace,
+        "pedido_id": pedido_id,
+        "lucro_bruto": round(lucro_total, 2),
+        "valor_liquido": valor_liquido,
+        "produtos_processados": produtos_processados
+    }
+
 
 @api_router.get("/marketplace/relatorio-lucros")
 async def relatorio_lucros_marketplace(marketplace: str = None, periodo_dias: int = 30):
     """Relatório de lucros por marketplace"""
-    data_inicio = datetime.utcnow() - relativedelta(days=periodo_dias)
+    data_inicio = datetime.utcnow() - timedelta(days=periodo_dias)
     
     filter_query = {
         "tipo": "VENDA",
@@ -1005,41 +3981,19 @@ async def relatorio_lucros_marketplace(marketplace: str = None, periodo_dias: in
         filter_query["descricao"] = {"$regex": marketplace, "$options": "i"}
     
     # Buscar movimentações de venda
-    movimentacoes = await db.movimentacoes_estoque.find(filter_query).to_list(1000)
+    movimentacoes = await db.movimentacoes_estoque.find(
+        filter_query,
+        {"_id": 0, "produto_id": 1, "descricao": 1, "valor_unitario": 1, "quantidade_saida": 1, "valor_total": 1}
+    ).to_list(1000)
     
-    lucro_total = 0
-    vendas_por_marketplace = {}
+    # Custo médio de todos os produtos vendidos em uma única consulta
+    produtos = await db.produtos.find(
+        {"id": {"$in": list({mov["produto_id"] for mov in movimentacoes})}},
+        {"_id": 0, "id": 1, "custo_medio": 1}
+    ).to_list(None)
+    custos = {p["id"]: p.get("custo_medio", 0) for p in produtos}
     
-    for mov in movimentacoes:
-        # Extrair marketplace da descrição
-        desc = mov.get("descricao", "")
-        if "UPSELLER" in desc:
-            marketplace_nome = "UPSELLER"
-        elif "MERCADO LIVRE" in desc:
-            marketplace_nome = "MERCADO_LIVRE"
-        else:
-            marketplace_nome = "OUTROS"
-        
-        if marketplace_nome not in vendas_por_marketplace:
-            vendas_por_marketplace[marketplace_nome] = {
-                "vendas": 0,
-                "quantidade": 0,
-                "valor_vendido": 0,
-                "lucro_estimado": 0
-            }
-        
-        # Buscar produto para calcular lucro
-        produto = await db.produtos.find_one({"id": mov["produto_id"]})
-        if produto:
-            custo_medio = produto.get("custo_medio", 0)
-            lucro_item = (mov["valor_unitario"] - custo_medio) * mov["quantidade_saida"]
-            
-            vendas_por_marketplace[marketplace_nome]["vendas"] += 1
-            vendas_por_marketplace[marketplace_nome]["quantidade"] += mov["quantidade_saida"]
-            vendas_por_marketplace[marketplace_nome]["valor_vendido"] += mov["valor_total"]
-            vendas_por_marketplace[marketplace_nome]["lucro_estimado"] += lucro_item
-            
-            lucro_total += lucro_item
+    lucro_total, vendas_por_marketplace = calcular_lucros_marketplace(movimentacoes, custos)
     
     return {
         "periodo_dias": periodo_dias,
@@ -1048,6 +4002,47 @@ async def relatorio_lucros_marketplace(marketplace: str = None, periodo_dias: in
         "gerado_em": datetime.utcnow().isoformat()
     }
 
+# ============= TAREFAS ROUTES =============
+
+@api_router.get("/tarefas")
+async def get_tarefas(status: str = None, tipo: str = None, current_user: str = Depends(get_current_user)):
+    filter_query = {}
+    if status:
+        filter_query["status"] = status
+    if tipo:
+        filter_query["tipo"] = tipo
+    
+    tarefas = await db.tarefas.find(filter_query, {"_id": 0, "payload": 0}).sort("created_at", -1).to_list(100)
+    return tarefas
+
+@api_router.get("/tarefas/{tarefa_id}")
+async def get_tarefa(tarefa_id: str, current_user: str = Depends(get_current_user)):
+    """Consulta o status de uma tarefa enfileirada"""
+    tarefa = await db.tarefas.find_one({"id": tarefa_id}, {"_id": 0, "payload": 0})
+    if tarefa:
+        return tarefa
+    raise HTTPException(status_code=404, detail="Tarefa não encontrada")
+
+# ============= MÉTRICAS ROUTES =============
+
+@api_router.get("/metricas/compressao")
+async def get_metricas_compressao(current_user: str = Depends(get_current_user)):
+    """Bytes economizados pela compressão de respostas neste processo"""
+    por_codificacao = {}
+    for codificacao, metricas in metricas_compressao.items():
+        dados = dict(metricas)
+        if dados.get("bytes_originais"):
+            dados["bytes_economizados"] = dados["bytes_originais"] - dados["bytes_comprimidos"]
+            dados["taxa_compressao"] = round(dados["bytes_originais"] / max(dados["bytes_comprimidos"], 1), 2)
+        por_codificacao[codificacao] = dados
+    
+    return {
+        "brotli_disponivel": brotli is not None,
+        "tamanho_minimo": COMPRESSAO_TAMANHO_MINIMO,
+        "bytes_economizados": sum(d.get("bytes_economizados", 0) for d in por_codificacao.values()),
+        "por_codificacao": por_codificacao
+    }
+
 # ============= DASHBOARD ROUTES =============
 
 @api_router.get("/dashboard")
@@ -1067,6 +4062,7 @@ async def get_dashboard(current_user: str = Depends(get_current_user)):
     
     # Financeiro
     relatorio_financeiro = await get_relatorios_financeiros(current_user)
+    vencidos = await get_resumo_vencidos()
     
     # Vendas do mês
     today = date.today()
@@ -1086,7 +4082,8 @@ async def get_dashboard(current_user: str = Depends(get_current_user)):
         "valor_estoque": round(estoque_valor, 2),
         "vendas_mes": vendas_mes_data["total_vendas"],
         "valor_vendas_mes": round(vendas_mes_data["valor_vendas"], 2),
-        "financeiro": relatorio_financeiro
+        "financeiro": relatorio_financeiro,
+        "contas_vencidas": vencidos
     }
 
 # Basic routes
@@ -1097,6 +4094,8 @@ async def root():
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(CompressaoMiddleware, prefixo="/api")
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -1112,6 +4111,43 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def startup_db_client():
+    global transacoes_suportadas
+    
+    hello = await db.command("hello")
+    transacoes_suportadas = "setName" in hello or hello.get("msg") == "isdbgrid"
+    
+    await criar_indices()
+    await migrar_dinheiro_decimal()
+    await carregar_empresas_config()
+    await carregar_regras_icms()
+    await carregar_indice_produtos()
+    
+    # Primeira execução: montar o índice de alertas a partir do catálogo
+    if await db.alertas_estoque.estimated_document_count() == 0:
+        await reconstruir_alertas_estoque()
+    
+    await migrar_imagens_base64()
+    
+    # Primeira execução com o extrato bancário: lançar os títulos já pagos
+    if await db.lancamentos_banco.estimated_document_count() == 0:
+        await reconstruir_lancamentos_banco()
+    await migrar_saldo_apos_lancamentos()
+    
+    # XML interrompido no meio do processamento: liberar para novo envio, como as tarefas
+    await db.xml_processamentos.update_many({"status": "PROCESSANDO"}, {"$set": {"status": "ERRO"}})
+    # Importação de catálogo roda em memória (asyncio.create_task): se o processo caiu, não termina mais
+    await db.importacoes_produtos.update_many(
+        {"status": "PROCESSANDO"},
+        {"$set": {"status": "ERRO", "mensagem": "Interrompida pela reinicialização do servidor", "updated_at": datetime.utcnow()}}
+    )
+    await fila_tarefas.iniciar(TAREFAS_WORKERS)
+    agendador.iniciar()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await fila_tarefas.parar()
+    await agendador.parar()
+    encerrar_executor_processos()
     client.close()
\ No newline at end of file
@@ -35,6 +35,7 @@ const Financeiro = () => {
     cliente_id: '',
     documento: '',
     cnpj: '',
+    conta_banco_id: '',
     parcelas: 1
   });
 
@@ -140,6 +141,7 @@ const Financeiro = () => {
       cliente_id: '',
       documento: '',
       cnpj: '',
+      conta_banco_id: '',
       parcelas: 1
     });
   };
@@ -167,7 +169,7 @@ const Financeiro = () => {
     
     if (status === 'PAGO') {
       return <Badge className="bg-green-100 text-green-800">Pago</Badge>;
-    } else if (vencimento < hoje) {
+    } else if (status === 'VENCIDO' || vencimento < hoje) {
       return <Badge variant="destructive">Vencido</Badge>;
     } else {
       return <Badge variant="secondary">Pendente</Badge>;
@@ -317,6 +319,22 @@ const Financeiro = () => {
                 </div>
               </div>
               
+              <div className="space-y-2">
+                <Label htmlFor="conta_banco_id">Conta bancária prevista</Label>
+                <Select value={formData.conta_banco_id} onValueChange={(value) => setFormData(prev => ({...prev, conta_banco_id: value}))}>
+                  <SelectTrigger>
+                    <SelectValue placeholder="Selecione a conta para o fluxo de caixa" />
+                  </SelectTrigger>
+                  <SelectContent>
+                    {contasBanco.map((contaBanco) => (
+                      <SelectItem key={contaBanco.id} value={contaBanco.id}>
+                        {contaBanco.nome}
+                      </SelectItem>
+                    ))}
+                  </SelectContent>
+                </Select>
+              </div>
+              
               {formData.tipo === 'PAGAR' && (
                 <div className="space-y-2">
                   <Label htmlFor="fornecedor_id">Fornecedor</Label>
@@ -516,13 +534,13 @@ const Financeiro = () => {
                       </TableCell>
                       <TableCell>{conta.categoria}</TableCell>
                       <TableCell className="text-right">
-                        {conta.status === 'PENDENTE' && (
+                        {conta.status !== 'PAGO' && (
                           <Button
                             size="sm"
                             variant="outline"
                             onClick={() => {
                               const dataPagamento = new Date().toISOString().split('T')[0];
-                              const contaBancoId = prompt('ID da conta banco:');
+                              const contaBancoId = prompt('ID da conta banco:', conta.conta_banco_id || '');
                               if (contaBancoId) {
                                 handlePagar(conta.id, conta.valor, dataPagamento, contaBancoId);
                               }
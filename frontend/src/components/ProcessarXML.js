@@ -12,6 +12,9 @@ import axios from 'axios';
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
+// Consultas de 1 em 1 segundo ao status do processamento em segundo plano
+const MAXIMO_CONSULTAS_TAREFA = 300;
+
 const CNPJS_CONFIG = {
   "11111111000101": "EMPRESA ABC LTDA",
   "22222222000102": "EMPRESA XYZ LTDA", 
@@ -76,13 +79,29 @@ const ProcessarXML = () => {
     }
   };
 
+  const aguardarTarefa = async (tarefaId) => {
+    // Processamento roda em segundo plano no servidor: consultar até terminar (no máximo 5 minutos)
+    for (let tentativa = 0; tentativa < MAXIMO_CONSULTAS_TAREFA; tentativa++) {
+      const response = await axios.get(`${API}/tarefas/${tarefaId}`);
+      if (response.data.status === 'CONCLUIDO' || response.data.status === 'ERRO') {
+        return response.data;
+      }
+      await new Promise((resolve) => setTimeout(resolve, 1000));
+    }
+    throw new Error('O processamento está demorando mais que o esperado. Verifique o estoque e o financeiro antes de processar novamente.');
+  };
+
   const handleProcessar = async () => {
     if (!dadosXML) return;
 
     setLoading(true);
     
     try {
-      await axios.post(`${API}/xml/${dadosXML._id}/processar`);
+      const response = await axios.post(`${API}/xml/${dadosXML.id}/processar`);
+      const tarefa = await aguardarTarefa(response.data.tarefa_id);
+      if (tarefa.status !== 'CONCLUIDO') {
+        throw new Error(tarefa.erro || 'Falha no processamento');
+      }
       alert('XML processado com sucesso! Estoque e financeiro foram atualizados.');
       
       // Reset form
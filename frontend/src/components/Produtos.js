@@ -430,7 +430,7 @@ const Produtos = () => {
                       <TableCell>
                         <div className="w-12 h-12 bg-gray-100 rounded flex items-center justify-center">
                           {produto.imagem_url ? (
-                            <img src={produto.imagem_url} alt={produto.nome} className="w-full h-full object-cover rounded" />
+                            <img src={produto.imagem_hash ? `${API}/imagens/${produto.imagem_hash}?thumb=1` : produto.imagem_url} alt={produto.nome} className="w-full h-full object-cover rounded" />
                           ) : (
                             <Image className="h-6 w-6 text-gray-400" />
                           )}
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# O módulo cria o cliente Motor na importação (conexão preguiçosa): basta uma URL qualquer
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "erp_testes")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
@@ -0,0 +1,55 @@
+from server_mongodb_backup import IndiceProdutos
+
+
+def _indice(*produtos):
+    indice = IndiceProdutos()
+    for produto in produtos:
+        indice.adicionar(produto, ordenar=False)
+    indice.ordenar()
+    return indice
+
+
+PRODUTOS = [
+    {"id": "1", "sku": "CAB-001", "ean": "7891000000011", "nome": "Cabo HDMI 2 metros"},
+    {"id": "2", "sku": "CAB-002", "ean": "", "nome": "Cabo USB-C"},
+    {"id": "3", "sku": "MOU-010", "ean": "", "nome": "Mouse óptico sem fio"},
+    {"id": "4", "sku": "TEC-100", "ean": "", "nome": "Teclado sem fio"},
+]
+
+
+def test_buscar_sku_e_ean_exatos_primeiro():
+    indice = _indice(*PRODUTOS)
+    
+    assert indice.buscar("cab-002")[0] == "2"
+    assert indice.buscar("7891000000011") == ["1"]
+
+
+def test_buscar_prefixo_de_sku():
+    assert _indice(*PRODUTOS).buscar("CAB") == ["1", "2"]
+
+
+def test_buscar_nome_sem_acento_e_com_erro_de_digitacao():
+    indice = _indice(*PRODUTOS)
+    
+    assert indice.buscar("mouse optico")[0] == "3"
+    assert indice.buscar("tecaldo sem fio")[0] == "4"
+    assert set(indice.buscar("sem fio")) == {"3", "4"}
+
+
+def test_buscar_respeita_limite_e_termo_vazio():
+    indice = _indice(*PRODUTOS)
+    
+    assert len(indice.buscar("cabo", limite=1)) == 1
+    assert indice.buscar("   ") == []
+
+
+def test_buscar_reflete_atualizacao_e_remocao():
+    indice = _indice(*PRODUTOS)
+    indice.adicionar({"id": "2", "sku": "USB-002", "ean": "", "nome": "Adaptador USB-C"})
+    
+    assert indice.buscar("CAB") == ["1"]
+    assert indice.buscar("USB-002") == ["2"]
+    
+    indice.remover("2")
+    assert indice.buscar("USB") == []
+    assert indice.buscar_exato("USB-002") is None
@@ -0,0 +1,49 @@
+import pandas as pd
+
+from server_mongodb_backup import preparar_catalogo
+
+
+def test_preparar_catalogo_normaliza_e_calcula_margem():
+    df = pd.DataFrame({
+        " SKU ": ["A1", "B2"],
+        "Nome": [" Cabo ", "Mouse"],
+        "valor_compra": ["10,00", "0"],
+        "preco_venda": ["15", "20"],
+        "fora_estado": ["sim", ""],
+    })
+    registros, erros = preparar_catalogo(df)
+    
+    assert erros == []
+    assert registros[0]["sku"] == "A1"
+    assert registros[0]["nome"] == "Cabo"
+    assert registros[0]["valor_compra"] == 10.0
+    assert registros[0]["margem_percentual"] == 50.0
+    assert registros[0]["fora_estado"] is True
+    assert registros[1]["margem_percentual"] == 0.0
+    assert registros[1]["fora_estado"] is False
+
+
+def test_preparar_catalogo_devolve_so_colunas_do_arquivo():
+    registros, erros = preparar_catalogo(pd.DataFrame({"sku": ["A1"], "nome": ["Cabo"], "preco_venda": ["12,5"]}))
+    
+    assert erros == []
+    # Sem valor_compra no arquivo: nem ele nem a margem sobrescrevem o produto existente
+    assert registros == [{"sku": "A1", "nome": "Cabo", "preco_venda": 12.5}]
+
+
+def test_preparar_catalogo_erros_por_linha_e_sku_repetido():
+    df = pd.DataFrame({
+        "sku": ["A1", "", "C3", "D4", "A1"],
+        "nome": ["Cabo", "Sem SKU", "", "Negativo", "Cabo novo"],
+        "valor_compra": ["1", "1", "1", "-5", "2"],
+        "preco_venda": ["2", "2", "2", "abc", "3"],
+    })
+    registros, erros = preparar_catalogo(df)
+    
+    assert erros == [
+        {"linha": 2, "sku": "", "erro": "SKU não informado"},
+        {"linha": 3, "sku": "C3", "erro": "Nome não informado"},
+        {"linha": 4, "sku": "D4", "erro": "Valor de compra/venda inválido"},
+    ]
+    # Mesmo SKU repetido no arquivo: vale a última linha
+    assert [(registro["sku"], registro["nome"]) for registro in registros] == [("A1", "Cabo novo")]
@@ -0,0 +1,42 @@
+import pytest
+
+import server_mongodb_backup
+from server_mongodb_backup import CompressaoMiddleware
+
+
+def _negociar(accept_encoding):
+    headers = [(b"accept-encoding", accept_encoding.encode())] if accept_encoding is not None else []
+    return CompressaoMiddleware(None)._negociar({"headers": headers})
+
+
+@pytest.fixture
+def com_brotli(monkeypatch):
+    # _negociar só verifica se o módulo está disponível
+    monkeypatch.setattr(server_mongodb_backup, "brotli", object())
+
+
+@pytest.fixture
+def sem_brotli(monkeypatch):
+    monkeypatch.setattr(server_mongodb_backup, "brotli", None)
+
+
+@pytest.mark.parametrize("accept_encoding, esperado", [
+    ("gzip, deflate, br", "br"),
+    ("br;q=0.5, gzip", "gzip"),
+    ("gzip;q=0, br;q=0", None),
+    ("*", "br"),
+    ("*;q=0.1, br;q=0", "gzip"),
+    ("identity", None),
+    (None, None),
+])
+def test_negociar_com_brotli(com_brotli, accept_encoding, esperado):
+    assert _negociar(accept_encoding) == esperado
+
+
+@pytest.mark.parametrize("accept_encoding, esperado", [
+    ("br", None),
+    ("br, GZIP;q=0.2", "gzip"),
+    ("gzip;q=abc", None),
+])
+def test_negociar_sem_brotli(sem_brotli, accept_encoding, esperado):
+    assert _negociar(accept_encoding) == esperado
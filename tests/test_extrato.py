@@ -0,0 +1,125 @@
+from datetime import date
+from decimal import Decimal
+
+from server_mongodb_backup import conciliar_extrato, ler_extrato
+
+OFX = b"""OFXHEADER:100
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>
+<STMTTRN>
+<TRNTYPE>DEBIT
+<DTPOSTED>20240105120000[-3:BRT]
+<TRNAMT>-150.00
+<FITID>A1
+<CHECKNUM>123
+<MEMO>Fornecedor X
+</STMTTRN>
+<STMTTRN>
+<TRNTYPE>CREDIT
+<DTPOSTED>20240106
+<TRNAMT>80,5
+<FITID>A2
+<NAME>Cliente Y
+</STMTTRN>
+<STMTTRN>
+<TRNTYPE>CREDIT
+<TRNAMT>10.00
+</STMTTRN>
+</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>
+"""
+
+
+def test_ler_extrato_ofx():
+    extrato = ler_extrato(OFX, "extrato.OFX")
+    
+    assert [linha["fitid"] for linha in extrato["linhas"]] == ["A1", "A2"]
+    primeira, segunda = extrato["linhas"]
+    assert primeira["data"] == date(2024, 1, 5)
+    assert primeira["valor"] == Decimal("-150.00")
+    assert primeira["documento"] == "123"
+    assert primeira["descricao"] == "Fornecedor X"
+    assert segunda["valor"] == Decimal("80.50")
+    assert segunda["descricao"] == "Cliente Y"
+    assert [erro["linha"] for erro in extrato["erros"]] == [3]
+
+
+def test_ler_extrato_csv_numera_linhas_a_partir_do_cabecalho():
+    csv = (
+        "data;valor;descricao;documento\n"
+        "05/01/2024;1.234,56;Venda;NF1\n"
+        "data ruim;10,00;Venda;NF2\n"
+        "2024-01-07;-10;Tarifa;\n"
+    ).encode()
+    extrato = ler_extrato(csv, "extrato.csv")
+    
+    assert [linha["valor"] for linha in extrato["linhas"]] == [Decimal("1234.56"), Decimal("-10.00")]
+    assert [erro["linha"] for erro in extrato["erros"]] == [3]
+
+
+def test_ler_extrato_sem_fitid_distingue_lancamentos_identicos():
+    csv = (
+        "data;valor;descricao\n"
+        "05/01/2024;10,00;Tarifa\n"
+        "05/01/2024;10,00;Tarifa\n"
+    ).encode()
+    primeira, segunda = ler_extrato(csv, "extrato.csv")["linhas"]
+    
+    assert primeira["fitid"].startswith("H")
+    assert primeira["fitid"] != segunda["fitid"]
+    # Reimportar o mesmo arquivo gera os mesmos FITIDs (deduplicação)
+    assert [linha["fitid"] for linha in ler_extrato(csv, "extrato.csv")["linhas"]] == [primeira["fitid"], segunda["fitid"]]
+
+
+def _linha(valor, dia, documento=""):
+    return {"valor": Decimal(valor), "data": date(2024, 1, dia), "documento": documento}
+
+
+def _titulo(id, tipo, valor, dia, documento="", valor_pago="0"):
+    return {
+        "id": id, "tipo": tipo, "valor": Decimal(valor), "valor_pago": Decimal(valor_pago),
+        "data_vencimento": date(2024, 1, dia), "documento": documento
+    }
+
+
+def test_conciliar_extrato_casa_por_tipo_valor_e_janela():
+    titulos = [
+        _titulo("pagar", "PAGAR", "100.00", 10),
+        _titulo("receber", "RECEBER", "100.00", 10),
+        _titulo("longe", "RECEBER", "50.00", 25),
+    ]
+    resultados = conciliar_extrato([_linha("-100.00", 11), _linha("100.00", 8), _linha("50.00", 10)], titulos, 3)
+    
+    assert resultados == [
+        {"status": "CONCILIADO", "conta_id": "pagar"},
+        {"status": "CONCILIADO", "conta_id": "receber"},
+        {"status": "NAO_CONCILIADO"},
+    ]
+
+
+def test_conciliar_extrato_considera_saldo_em_aberto():
+    titulos = [_titulo("parcial", "PAGAR", "100.00", 10, valor_pago="40.00")]
+    
+    assert conciliar_extrato([_linha("-60.00", 10)], titulos, 0) == [{"status": "CONCILIADO", "conta_id": "parcial"}]
+
+
+def test_conciliar_extrato_documento_desempata_e_titulo_nao_e_reusado():
+    titulos = [
+        _titulo("a", "RECEBER", "30.00", 10, documento="NF1"),
+        _titulo("b", "RECEBER", "30.00", 11, documento="NF2"),
+    ]
+    resultados = conciliar_extrato(
+        [_linha("30.00", 10, "NF2"), _linha("30.00", 10), _linha("30.00", 10)],
+        titulos,
+        3
+    )
+    
+    assert resultados == [
+        {"status": "CONCILIADO", "conta_id": "b"},
+        {"status": "CONCILIADO", "conta_id": "a"},
+        {"status": "NAO_CONCILIADO"},
+    ]
+
+
+def test_conciliar_extrato_ambiguo_lista_candidatos():
+    titulos = [_titulo("a", "PAGAR", "30.00", 10), _titulo("b", "PAGAR", "30.00", 12)]
+    
+    assert conciliar_extrato([_linha("-30.00", 11)], titulos, 3) == [{"status": "AMBIGUO", "candidatos": ["a", "b"]}]
@@ -0,0 +1,38 @@
+from datetime import date
+from decimal import Decimal
+
+from server_mongodb_backup import ContaFinanceiraCreate, gerar_parcelas
+
+
+def test_gerar_parcelas_sobra_de_centavos_na_ultima():
+    conta = ContaFinanceiraCreate(
+        tipo="PAGAR", descricao="Aluguel", valor=Decimal("100.00"), data_vencimento=date(2024, 1, 31), parcelas=3
+    )
+    parcelas = gerar_parcelas(conta.model_dump())
+    
+    assert [parcela.valor for parcela in parcelas] == [Decimal("33.33"), Decimal("33.33"), Decimal("33.34")]
+    assert sum(parcela.valor for parcela in parcelas) == Decimal("100.00")
+    assert [parcela.parcela for parcela in parcelas] == [1, 2, 3]
+    assert {parcela.total_parcelas for parcela in parcelas} == {3}
+    assert parcelas[1].descricao == "Aluguel - Parcela 2/3"
+
+
+def test_gerar_parcelas_vencimento_mensal_ajusta_fim_de_mes():
+    conta = ContaFinanceiraCreate(
+        tipo="RECEBER", descricao="Venda", valor=Decimal("10.00"), data_vencimento=date(2024, 1, 31), parcelas=3
+    )
+    parcelas = gerar_parcelas(conta.model_dump())
+    
+    assert [parcela.data_vencimento for parcela in parcelas] == [date(2024, 1, 31), date(2024, 2, 29), date(2024, 3, 31)]
+    assert len({parcela.id for parcela in parcelas}) == 3
+
+
+def test_gerar_parcelas_conta_a_vista():
+    conta = ContaFinanceiraCreate(
+        tipo="PAGAR", descricao="Frete", valor=Decimal("0.01"), data_vencimento=date(2024, 5, 2), conta_banco_id="banco-1"
+    )
+    [parcela] = gerar_parcelas(conta.model_dump())
+    
+    assert parcela.valor == Decimal("0.01")
+    assert parcela.conta_banco_id == "banco-1"
+    assert parcela.descricao == "Frete - Parcela 1/1"
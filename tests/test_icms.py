@@ -0,0 +1,47 @@
+from server_mongodb_backup import ALIQUOTA_FORA_ESTADO_PADRAO, TabelaICMS
+
+
+def _regra(uf_origem, uf_destino, aliquota, ncm_prefixo="", categoria=""):
+    return {
+        "uf_origem": uf_origem, "uf_destino": uf_destino, "aliquota": aliquota,
+        "ncm_prefixo": ncm_prefixo, "categoria": categoria
+    }
+
+
+TABELA = TabelaICMS([
+    _regra("*", "*", 4.0),
+    _regra("SP", "*", 7.0),
+    _regra("SP", "RJ", 12.0),
+    _regra("SP", "RJ", 18.0, ncm_prefixo="8471"),
+    _regra("SP", "RJ", 25.0, ncm_prefixo="8471", categoria="Informática"),
+])
+
+
+def test_aliquotas_regra_mais_especifica_vence():
+    aliquotas = TABELA.aliquotas(
+        "sp", "rj",
+        ["84713012", "84713012", "22030000", None],
+        ["Informática", "Outros", "", None],
+        [False, False, False, False]
+    )
+    
+    assert aliquotas.tolist() == [25.0, 18.0, 12.0, 12.0]
+
+
+def test_aliquotas_curingas_de_uf():
+    assert TABELA.aliquotas("SP", "MG", ["1"], [""], [False]).tolist() == [7.0]
+    assert TABELA.aliquotas("PR", "MG", ["1"], [""], [False]).tolist() == [4.0]
+
+
+def test_aliquotas_operacao_interna_e_zero():
+    assert TABELA.aliquotas("SP", "sp", ["84713012"], ["Informática"], [True]).tolist() == [0.0]
+
+
+def test_aliquotas_sem_regra_usa_fora_estado():
+    tabela = TabelaICMS([_regra("SP", "RJ", 12.0, ncm_prefixo="8471")])
+    
+    assert tabela.aliquotas("SP", "RJ", ["2203", "2203", "8471"], ["", "", ""], [True, False, False]).tolist() == [
+        ALIQUOTA_FORA_ESTADO_PADRAO, 0.0, 12.0
+    ]
+    # Sem UF de origem conhecida nenhuma regra se aplica
+    assert tabela.aliquotas("", "RJ", ["8471"], [""], [True]).tolist() == [ALIQUOTA_FORA_ESTADO_PADRAO]